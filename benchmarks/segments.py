@@ -0,0 +1,170 @@
+'''
+Segment compilation benchmarks
+
+Times turning parsed HLS and DASH manifests into `Segment` lists, with the
+previous implementation (numbering segments with a list search per segment)
+and the protocols' current one, on generated manifests. The previous one is
+quadratic, it's measured on smaller manifests, `--legacy-segments`
+
+    python benchmarks/segments.py --segments 50000
+'''
+import argparse
+import os
+import sys
+
+from time import perf_counter
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import xmltodict
+
+from m3u8 import parse
+
+from singularity.downloader.penguin.protocols import HTTPLiveStream, MPEGDASHStream
+from singularity.types.stream import ContentKey, Segment, Stream
+from singularity.utils import get_extension
+
+BASE_URL = 'https://cdn.example.com/title/'
+
+
+def make_hls(segments: int, byterange=False) -> str:
+    lines = ['#EXTM3U', '#EXT-X-VERSION:4', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0']
+    for i in range(segments):
+        lines.append('#EXTINF:4.000,')
+        if byterange:
+            lines.append(f'#EXT-X-BYTERANGE:{100000 + i % 7}')
+            lines.append('video.ts')
+        else:
+            lines.append(f'video/segment{i}.ts')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def make_mpd(segments: int) -> str:
+    offset = 1000
+    urls = []
+    for i in range(segments):
+        size = 100000 + i % 7
+        urls.append(f'<SegmentURL mediaRange="{offset}-{offset + size - 1}"/>')
+        offset += size
+    return (
+        '<?xml version="1.0"?>\n'
+        '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static"><Period>'
+        '<AdaptationSet contentType="video">'
+        '<Representation id="v1" height="1080" bandwidth="5000000"><BaseURL>video.mp4</BaseURL>'
+        f'<SegmentList><Initialization range="0-999"/>{"".join(urls)}</SegmentList>'
+        '</Representation></AdaptationSet></Period></MPD>'
+        )
+
+
+def legacy_hls_segments(parsed_stream: dict, stream_url: str) -> list:
+    return [
+        Segment(
+            url=urljoin(stream_url, s['uri']),
+            number=parsed_stream['segments'].index(s),
+            media_type='video',
+            key=ContentKey(s['key'].get('uri'), None, s['key']['method']) if s.get('key') else None,
+            group='video0',
+            duration=s['duration'],
+            init=False,
+            ext=get_extension(urljoin(stream_url, s['uri'])),
+            mpd_range=None
+            )
+        for s in parsed_stream['segments']
+        ]
+
+
+def legacy_dash_segments(representation: dict, stream_url: str) -> list:
+    return [
+        Segment(
+            url=stream_url,
+            number=list(representation['SegmentList']['SegmentURL']).index(s),
+            media_type='video',
+            key=None,
+            group='video0',
+            init=False,
+            duration=None,
+            ext=get_extension(stream_url),
+            mpd_range=s['@mediaRange']
+            )
+        for s in representation['SegmentList']['SegmentURL']
+        ]
+
+
+def hls_segments(parsed_stream: dict) -> list:
+    'Runs the segment compilation of `HTTPLiveStream` on an already parsed playlist'
+    protocol = HTTPLiveStream(Stream(url=BASE_URL + 'master.m3u8', id='0', preferred=True, name={}, language={}, key=None))
+    protocol.processed_tracks = {'video': -1, 'audio': -1, 'unified': -1, 'subtitles': -1}
+    protocol.fetch = lambda url: b''
+    module = sys.modules[HTTPLiveStream.__module__]
+    # The playlist is parsed beforehand, measured on its own
+    original_parse = module.parse
+    module.parse = lambda data: parsed_stream
+    try:
+        protocol.get_stream_fragments({'uri': 'video.m3u8', 'stream_info': {}}, force_type='video')
+    finally:
+        module.parse = original_parse
+    return protocol.segment_pools[0].segments
+
+
+def dash_segments(manifest: dict) -> list:
+    'Runs the segment compilation of `MPEGDASHStream` on a parsed manifest'
+    protocol = MPEGDASHStream(Stream(url=BASE_URL + 'manifest.mpd', id='0', preferred=True, name={}, language={}, key=None))
+    protocol.processed_tracks = {'video': -1, 'audio': -1, 'unified': -1, 'subtitles': -1}
+    protocol.manifest_data = manifest
+    protocol.periods = [manifest['MPD']['Period']]
+    adaptation_set = manifest['MPD']['Period']['AdaptationSet']
+    protocol.get_stream_fragments([(protocol.periods[0], adaptation_set, adaptation_set['Representation'])], 'video', 'video')
+    return protocol.segment_pools[0].segments
+
+
+def measure(name: str, function, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<50} {best * 1000:10.1f} ms')
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Segment compilation benchmarks')
+    parser.add_argument('--segments', type=int, default=50000, help='Segments per manifest')
+    parser.add_argument('--legacy-segments', type=int, default=5000, help='Segments per manifest for the previous implementation')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for name, make in (('HLS', make_hls), ('HLS byte ranges', lambda n: make_hls(n, byterange=True))):
+        print(f'{name}')
+        timings = {}
+        for count in sorted({args.legacy_segments // 2, args.legacy_segments, args.segments // 2, args.segments}):
+            parsed = parse(make(count))
+            if count == args.segments:
+                measure(f'  m3u8 parse, {count} segments', lambda: parse(make(count)), 1)
+            if count <= args.legacy_segments:
+                measure(f'  previous, {count} segments', lambda: legacy_hls_segments(parsed, BASE_URL), args.repeat)
+            timings[count] = measure(f'  current, {count} segments', lambda: hls_segments(parsed), args.repeat)
+            assert [s.number for s in hls_segments(parsed)] == list(range(count))
+        print('  current, time per segment: ' + ', '.join(f'{c}: {t / c * 1e6:.2f} us' for c, t in timings.items()) + '\n')
+
+    print('DASH')
+    timings = {}
+    for count in sorted({args.legacy_segments // 2, args.legacy_segments, args.segments // 2, args.segments}):
+        mpd = make_mpd(count)
+        manifest = xmltodict.parse(mpd)
+        representation = manifest['MPD']['Period']['AdaptationSet']['Representation']
+        if count == args.segments:
+            measure(f'  xmltodict parse, {count} segments', lambda: xmltodict.parse(mpd), 1)
+        if count <= args.legacy_segments:
+            measure(f'  previous, {count} segments', lambda: legacy_dash_segments(representation, BASE_URL + 'video.mp4'), args.repeat)
+        timings[count] = measure(f'  current, {count} segments', lambda: dash_segments(manifest), args.repeat)
+        # Initialization segment first
+        assert [s.number for s in dash_segments(manifest)][1:] == list(range(count))
+    print('  current, time per segment: ' + ', '.join(f'{c}: {t / c * 1e6:.2f} us' for c, t in timings.items()))
+
+
+if __name__ == '__main__':
+    main()
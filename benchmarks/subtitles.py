@@ -0,0 +1,136 @@
+'''
+Subtitle conversion micro-benchmarks
+
+Compares the previous in-fetch conversion (regex over the whole decoded document,
+string concatenation) with `singularity.downloader.penguin.subtitles`, on a
+generated multi-language subtitle set, converting serially and in a process pool
+
+    python benchmarks/subtitles.py --languages 30 --paragraphs 2000
+'''
+import argparse
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from singularity.downloader.penguin.subtitles import convert_subtitle, convert_subtitles, fix_vtt, ttml_to_srt
+
+
+def legacy_ttml_to_srt(segment_contents: bytes) -> bytes:
+    subrip_contents = ''
+    subtitle_entries = re.findall(r'<p.+</p>', segment_contents.decode())
+    i = 1
+    for p in subtitle_entries:
+        begin = re.search(r'begin="([\d:.]+)"', p).group(1).replace('.', ',')
+        end = re.search(r'end="([\d:.]+)"', p).group(1).replace('.', ',')
+        contents = re.search(r'>(.+)</p>', p).group(1).replace('<br />', '\n')
+        contents = re.sub(r'<(|/)span>', '', p)
+        contents = contents.replace('&gt;', '')
+        contents = contents.strip()
+        subrip_contents += f'{i}\n{begin} --> {end}\n{contents}\n\n'
+        i += 1
+    return subrip_contents.encode()
+
+
+def legacy_fix_vtt(segment_contents: bytes) -> bytes:
+    segment_contents = re.sub(r'^# ', '<i>', segment_contents.decode(), flags=re.MULTILINE)
+    segment_contents = re.sub(r' #$', '</i>', segment_contents, flags=re.MULTILINE)
+    return segment_contents.replace('&apos;', '\'').encode()
+
+
+def clock(seconds: float) -> str:
+    return f'{int(seconds // 3600):02d}:{int(seconds % 3600 // 60):02d}:{seconds % 60:06.3f}'
+
+
+def make_ttml(paragraphs: int) -> bytes:
+    body = ''.join(
+        f'<p begin="{clock(i * 2)}" end="{clock(i * 2 + 1.5)}">Line {i} with <span>some styled</span> text'
+        f'<br />and a second &gt;&gt; line, it&apos;s {i}</p>\n'
+        for i in range(paragraphs)
+        )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<tt xmlns="http://www.w3.org/ns/ttml"><body><div>\n'
+        f'{body}</div></body></tt>'
+        ).encode()
+
+
+def make_vtt(cues: int) -> bytes:
+    return ('WEBVTT\n\n' + ''.join(
+        f'{clock(i * 2)[3:]} --> {clock(i * 2 + 1.5)[3:]}\n# Cue {i} in italics #\nIt&apos;s cue {i}\n\n'
+        for i in range(cues)
+        )).encode()
+
+
+def measure(name: str, function, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<45} {best * 1000:10.1f} ms')
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Subtitle conversion benchmarks')
+    parser.add_argument('--languages', type=int, default=20, help='Subtitle tracks per format')
+    parser.add_argument('--paragraphs', type=int, default=2000, help='Paragraphs (cues) per track')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    ttml = make_ttml(args.paragraphs)
+    vtt = make_vtt(args.paragraphs)
+    print(f'{args.languages} tracks x {args.paragraphs} paragraphs, '
+          f'TTML2 {len(ttml) / 1048576:.1f} MiB, WebVTT {len(vtt) / 1048576:.1f} MiB per track\n')
+
+    measure('TTML2 -> SRT, legacy (1 track)', lambda: legacy_ttml_to_srt(ttml), args.repeat)
+    measure('TTML2 -> SRT, streaming (1 track)', lambda: ttml_to_srt(io.BytesIO(ttml)), args.repeat)
+    measure('WebVTT fixes, legacy (1 track)', lambda: legacy_fix_vtt(vtt), args.repeat)
+    measure('WebVTT fixes, precompiled (1 track)', lambda: fix_vtt(vtt), args.repeat)
+
+    directory = tempfile.mkdtemp(prefix='singularity-bench-')
+    try:
+        def write_tracks() -> list:
+            paths = []
+            for i in range(args.languages):
+                for extension, contents in (('.ttml2', ttml), ('.vtt', vtt)):
+                    path = os.path.join(directory, f'subtitles{i}_0{extension}')
+                    with open(path, 'wb') as f:
+                        f.write(contents)
+                    paths.append(path)
+            return paths
+
+        def legacy_batch():
+            for path in write_tracks():
+                with open(path, 'rb') as f:
+                    contents = f.read()
+                if path.endswith('.ttml2'):
+                    with open(path.replace('.ttml2', '.srt'), 'wb') as f:
+                        f.write(legacy_ttml_to_srt(contents))
+                else:
+                    with open(path, 'wb') as f:
+                        f.write(legacy_fix_vtt(contents))
+
+        print()
+        measure(f'{len(write_tracks())} tracks, legacy', legacy_batch, args.repeat)
+        measure(f'{len(write_tracks())} tracks, serial', lambda: [convert_subtitle(p) for p in write_tracks()], args.repeat)
+        measure(
+            f'{len(write_tracks())} tracks, {args.processes} processes',
+            lambda: convert_subtitles(write_tracks(), processes=args.processes),
+            args.repeat
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@ from copy import deepcopy
 from datetime import datetime
 from pprint import pprint
 from time import sleep
-from threading import Lock, Thread, current_thread
+from threading import Lock, Thread, current_thread, enumerate as enumerate_threads
 from tqdm import TqdmWarning
 
 import json
@@ -14,7 +14,9 @@ from singularity.browser import browser
 from singularity.config import config, ConfigError, verbose_level, USAGE, lang
 from singularity.downloader import DOWNLOADERS
 from singularity.extractor import EXTRACTORS
+from singularity.metrics import MetricsWriter, get_metrics
 from singularity.paths import DOWNLOAD_LOG, LANGUAGES
+from singularity.responses import get_response_cache
 from singularity.types import *
 from singularity.utils import filename_datetime, get_compatible_extractor, is_download_id, parse_download_id, request_webpage, sanitize_path, sanitized_file_exists, vprint, recurse_merge_dict, normalize_integer
 from singularity.update import windows_install, download_languages
@@ -30,6 +32,9 @@ _STATS = {
 
 downloader_lock = Lock()
 
+DOWNLOADED_ITEMS = get_metrics().counter('singularity_downloaded_items_total', 'Items downloaded', ['extractor'])
+QUEUED_URLS = get_metrics().gauge('singularity_queued_urls', 'URLs waiting to be extracted')
+
 warnings.filterwarnings('ignore', category=TqdmWarning)
 
 class Singularity:
@@ -119,6 +124,18 @@ class Singularity:
                         password = self.options['extractor'][extractor[0].lower()]['password']
                     extractor[1]().login_with_form(username, password)
                 url_pool.append((url, *extractor))
+            # Status and metrics files
+            self.metrics_writer = None
+            if self.options['status_file'] or self.options['metrics_file']:
+                self.metrics_writer = MetricsWriter(
+                    get_metrics(),
+                    status_path=self.options['status_file'],
+                    prometheus_path=self.options['metrics_file'],
+                    interval=float(self.options['status_interval']),
+                    status=self.status
+                    )
+                self.metrics_writer.start()
+            QUEUED_URLS.set(len(self.url_pool))
             for i in range(self.options['download']['simultaneous_urls']):
                 worker = Thread(target=self.worker, daemon=True, name=f'worker{i}')
                 self.workers.append(worker)
@@ -129,6 +146,8 @@ class Singularity:
                     sleep(0.5)
                     continue
                 break
+            if self.metrics_writer is not None:
+                self.metrics_writer.stop()
             vprint(lang['polarity']['all_tasks_finished'])
         
     def worker(self):
@@ -176,72 +195,85 @@ class Singularity:
                 if not download_pool:
                     return
                 item = download_pool.pop(0)
-                content_extended_id = f'{extractor_name.lower()}/{type(item).__name__.lower()}-{item.id}'
-                # Skip if output file already exists or id in download log
-                if self.id_in_archive(content_extended_id) or sanitized_file_exists(item.output): 
-                    if not self.id_in_archive(content_extended_id):
-                        self.add_id_to_archive(content_extended_id)
-                    if not self.options['download']['redownload']:
+                try:
+                    content_extended_id = f'{extractor_name.lower()}/{type(item).__name__.lower()}-{item.id}'
+                    # Skip if output file already exists or id in download log
+                    if self.id_in_archive(content_extended_id) or sanitized_file_exists(item.output): 
+                        if not self.id_in_archive(content_extended_id):
+                            self.add_id_to_archive(content_extended_id)
+                        if not self.options['download']['redownload']:
+                            vprint(
+                                message=lang['dl']['no_redownload'] % (
+                                    lang['types'][type(item).__name__.lower()],
+                                    item.title),
+                                level=1,
+                                error_level='warning'
+                            )
+                            continue
+
+                    if hasattr(item, 'skip_download'):
                         vprint(
-                            message=lang['dl']['no_redownload'] % (
+                            message=lang['dl']['cannot_download_content'] % (
                                 lang['types'][type(item).__name__.lower()],
-                                item.title),
-                            level=1,
+                                item.title,
+                                item.skip_download),
                             error_level='warning'
                         )
                         continue
 
-                if hasattr(item, 'skip_download'):
-                    vprint(
-                        message=lang['dl']['cannot_download_content'] % (
-                            lang['types'][type(item).__name__.lower()],
-                            item.title,
-                            item.skip_download),
-                        error_level='warning'
-                    )
-                    continue
-
-                # Set preferred stream as main stream if set else use stream 0
-                stream = item.get_preferred_stream()
-                if stream is None:
-                    stream = item.streams[0]
+                    # Set preferred stream as main stream if set else use stream 0
+                    stream = item.get_preferred_stream()
+                    if stream is None:
+                        stream = item.streams[0]
 
-                if type(item) == Episode and not item.movie:
-                    name = f"{content_info.title} {item.season_id}"
-                elif type(item) == Movie or type(item) == Episode and item.movie:
-                    name = f"{item.title} ({item.year})"
+                    if type(item) == Episode and not item.movie:
+                        name = f"{content_info.title} {item.season_id}"
+                    elif type(item) == Movie or type(item) == Episode and item.movie:
+                        name = f"{item.title} ({item.year})"
                     
-                vprint(
-                    message=lang['dl']['downloading_content']%(
-                        lang['types'][type(item).__name__.lower()],
-                        item.title
+                    vprint(
+                        message=lang['dl']['downloading_content']%(
+                            lang['types'][type(item).__name__.lower()],
+                            item.title
+                            )
                         )
-                    )
-                _downloader = DOWNLOADERS[self.options['download']['downloader']] if self.options['download']['downloader'] in DOWNLOADERS else DOWNLOADERS['penguin']
-                downloader = _downloader(
-                    stream,
-                    options=self.options['download'],
-                    extra_audio=item.get_extra_audio(),
-                    extra_subs=item.get_extra_subs(),
-                    name=name,
-                    id=item.id,
-                    #media_metadata=item['metadata'],
-                    output=item.output
-                    )
-                downloader.start()
+                    _downloader = DOWNLOADERS[self.options['download']['downloader']] if self.options['download']['downloader'] in DOWNLOADERS else DOWNLOADERS['penguin']
+                    # Episodes of a series share the bandwidth as background downloads
+                    download_options = dict(self.options['download'])
+                    if type(content_info) == Series:
+                        download_options['bandwidth_weight'] = self.options['download']['series_bandwidth_weight']
+                    downloader = _downloader(
+                        stream,
+                        options=download_options,
+                        extra_audio=item.get_extra_audio(),
+                        extra_subs=item.get_extra_subs(),
+                        name=name,
+                        id=item.id,
+                        #media_metadata=item['metadata'],
+                        output=item.output
+                        )
+                    _STATS['tasks'][content_extended_id] = downloader
+                    try:
+                        downloader.start()
+                    finally:
+                        # Only its last status is kept, not the finished downloader
+                        _STATS['tasks'][content_extended_id] = downloader.status()
+                    DOWNLOADED_ITEMS.inc(extractor=extractor_name)
                 
 
-                download_successful = lang['dl']['download_successful'] % (
-                    lang['types'][type(item).__name__.lower()],
-                    name
-                    ) 
+                    download_successful = lang['dl']['download_successful'] % (
+                        lang['types'][type(item).__name__.lower()],
+                        name
+                        ) 
 
-                vprint(download_successful)
+                    vprint(download_successful)
 
-                # if self.options['extractor']['postprocessing'] and hasattr(self.extractor[0], 'postprocessing'):
-                #     extractor[0]().postprocessing(item['output'])
-                if not self.id_in_archive(content_extended_id):
-                    self.add_id_to_archive(content_extended_id)
+                    # if self.options['extractor']['postprocessing'] and hasattr(self.extractor[0], 'postprocessing'):
+                    #     extractor[0]().postprocessing(item['output'])
+                    if not self.id_in_archive(content_extended_id):
+                        self.add_id_to_archive(content_extended_id)
+                finally:
+                    get_response_cache().release(s.url for s in item.streams)
                     
         def make_metafiles_task():
             if content_info['type'] == 'series':
@@ -252,6 +284,7 @@ class Singularity:
             if not self.url_pool:
                 return
             thread_url = self.url_pool.pop(0)
+            QUEUED_URLS.set(len(self.url_pool))
             worker_stats['current_url'] = thread_url
             extractor_tupl = get_compatible_extractor(thread_url)
             # Skip if there's not an extractor available
@@ -270,6 +303,9 @@ class Singularity:
                 continue
             # Create download and metadata pools
             download_pool = self.build_download_list(extractor_name, content_info)
+            # Queued items keep their manifests cached until they are downloaded
+            for item in download_pool:
+                get_response_cache().hold(s.url for s in item.streams)
             metadata_pool = deepcopy(download_pool)
             # Create downloader threads
             for i in range(self.options['download']['simultaneous_downloads_per_url']):
@@ -381,10 +417,18 @@ class Singularity:
     def id_in_archive(id=str):
         return id in open(DOWNLOAD_LOG, 'r').read()
 
+    def status(self) -> dict:
+        'Returns the status written to the status file'
+        return {
+            'version': __version__,
+            'url_queue': list(self.url_pool),
+            'tasks': {i: d if type(d) == dict else d.status() for i, d in list(_STATS['tasks'].items())},
+            'threads': [t.name for t in enumerate_threads()],
+            }
+
     def write_status_file(self):
-        global _STATS
-        with open(self.status_file_path, 'w') as status:
-            json.dump(_STATS, status)
+        if self.metrics_writer is not None:
+            self.metrics_writer.write()
 
     def search(self, extractor=str, search_term=str):
         pass
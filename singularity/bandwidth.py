@@ -0,0 +1,177 @@
+import threading
+
+from time import monotonic
+
+
+class TokenBucket:
+    '''
+    ## Token bucket
+    ### Limits a byte rate, `rate` 0 means unlimited
+        >>> bucket = TokenBucket(rate=1048576)
+        >>> bucket.consume(262144)  # Blocks until the bytes can be sent
+
+    Consumes bigger than the burst are allowed, leaving the bucket in debt,
+    the next consumers wait until it's paid back
+    '''
+    def __init__(self, rate: float, burst=None):
+        self.condition = threading.Condition()
+        self.tokens = 0
+        self.rate = 0
+        self.last = monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: float, burst=None) -> None:
+        with self.condition:
+            self.refill()
+            self.rate = max(0, rate)
+            # A quarter of a second worth of bytes by default
+            self.burst = burst if burst is not None else max(65536, self.rate / 4)
+            self.tokens = min(self.tokens, self.burst)
+            self.condition.notify_all()
+
+    def refill(self) -> None:
+        now = monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self) -> float:
+        'Seconds until the bucket is out of debt, must be called with the condition held'
+        self.refill()
+        if not self.rate or self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def consume(self, amount: int) -> None:
+        with self.condition:
+            while True:
+                wait = self.wait_time()
+                if not wait:
+                    break
+                self.condition.wait(timeout=wait)
+            if self.rate:
+                self.tokens -= amount
+
+
+class BandwidthLimiter:
+    '''
+    ## Bandwidth limiter
+    ### Process-wide bandwidth cap, with optional per-item and per-host caps
+        >>> from singularity.bandwidth import get_bandwidth_limiter
+        >>> limiter = get_bandwidth_limiter()
+        >>> limiter.register('Title 1', weight=2)
+        >>> limiter.consume(read, item='Title 1', host='cdn.example.com')
+        >>> limiter.set_rate(5242880)  # Can be changed while downloading
+        >>> limiter.unregister('Title 1')
+
+    The global cap is shared between the items waiting for it by weight, an
+    item of weight 2 gets twice the bandwidth of an item of weight 1. Bandwidth
+    not used by an item is given to the rest. All rates are in bytes per second,
+    0 meaning unlimited
+    '''
+    def __init__(self, rate=0, item_rate=0, host_rate=0):
+        self.bucket = TokenBucket(rate)
+        self.item_rate = item_rate
+        self.host_rate = host_rate
+        self.item_buckets = {}
+        self.host_buckets = {}
+        self.weights = {}
+        # Bytes given to each item divided by its weight, the waiting
+        # item with the lowest one is served first
+        self.virtual_bytes = {}
+        self.waiting = {}
+        self._lock = threading.Lock()
+
+    def register(self, item: str, weight=1) -> None:
+        with self._lock:
+            self.weights[item] = max(weight, 0.01)
+            self.item_buckets[item] = TokenBucket(self.item_rate)
+            # Start level with the others, not with a huge credit
+            self.virtual_bytes[item] = min(self.virtual_bytes.values(), default=0)
+
+    def unregister(self, item: str) -> None:
+        with self._lock:
+            for d in (self.weights, self.item_buckets, self.virtual_bytes):
+                d.pop(item, None)
+
+    def set_rate(self, rate: float) -> None:
+        self.bucket.set_rate(rate)
+
+    def set_weight(self, item: str, weight: float) -> None:
+        with self._lock:
+            self.weights[item] = max(weight, 0.01)
+
+    def set_item_rate(self, rate: float, item=None) -> None:
+        'Sets the cap of an item, or of every item if not specified'
+        with self._lock:
+            if item is None:
+                self.item_rate = rate
+            buckets = [self.item_buckets[item]] if item is not None else list(self.item_buckets.values())
+        for bucket in buckets:
+            bucket.set_rate(rate)
+
+    def set_host_rate(self, rate: float, host=None) -> None:
+        'Sets the cap of a host, or of every host if not specified'
+        with self._lock:
+            if host is None:
+                self.host_rate = rate
+            buckets = [self.host_buckets[host]] if host is not None else list(self.host_buckets.values())
+        for bucket in buckets:
+            bucket.set_rate(rate)
+
+    def get_host_bucket(self, host: str) -> TokenBucket:
+        with self._lock:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = TokenBucket(self.host_rate)
+            return self.host_buckets[host]
+
+    def consume(self, amount: int, item=None, host=None) -> None:
+        'Blocks until `amount` bytes are allowed by all the caps that apply'
+        item_bucket = self.item_buckets.get(item)
+        if item_bucket is not None:
+            item_bucket.consume(amount)
+        if host is not None:
+            self.get_host_bucket(host).consume(amount)
+        bucket = self.bucket
+        with bucket.condition:
+            if not bucket.rate:
+                return
+            self.waiting[item] = self.waiting.get(item, 0) + 1
+            try:
+                while True:
+                    wait = bucket.wait_time()
+                    if not wait and self.is_next(item):
+                        break
+                    bucket.condition.wait(timeout=wait or None)
+            finally:
+                self.waiting[item] -= 1
+                if not self.waiting[item]:
+                    del self.waiting[item]
+            if bucket.rate:
+                bucket.tokens -= amount
+            if item in self.virtual_bytes:
+                self.virtual_bytes[item] += amount / self.weights[item]
+            bucket.condition.notify_all()
+
+    def is_next(self, item) -> bool:
+        'Returns True if no waiting item is behind its weighted share less than this one'
+        own = self.virtual_bytes.get(item, 0)
+        return all(self.virtual_bytes.get(i, 0) >= own for i in self.waiting if i != item)
+
+
+_bandwidth_limiter = None
+_bandwidth_limiter_lock = threading.Lock()
+
+
+def get_bandwidth_limiter() -> BandwidthLimiter:
+    'Returns the process-wide bandwidth limiter, created from the configuration on the first call'
+    global _bandwidth_limiter
+    with _bandwidth_limiter_lock:
+        if _bandwidth_limiter is None:
+            from singularity.config import config
+            _bandwidth_limiter = BandwidthLimiter(
+                rate=int(config['download']['bandwidth_limit']),
+                item_rate=int(config['download']['item_bandwidth_limit']),
+                host_rate=int(config['download']['host_bandwidth_limit'])
+                )
+        return _bandwidth_limiter
@@ -6,7 +6,9 @@ from toml.decoder import TomlDecodeError
 
 from copy import deepcopy
 
+from singularity.connections import get_connection_budget
 from singularity.paths import *
+from singularity.responses import get_response_cache
 from singularity.utils import filename_datetime, load_language, mkfile, recurse_merge_dict, vprint, language_installed
 import traceback
 
@@ -16,6 +18,11 @@ DEFAULTS = {
     'verbose': 1,
     'language': 'enUS',
     'update_languages': True,
+    # JSON status and Prometheus text-format metrics files, rewritten
+    # every status_interval seconds while downloading. Empty to disable
+    'status_file': '',
+    'metrics_file': '',
+    'status_interval': 5,
     'download': {
         'downloader': 'penguin',
         'simultaneous_urls': 3,
@@ -29,6 +36,22 @@ DEFAULTS = {
         'video_extension': 'mkv',
         'resolution': 4320,
         'redownload': False,
+        # Concurrent connections to a single host, shared by all the
+        # downloads and requests of the process
+        'max_connections_per_host': 24,
+        # Bandwidth caps in bytes per second, 0 means unlimited
+        'bandwidth_limit': 0,
+        'item_bandwidth_limit': 0,
+        'host_bandwidth_limit': 0,
+        # Share of the capped bandwidth of an item, relative to the rest.
+        # Episodes of series and seasons use series_bandwidth_weight
+        'bandwidth_weight': 1,
+        'series_bandwidth_weight': 1,
+        # Manifests and other small responses are fetched once and shared by
+        # extractors, protocols and downloads, for response_cache_ttl seconds.
+        # The manifests of queued items are kept until they are downloaded
+        'response_cache_size': 33554432,
+        'response_cache_ttl': 600,
     },
     'extractor': {},
     'flags': []
@@ -128,4 +151,11 @@ for downloader in DOWNLOADERS.items():
     config['download'][downloader_name] = a
 save_config()
 
+# Process-wide limits, requests made until here used the default ones
+get_connection_budget().configure(int(config['download']['max_connections_per_host']))
+get_response_cache().configure(
+    int(config['download']['response_cache_size']),
+    float(config['download']['response_cache_ttl'])
+    )
+
 options = deepcopy(config)
\ No newline at end of file
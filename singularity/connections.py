@@ -0,0 +1,112 @@
+import threading
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Limit until the configuration is loaded, requests made while it loads
+# (like downloading the base language) can't read it
+DEFAULT_CONNECTIONS_PER_HOST = 24
+
+
+class HostBudget:
+    'Connections in use of a single host, by owner'
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.owners = {}
+        self.waiting = {}
+        self.condition = threading.Condition()
+
+    def fair_share(self) -> int:
+        'Slots each owner (using or waiting for the host) is entitled to'
+        owners = len(set(self.owners) | set(self.waiting))
+        return max(1, self.limit // max(1, owners))
+
+    def can_take(self, owner) -> bool:
+        if self.active >= self.limit:
+            return False
+        if self.owners.get(owner, 0) < self.fair_share():
+            return True
+        # Over its share, only allowed if no one else is waiting
+        return not [o for o in self.waiting if o != owner]
+
+
+class ConnectionBudget:
+    '''
+    ## Connection budget
+    ### Process-wide limit of concurrent connections to each host, shared by
+    ### every download, segment downloader and webpage request
+        >>> from singularity.connections import get_connection_budget
+        >>> with get_connection_budget().slot(url, owner='Title 1'):
+        >>>     session.get(url)
+
+    Slots are shared fairly between owners (usually items being downloaded),
+    an owner may use more than its share while nobody else is waiting
+    '''
+    def __init__(self, per_host: int):
+        self.per_host = max(1, per_host)
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def configure(self, per_host: int) -> None:
+        'Changes the limit of every host, connections over it are not closed but no new ones are given'
+        with self._lock:
+            self.per_host = max(1, per_host)
+            hosts = list(self.hosts.values())
+        for budget in hosts:
+            with budget.condition:
+                budget.limit = self.per_host
+                budget.condition.notify_all()
+
+    def get_host(self, url: str) -> HostBudget:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostBudget(self.per_host)
+            return self.hosts[host]
+
+    def acquire(self, url: str, owner=None) -> None:
+        budget = self.get_host(url)
+        with budget.condition:
+            budget.waiting[owner] = budget.waiting.get(owner, 0) + 1
+            try:
+                budget.condition.wait_for(lambda: budget.can_take(owner))
+            finally:
+                budget.waiting[owner] -= 1
+                if not budget.waiting[owner]:
+                    del budget.waiting[owner]
+            budget.active += 1
+            budget.owners[owner] = budget.owners.get(owner, 0) + 1
+
+    def release(self, url: str, owner=None) -> None:
+        budget = self.get_host(url)
+        with budget.condition:
+            budget.active -= 1
+            budget.owners[owner] -= 1
+            if not budget.owners[owner]:
+                del budget.owners[owner]
+            budget.condition.notify_all()
+
+    @contextmanager
+    def slot(self, url: str, owner=None):
+        self.acquire(url, owner)
+        try:
+            yield
+        finally:
+            self.release(url, owner)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hosts = dict(self.hosts)
+        return {
+            host: {'limit': b.limit, 'active': b.active, 'owners': {str(o): n for o, n in b.owners.items()}}
+            for host, b in hosts.items()
+        }
+
+
+_connection_budget = ConnectionBudget(DEFAULT_CONNECTIONS_PER_HOST)
+
+
+def get_connection_budget() -> ConnectionBudget:
+    'Returns the process-wide connection budget, configured by `singularity.config` once loaded'
+    return _connection_budget
@@ -55,6 +55,14 @@ class BaseDownloader:
         if hasattr(self, 'load_at_init'):
             self.load_at_init()
 
+    def status(self) -> dict:
+        '#### Returns the status of the download, written to the status file'
+        return {
+            'content': self.content,
+            'downloader': self.downloader_name,
+            'output': self.output,
+        }
+
     def write_status_dict(self, status=dict):
         '#### Write to status dict, use this instead of writing directly to `self.status`'
         self.status.clear()
@@ -0,0 +1,75 @@
+from singularity.downloader.penguin.cenc import AES
+
+# Same optional dependency as CENC decryption, without it
+# AES-128 segments are decrypted by ffmpeg while muxing
+AVAILABLE = AES is not None
+BLOCK_SIZE = 16
+
+
+class AESError(Exception):
+    pass
+
+
+class TruncatedError(AESError):
+    'The encrypted data ends before the last block, it wasn\'t received whole'
+
+
+def segment_iv(iv: str, sequence: int) -> bytes:
+    '''
+    Returns the IV of a segment, the `IV` attribute of its `EXT-X-KEY`
+    (an hex string) or, if it doesn't have one, its media sequence number
+        >>> segment_iv(None, 5)
+        b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x05'
+    '''
+    if iv is None:
+        return sequence.to_bytes(BLOCK_SIZE, 'big')
+    iv = iv[2:] if iv[:2].lower() == '0x' else iv
+    return bytes.fromhex(iv.rjust(BLOCK_SIZE * 2, '0'))
+
+
+def sequence_iv(sequence: int) -> str:
+    'Returns the IV of a segment without an explicit one, as the hex string of an `IV` attribute'
+    return f'0x{sequence:032x}'
+
+
+class SegmentDecryptor:
+    '''
+    ## AES-128 segment decryptor
+    ### Streaming decryption of HLS `METHOD=AES-128` segments (CBC, PKCS#7 padding)
+        >>> from singularity.downloader.penguin.aes import SegmentDecryptor, segment_iv
+        >>> decryptor = SegmentDecryptor(key, segment_iv(segment.key.iv, segment.number))
+        >>> output.write(decryptor.update(chunk))  # For every chunk received
+        >>> output.write(decryptor.finalize())
+
+    The last block received is held back until `finalize`, since it may
+    be the padding. `size` is the amount of decrypted bytes returned
+    '''
+    def __init__(self, key: bytes, iv: bytes):
+        if len(key) != BLOCK_SIZE:
+            raise AESError(f'AES-128 keys are {BLOCK_SIZE} bytes long, got {len(key)}')
+        self.cipher = AES.new(key, AES.MODE_CBC, iv)
+        self.pending = bytearray()
+        self.size = 0
+
+    def update(self, data) -> bytes:
+        self.pending += data
+        # Everything but the last block, complete or not
+        usable = max(len(self.pending) - 1, 0) // BLOCK_SIZE * BLOCK_SIZE
+        if not usable:
+            return b''
+        decrypted = self.cipher.decrypt(bytes(self.pending[:usable]))
+        del self.pending[:usable]
+        self.size += usable
+        return decrypted
+
+    def finalize(self) -> bytes:
+        'Decrypts the last block and returns it without the padding'
+        if len(self.pending) != BLOCK_SIZE:
+            raise TruncatedError('Encrypted data is not a multiple of the block size')
+        block = self.cipher.decrypt(bytes(self.pending))
+        padding = block[-1]
+        if not 1 <= padding <= BLOCK_SIZE or block[-padding:] != bytes([padding]) * padding:
+            raise AESError('Invalid padding, wrong key or IV')
+        self.pending.clear()
+        self.size += BLOCK_SIZE - padding
+        return block[:-padding]
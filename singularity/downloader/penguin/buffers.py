@@ -0,0 +1,45 @@
+import threading
+
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+
+
+class BufferPool:
+    '''
+    ## Buffer pool
+    ### Preallocated, recycled buffers used to stream segment bodies to disk
+        >>> from singularity.downloader.penguin.buffers import BufferPool
+        >>> pool = BufferPool(count=10, size=262144)
+        >>> with pool.buffer() as buffer:
+        >>>     read = response.raw.readinto(buffer)
+        >>>     output.write(buffer[:read])
+    '''
+    def __init__(self, count: int, size: int):
+        self.count = max(1, count)
+        self.size = size
+        self._idle = LifoQueue()
+        self._allocated = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> memoryview:
+        'Returns an idle buffer as a memoryview, allocating it if the pool is not full yet'
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if self._allocated < self.count:
+                self._allocated += 1
+                return memoryview(bytearray(self.size))
+        return self._idle.get()
+
+    def release(self, buffer: memoryview) -> None:
+        self._idle.put(buffer)
+
+    @contextmanager
+    def buffer(self):
+        buffer = self.acquire()
+        try:
+            yield buffer
+        finally:
+            self.release(buffer)
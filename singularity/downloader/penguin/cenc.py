@@ -0,0 +1,317 @@
+import struct
+
+# pycryptodomex and pycryptodome share the same API, both are optional,
+# without any of them decryption is left to mp4decrypt
+try:
+    from Cryptodome.Cipher import AES
+except ImportError:
+    try:
+        from Crypto.Cipher import AES
+    except ImportError:
+        AES = None
+
+AVAILABLE = AES is not None
+SUPPORTED_SCHEMES = (b'cenc', b'cbcs')
+# Boxes which only contain other boxes
+CONTAINERS = (b'moov', b'trak', b'mdia', b'minf', b'stbl', b'mvex', b'moof', b'traf', b'sinf', b'schi')
+# Boxes carrying encryption information, replaced by "free" boxes once decrypted
+ENCRYPTION_BOXES = (b'senc', b'saiz', b'saio', b'pssh')
+# Sample groups (sgpd, sbgp) of this type are encryption information too
+ENCRYPTION_GROUPING = b'seig'
+
+
+class CencError(Exception):
+    pass
+
+
+class UnsupportedScheme(CencError):
+    pass
+
+
+class NotEncrypted(CencError):
+    pass
+
+
+def iter_boxes(data, start=0, end=None):
+    'Yields a `(type, start, payload start, end)` tuple for each box between `start` and `end`'
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise CencError(f'Invalid {box_type} box at offset {offset}')
+        yield (box_type, offset, offset + header, offset + size)
+        offset += size
+
+
+def find_boxes(data, path: list, start=0, end=None):
+    'Yields the boxes found following a path of box types, like `[b\'moov\', b\'trak\']`'
+    for box in iter_boxes(data, start, end):
+        if box[0] != path[0]:
+            continue
+        if len(path) == 1:
+            yield box
+        elif box[0] in CONTAINERS:
+            yield from find_boxes(data, path[1:], box[2], box[3])
+
+
+def find_box(data, path: list, start=0, end=None):
+    return next(find_boxes(data, path, start, end), None)
+
+
+def sample_entry_children(data, entry_type: bytes, payload: int) -> int:
+    'Returns the offset where the child boxes of a sample entry start'
+    if entry_type == b'encv':
+        # SampleEntry (8) + VisualSampleEntry (70)
+        return payload + 78
+    # SampleEntry (8) + AudioSampleEntry (20), QuickTime versions are longer
+    version = struct.unpack_from('>H', data, payload + 8)[0]
+    return payload + 28 + {1: 16, 2: 36}.get(version, 0)
+
+
+def rename_box(data, start: int, box_type: bytes) -> None:
+    data[start + 4:start + 8] = box_type
+
+
+class CencDecryptor:
+    '''
+    ## CENC decryptor
+    ### In-place decryption of fragmented MP4 (ISO/IEC 23001-7 `cenc` and `cbcs`)
+        >>> from singularity.downloader.penguin.cenc import CencDecryptor
+        >>> decryptor = CencDecryptor(keys={'<kid>': '<key>'})
+        >>> decryptor.load_init(init_data)
+        >>> decryptor.decrypt_segment(segment_data)  # A bytearray, modified in place
+        >>> CencDecryptor.patch_init(init_data)
+
+    Decrypted data has the same size as the encrypted one and boxes are never
+    moved, encryption boxes are just renamed to "free", so segments can be
+    decrypted right where they were written. Decrypting an already decrypted
+    segment does nothing, since it has no encryption boxes left
+    '''
+    def __init__(self, keys: dict):
+        # Key ids and keys as hex strings
+        self.keys = {k.replace('-', '').lower(): bytes.fromhex(v) for k, v in keys.items()}
+        self.key = None
+        self.kid = None
+        self.scheme = None
+        self.iv_size = 0
+        self.constant_iv = None
+        self.crypt_blocks = 0
+        self.skip_blocks = 0
+        self.default_sample_size = 0
+        # Set if the initialization segment couldn't be loaded
+        self.error = None
+
+    def load_init(self, data) -> None:
+        'Reads the encryption parameters of the track from its initialization segment'
+        trex = find_box(data, [b'moov', b'mvex', b'trex'])
+        if trex is not None:
+            self.default_sample_size = struct.unpack_from('>I', data, trex[2] + 16)[0]
+        for stsd in find_boxes(data, [b'moov', b'trak', b'mdia', b'minf', b'stbl', b'stsd']):
+            # Full box header and entry count
+            for entry_type, _, payload, end in iter_boxes(data, stsd[2] + 8, stsd[3]):
+                if entry_type not in (b'encv', b'enca'):
+                    continue
+                sinf = find_box(data, [b'sinf'], sample_entry_children(data, entry_type, payload), end)
+                if sinf is not None:
+                    self.load_sinf(data, sinf)
+                    return
+        raise NotEncrypted('No encrypted sample entry found in the initialization segment')
+
+    def load_sinf(self, data, sinf: tuple) -> None:
+        schm = find_box(data, [b'schm'], sinf[2], sinf[3])
+        tenc = find_box(data, [b'schi', b'tenc'], sinf[2], sinf[3])
+        if schm is None or tenc is None:
+            raise CencError('Missing scheme information')
+        self.scheme = bytes(data[schm[2] + 4:schm[2] + 8])
+        if self.scheme not in SUPPORTED_SCHEMES:
+            raise UnsupportedScheme(f'Unsupported protection scheme "{self.scheme.decode(errors="replace")}"')
+        version = data[tenc[2]]
+        payload = tenc[2] + 4
+        if version > 0:
+            self.crypt_blocks = data[payload + 1] >> 4
+            self.skip_blocks = data[payload + 1] & 0xF
+        self.iv_size = data[payload + 3]
+        self.kid = bytes(data[payload + 4:payload + 20]).hex()
+        if data[payload + 2] and not self.iv_size:
+            constant_iv_size = data[payload + 20]
+            self.constant_iv = bytes(data[payload + 21:payload + 21 + constant_iv_size])
+        self.key = self.keys.get(self.kid)
+        if self.key is None:
+            if len(self.keys) != 1:
+                raise CencError(f'No key for key id {self.kid}')
+            # A single key given, assume it's the right one
+            self.key = list(self.keys.values())[0]
+
+    def decrypt_segment(self, data: bytearray) -> None:
+        'Decrypts every fragment (moof + mdat) of a media segment in place'
+        view = memoryview(data)
+        moof = None
+        for box in iter_boxes(data):
+            if box[0] == b'moof':
+                moof = box
+            elif box[0] == b'mdat' and moof is not None:
+                self.decrypt_fragment(data, view, moof, box)
+                moof = None
+
+    def decrypt_fragment(self, data: bytearray, view: memoryview, moof: tuple, mdat: tuple) -> None:
+        for traf in find_boxes(data, [b'traf'], moof[2], moof[3]):
+            samples = self.get_samples(data, moof, mdat, traf)
+            aux_info = self.get_aux_info(data, moof, traf)
+            if aux_info is None:
+                # Not encrypted or already decrypted
+                continue
+            if len(aux_info) != len(samples):
+                raise CencError(f'{len(samples)} samples but {len(aux_info)} encryption entries')
+            for (position, size), (iv, subsamples) in zip(samples, aux_info):
+                self.decrypt_sample(view, position, size, iv, subsamples)
+            for box in iter_boxes(data, traf[2], traf[3]):
+                if box[0] in ENCRYPTION_BOXES or \
+                   box[0] in (b'sgpd', b'sbgp') and data[box[2] + 4:box[2] + 8] == ENCRYPTION_GROUPING:
+                    rename_box(data, box[1], b'free')
+        for box in iter_boxes(data, moof[2], moof[3]):
+            if box[0] == b'pssh':
+                rename_box(data, box[1], b'free')
+
+    def get_samples(self, data, moof: tuple, mdat: tuple, traf: tuple) -> list:
+        'Returns the position and size of each sample of a track fragment'
+        tfhd = find_box(data, [b'tfhd'], traf[2], traf[3])
+        flags = int.from_bytes(data[tfhd[2] + 1:tfhd[2] + 4], 'big')
+        if flags & 0x1:
+            raise CencError('Explicit base data offsets are not supported')
+        offset = tfhd[2] + 8
+        # Sample description index, default sample duration
+        offset += 4 * bool(flags & 0x2) + 4 * bool(flags & 0x8)
+        default_size = struct.unpack_from('>I', data, offset)[0] if flags & 0x10 else self.default_sample_size
+        samples = []
+        position = mdat[2]
+        for trun in find_boxes(data, [b'trun'], traf[2], traf[3]):
+            flags = int.from_bytes(data[trun[2] + 1:trun[2] + 4], 'big')
+            count = struct.unpack_from('>I', data, trun[2] + 4)[0]
+            offset = trun[2] + 8
+            if flags & 0x1:
+                # Relative to the moof box
+                position = moof[1] + struct.unpack_from('>i', data, offset)[0]
+                offset += 4
+            offset += 4 * bool(flags & 0x4)
+            fields = [f for f in (0x100, 0x200, 0x400, 0x800) if flags & f]
+            for _ in range(count):
+                size = default_size
+                for field in fields:
+                    if field == 0x200:
+                        size = struct.unpack_from('>I', data, offset)[0]
+                    offset += 4
+                samples.append((position, size))
+                position += size
+        return samples
+
+    def get_aux_info(self, data, moof: tuple, traf: tuple):
+        'Returns the IV and subsamples of each sample, from the senc box or saiz/saio'
+        senc = find_box(data, [b'senc'], traf[2], traf[3])
+        if senc is not None:
+            flags = int.from_bytes(data[senc[2] + 1:senc[2] + 4], 'big')
+            offset = senc[2] + 4
+            iv_size = self.iv_size
+            if flags & 0x1:
+                # Overridden track encryption parameters
+                iv_size = data[offset + 3]
+                offset += 20
+            count = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+            entries = []
+            for _ in range(count):
+                entry, offset = self.read_aux_entry(data, offset, iv_size, flags & 0x2)
+                entries.append(entry)
+            return entries
+        saiz = find_box(data, [b'saiz'], traf[2], traf[3])
+        saio = find_box(data, [b'saio'], traf[2], traf[3])
+        if saiz is None or saio is None:
+            return None
+        offset = saiz[2] + 4 + 8 * bool(data[saiz[2] + 3] & 0x1)
+        default_info_size = data[offset]
+        count = struct.unpack_from('>I', data, offset + 1)[0]
+        sizes = [default_info_size] * count if default_info_size else list(data[offset + 5:offset + 5 + count])
+        offset = saio[2] + 4 + 8 * bool(data[saio[2] + 3] & 0x1) + 4
+        # Relative to the moof box
+        offset = moof[1] + struct.unpack_from('>Q' if data[saio[2]] else '>I', data, offset)[0]
+        entries = []
+        for size in sizes:
+            entry, _ = self.read_aux_entry(data, offset, self.iv_size, size > self.iv_size)
+            entries.append(entry)
+            offset += size
+        return entries
+
+    def read_aux_entry(self, data, offset: int, iv_size: int, has_subsamples: bool) -> tuple:
+        iv = bytes(data[offset:offset + iv_size]) if iv_size else self.constant_iv
+        offset += iv_size
+        subsamples = []
+        if has_subsamples:
+            count = struct.unpack_from('>H', data, offset)[0]
+            offset += 2
+            for _ in range(count):
+                subsamples.append(struct.unpack_from('>HI', data, offset))
+                offset += 6
+        return ((iv, subsamples), offset)
+
+    def decrypt_sample(self, view: memoryview, position: int, size: int, iv: bytes, subsamples: list) -> None:
+        # Without subsamples the whole sample is encrypted
+        regions = subsamples or [(0, size)]
+        if self.scheme == b'cenc':
+            # A single keystream for all the encrypted regions of the sample
+            cipher = AES.new(self.key, AES.MODE_CTR, nonce=b'', initial_value=iv.ljust(16, b'\0'))
+            for clear, encrypted in regions:
+                position += clear
+                region = view[position:position + encrypted]
+                cipher.decrypt(region, output=region)
+                position += encrypted
+            return
+        for clear, encrypted in regions:
+            position += clear
+            self.decrypt_cbcs_region(view, position, encrypted, iv)
+            position += encrypted
+
+    def decrypt_cbcs_region(self, view: memoryview, position: int, size: int, iv: bytes) -> None:
+        'Decrypts a region using the crypt/skip block pattern, the IV is reset for each region'
+        cipher = AES.new(self.key, AES.MODE_CBC, iv=iv)
+        end = position + size
+        if not self.skip_blocks:
+            # Every complete block is encrypted
+            region = view[position:position + size // 16 * 16]
+            cipher.decrypt(region, output=region)
+            return
+        while end - position >= 16:
+            length = min(self.crypt_blocks * 16, (end - position) // 16 * 16)
+            region = view[position:position + length]
+            cipher.decrypt(region, output=region)
+            position += length + self.skip_blocks * 16
+
+    @staticmethod
+    def patch_init(data: bytearray) -> bool:
+        '''
+        Turns the encrypted sample entries of an initialization segment back into
+        the original ones, in place. Returns False if there was nothing to patch
+        '''
+        patched = False
+        for stsd in find_boxes(data, [b'moov', b'trak', b'mdia', b'minf', b'stbl', b'stsd']):
+            for entry_type, start, payload, end in iter_boxes(data, stsd[2] + 8, stsd[3]):
+                if entry_type not in (b'encv', b'enca'):
+                    continue
+                sinf = find_box(data, [b'sinf'], sample_entry_children(data, entry_type, payload), end)
+                frma = find_box(data, [b'frma'], sinf[2], sinf[3]) if sinf is not None else None
+                if frma is None:
+                    raise CencError('Missing original format box')
+                rename_box(data, start, bytes(data[frma[2]:frma[2] + 4]))
+                rename_box(data, sinf[1], b'free')
+                patched = True
+        for box in iter_boxes(data):
+            if box[0] == b'moov':
+                for child in iter_boxes(data, box[2], box[3]):
+                    if child[0] == b'pssh':
+                        rename_box(data, child[1], b'free')
+        return patched
@@ -0,0 +1,77 @@
+import errno
+import os
+
+from shutil import copyfileobj
+
+# Errors meaning the kernel can't do the copy between those files,
+# in that case the next method is tried
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+def _copy_file_range(input_fd: int, output_fd: int, size: int) -> None:
+    while size > 0:
+        # Copies from the input's position to the output's position
+        copied = os.copy_file_range(input_fd, output_fd, size)
+        if not copied:
+            break
+        size -= copied
+
+
+def _sendfile(input_fd: int, output_fd: int, size: int) -> None:
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(output_fd, input_fd, offset, size - offset)
+        if not sent:
+            break
+        offset += sent
+
+
+def append_file(output, input_path: str) -> int:
+    '''
+    Appends the contents of a file to an open binary file object, letting the kernel
+    copy the data (`copy_file_range`, `sendfile`) when supported. Returns the amount
+    of bytes copied
+    '''
+    with open(input_path, 'rb') as input_data:
+        size = os.fstat(input_data.fileno()).st_size
+        output.flush()
+        start = output.seek(0, os.SEEK_END)
+        for method, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile)):
+            if not hasattr(os, method):
+                continue
+            try:
+                copy(input_data.fileno(), output.fileno(), size)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                # Undo any partial copy before trying the next method
+                output.truncate(start)
+                output.seek(start)
+                continue
+            # Kernel copies don't move the file object's position
+            output.seek(0, os.SEEK_END)
+            return size
+        copyfileobj(input_data, output, 1048576)
+        return size
+
+
+def concat_files(output_path: str, input_paths: list, remove=True, progress=None) -> int:
+    '''
+    Appends `input_paths` to `output_path`, opening the destination once.
+    Missing inputs are skipped, that way an interrupted concat can be resumed
+    if inputs are removed after being copied. Returns the amount of bytes copied
+    '''
+    copied = 0
+    if not os.path.exists(output_path):
+        open(output_path, 'wb').close()
+    # Not opened in append mode, kernel copies don't support it
+    with open(output_path, 'r+b') as output:
+        for input_path in input_paths:
+            if os.path.exists(input_path):
+                copied += append_file(output, input_path)
+                if remove:
+                    os.remove(input_path)
+            if progress is not None:
+                progress.update(1)
+    return copied
+
@@ -0,0 +1,229 @@
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import monotonic, time
+from urllib.parse import urlparse
+
+from requests.exceptions import HTTPError
+
+from singularity.metrics import get_metrics
+from singularity.utils import vprint
+
+# Statuses CDNs use to tell they are being hammered, these shrink the
+# host's limit right away instead of being retried with the same concurrency
+THROTTLE_STATUSES = (403, 429, 503)
+
+THROTTLED_REQUESTS = get_metrics().counter(
+    'penguin_throttled_requests_total',
+    'Requests answered with a throttling status',
+    ['host', 'status']
+    )
+
+
+class ControllerClosed(Exception):
+    'Raised to the requests waiting for a slot of a closed controller'
+
+
+@dataclass
+class Transfer:
+    'Outcome of a request made inside a concurrency slot, `size` is set by the caller'
+    size: int = 0
+
+
+class HostLimiter:
+    '''
+    ## Host limiter
+    ### AIMD limit of the concurrent requests made to a single host
+
+    Every `limit` completed requests (a window) the limit is adjusted:
+    - Throttling responses halve it and pause the host, right away
+    - An error rate over 10% halves it
+    - Latency doubling with no throughput gain, or throughput dropping
+      after the last increase, shrinks it by one
+    - Otherwise it grows by one
+    '''
+    def __init__(self, host: str, limit: int, minimum: int, maximum: int, decisions: deque):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(limit, minimum), maximum)
+        self.active = 0
+        self.decisions = decisions
+        self.paused_until = 0
+        self.throughput = 0
+        self.latency = 0
+        self.best_latency = None
+        self.last_change = 0
+        self.closed = False
+        self._condition = threading.Condition()
+        self.reset_window()
+
+    def reset_window(self) -> None:
+        self.window_start = monotonic()
+        self.window_requests = 0
+        self.window_errors = 0
+        self.window_bytes = 0
+        self.window_latency = 0
+
+    def acquire(self) -> None:
+        with self._condition:
+            while True:
+                if self.closed:
+                    raise ControllerClosed(f'No more requests are made to {self.host}')
+                wait = self.paused_until - monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    break
+                self._condition.wait(timeout=wait if wait > 0 else None)
+            self.active += 1
+
+    def release(self, elapsed: float, size: int, error=None) -> None:
+        with self._condition:
+            self.active -= 1
+            self.window_requests += 1
+            self.window_bytes += size
+            self.window_latency += elapsed
+            if error is not None:
+                self.window_errors += 1
+                if is_throttle(error):
+                    THROTTLED_REQUESTS.inc(host=self.host, status=error.response.status_code)
+                    self.pause(retry_after(error))
+                    self.set_limit(self.limit // 2, f'throttled ({error.response.status_code})')
+                    self.reset_window()
+            if self.window_requests >= self.limit:
+                self.adjust()
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        'Wakes the requests waiting for a slot, making them and the next ones fail'
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+    def adjust(self) -> None:
+        'Decides the new limit from the stats of the finished window'
+        throughput = self.window_bytes / max(monotonic() - self.window_start, 1e-6)
+        latency = self.window_latency / self.window_requests
+        if self.window_errors / self.window_requests > 0.1:
+            self.set_limit(self.limit // 2, f'{self.window_errors} errors in {self.window_requests} requests')
+        elif self.best_latency is not None and latency > self.best_latency * 2 and throughput <= self.throughput:
+            self.set_limit(self.limit - 1, f'latency {latency:.2f}s, best {self.best_latency:.2f}s')
+        elif self.last_change > 0 and throughput < self.throughput * 0.95:
+            self.set_limit(self.limit - 1, 'throughput dropped after increase')
+        else:
+            self.set_limit(self.limit + 1, 'throughput growing')
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        self.throughput = throughput
+        self.latency = latency
+        self.reset_window()
+
+    def set_limit(self, limit: int, reason: str) -> None:
+        limit = min(max(limit, self.minimum), self.maximum)
+        self.last_change = limit - self.limit
+        if not self.last_change:
+            return
+        self.decisions.append({
+            'time': time(),
+            'host': self.host,
+            'from': self.limit,
+            'to': limit,
+            'reason': reason,
+        })
+        vprint(f'{self.host}: concurrency {self.limit} -> {limit}, {reason}', 4, 'penguin/concurrency', 'debug')
+        self.limit = limit
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'throughput': self.throughput,
+            'latency': self.latency,
+        }
+
+
+class ConcurrencyController:
+    '''
+    ## Concurrency controller
+    ### Adapts the amount of active segment fetchers of each host to its behaviour
+        >>> from singularity.downloader.penguin.concurrency import ConcurrencyController
+        >>> controller = ConcurrencyController(initial=10, minimum=2, maximum=32)
+        >>> with controller.slot(segment.url) as transfer:
+        >>>     transfer.size = download(segment)
+        >>> controller.stats()
+        {'hosts': {'cdn.example.com': {'limit': 11, ...}}, 'decisions': [...]}
+
+    Workers are created as the limits grow, up to `maximum`, and never destroyed,
+    the ones over the host's limit wait for a slot
+    '''
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.initial = initial
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.hosts = {}
+        # Last decisions made, for stats and debugging
+        self.decisions = deque(maxlen=50)
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def get_limiter(self, url: str) -> HostLimiter:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(host, self.initial, self.minimum, self.maximum, self.decisions)
+                self.hosts[host].closed = self.closed
+            return self.hosts[host]
+
+    @contextmanager
+    def slot(self, url: str):
+        'Waits for a free slot of the url\'s host, measuring the request made inside'
+        limiter = self.get_limiter(url)
+        limiter.acquire()
+        transfer = Transfer()
+        start = monotonic()
+        try:
+            yield transfer
+        except Exception as e:
+            limiter.release(monotonic() - start, transfer.size, error=e)
+            raise
+        limiter.release(monotonic() - start, transfer.size)
+
+    def workers(self) -> int:
+        'Returns the amount of workers needed to use the current limit of every host'
+        with self._lock:
+            hosts = list(self.hosts.values())
+        return min(self.maximum, max(self.initial, sum(h.limit for h in hosts)))
+
+    def close(self) -> None:
+        'Stops giving slots, once a download is given up'
+        with self._lock:
+            self.closed = True
+            hosts = list(self.hosts.values())
+        for limiter in hosts:
+            limiter.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hosts = list(self.hosts.values())
+        return {
+            'hosts': {h.host: h.stats() for h in hosts},
+            'decisions': list(self.decisions),
+        }
+
+
+def is_throttle(error: Exception) -> bool:
+    return isinstance(error, HTTPError) and error.response is not None and \
+        error.response.status_code in THROTTLE_STATUSES
+
+
+def retry_after(error: HTTPError, default=1.0) -> float:
+    'Returns the seconds to wait from the Retry-After header of a throttling response'
+    value = error.response.headers.get('retry-after')
+    try:
+        return min(float(value), 60)
+    except (TypeError, ValueError):
+        return default
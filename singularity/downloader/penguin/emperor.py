@@ -1,35 +1,87 @@
-import cloudscraper
 import os
-import pickle
-import re
 import subprocess
 import threading
-import xmltodict
 
-from copy import deepcopy
-from requests.adapters import HTTPAdapter
-from shutil import move, copyfileobj
-from time import sleep
-from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from requests import RequestException
+from shutil import move
+from time import sleep, time
+from urllib.parse import unquote, urlparse
+from urllib3.exceptions import HTTPError
 from urllib3.util.retry import Retry
 
 from singularity.config import lang
+from singularity.bandwidth import get_bandwidth_limiter
+from singularity.connections import get_connection_budget
 from singularity.downloader.base import BaseDownloader
+from singularity.downloader.penguin import aes, cenc
+from singularity.downloader.penguin.buffers import BufferPool
+from singularity.downloader.penguin.concurrency import ConcurrencyController
+from singularity.downloader.penguin.engine import get_async_engine
+from singularity.downloader.penguin.journal import Journal
+from singularity.downloader.penguin.keys import get_key_cache
 from singularity.downloader.penguin.protocols import *
+from singularity.downloader.penguin.ranges import RangeRequest, ResponseError, is_encoded, parse_range, plan_range_requests, response_length
+from singularity.downloader.penguin.sessions import SessionPool
+from singularity.downloader.penguin.stores import FileStore, MemoryBudget, create_store
+from singularity.downloader.penguin.subtitles import SUBTITLE_EXTENSIONS, convert_subtitles
+from singularity.downloader.penguin.table import SavedPools, SegmentSizes, SegmentTable, save_pools
+from singularity.downloader.penguin.tracks import TrackFile
+from singularity.downloader.penguin.workqueue import SegmentQueue
+from singularity.downloader.penguin.writer import SegmentWriter, WriteRequest, WriterError
+from singularity.metrics import Counter, get_metrics
 from singularity.paths import TEMP
+from singularity.responses import get_response_cache
 from singularity.types import Stream
 from singularity.types.ffmpeg import *
 from singularity.types.stream import *
-from singularity.utils import get_extension, vprint, threaded_vprint
+from singularity.utils import get_extension, humanbytes, vprint, threaded_vprint
 from singularity.version import __version__
 
+metrics = get_metrics()
+SEGMENT_FETCH_TIME = metrics.histogram(
+    'penguin_segment_fetch_seconds',
+    'Time taken to download a segment or range request',
+    ['host']
+    )
+DOWNLOADED_BYTES = metrics.counter('penguin_downloaded_bytes_total', 'Segment bytes downloaded', ['host'])
+DOWNLOADED_SEGMENTS = metrics.counter('penguin_downloaded_segments_total', 'Segments downloaded', ['host'])
+SEGMENT_RETRIES = metrics.counter(
+    'penguin_segment_retries_total',
+    'Failed segment requests, the ones failed by network errors are retried',
+    ['host']
+    )
+POST_PROCESSING_TIME = metrics.histogram(
+    'penguin_post_processing_seconds',
+    'Time taken by each post-processing step (concat, join, decrypt, mp4decrypt, subtitles, mux)',
+    ['step']
+    )
+RESUMED_BYTES = metrics.counter(
+    'penguin_resumed_bytes_total',
+    'Bytes of partially downloaded segments not requested again on retries',
+    ['host']
+    )
+WRITE_BEHIND_BYTES = metrics.gauge('penguin_write_behind_bytes', 'Downloaded bytes waiting to be written', ['item'])
+QUEUED_SEGMENTS = metrics.gauge('penguin_queued_segments', 'Segments waiting to be downloaded', ['item'])
+CONCURRENCY_LIMIT = metrics.gauge('penguin_concurrency_limit', 'Concurrent requests allowed', ['item', 'host'])
+
+# Segment downloads failed by these are retried, any other error stops the download
+NETWORK_ERRORS = (RequestException, HTTPError, ResponseError, ConnectionError, TimeoutError)
+
+
+class DecryptionError(Exception):
+    'A segment can\'t be decrypted while downloading, its key is wrong or can\'t be downloaded'
+
 
 class PenguinDownloader(BaseDownloader):
     
     __penguin_version__ = '2021.09.15'
     
-    # Set retry config
-    retry_config = Retry(total=10, backoff_factor=1, status_forcelist=[502, 503, 504, 403, 404])
+    # Set retry config, throttling statuses (403, 429, 503) are not retried
+    # here, the concurrency controller slows down the host instead. Kept short,
+    # failed segments are retried by the segment downloaders, continuing
+    # from the last byte received
+    retry_config = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 504, 404])
 
     browser = {
         'browser': 'firefox',
@@ -46,11 +98,64 @@ class PenguinDownloader(BaseDownloader):
                 'help': lang['penguin']['args']['segment_downloaders']
             },
             'variable': 'segment_downloaders'
+        },
+        {
+            'args': ['--penguin-engine'],
+            'attrib': {
+                'choices': ['threaded', 'async'],
+                'help': 'Segment download engine, "async" schedules the requests of all downloads from a single event loop and a shared thread pool'
+            },
+            'variable': 'engine'
         }
     ]
     
     DEFAULTS = {
+        # Initial amount of concurrent segment requests per host
         'segment_downloaders': 10,
+        # Grow or shrink the concurrent requests of each host depending on
+        # its throughput, latency and errors, within these bounds
+        'adaptive_concurrency': True,
+        'min_segment_downloaders': 2,
+        'max_segment_downloaders': 32,
+        # "threaded" or "async"
+        'engine': 'threaded',
+        # Maximum concurrent segment requests of the async engine,
+        # shared by all the items being downloaded
+        'async_max_in_flight': 30,
+        # Size in bytes of the buffers used to stream segments to disk
+        'stream_buffer_size': 262144,
+        # Merge contiguous byte-range segments (DASH mediaRange, HLS
+        # EXT-X-BYTERANGE) into requests of up to range_chunk_size bytes
+        'coalesce_ranges': True,
+        'range_chunk_size': 16777216,
+        # Where segments are kept until post-processing:
+        # "files": a file per segment, concatenated afterwards
+        # "sparse": a file per pool, for byte-range segments on filesystems
+        # with sparse files, other pools are stored as files
+        # "memory": in memory, up to memory_store_limit bytes per item, written
+        # once the pool is complete. Segments in memory are lost if interrupted
+        'segment_store': 'files',
+        'memory_store_limit': 268435456,
+        # Write byte-range (DASH) segments straight into the track
+        # file at their final offset, skipping the binary concat
+        'direct_assembly': True,
+        # Pools post-processed (concatenated, decrypted) at the same time
+        'concat_workers': 4,
+        # Processes converting the subtitles of an item when they are large
+        # (16 MB in total), smaller ones are converted in a post-processing
+        # thread, always with 0
+        'subtitle_processes': 4,
+        # Hand downloaded segments to a single writer thread, which writes
+        # them in order, coalescing contiguous writes. Segment downloaders
+        # wait while more than write_behind_memory bytes are waiting
+        'write_behind': False,
+        'write_behind_memory': 67108864,
+        # "internal" decrypts Widevine (CENC) segments as they are downloaded,
+        # needs pycryptodome(x). "mp4decrypt" decrypts the tracks afterwards
+        'decryption': 'internal',
+        # "internal" decrypts AES-128 HLS segments as they are downloaded,
+        # needs pycryptodome(x). "ffmpeg" leaves them to ffmpeg while muxing
+        'hls_decryption': 'internal',
         'ffmpeg': {
             'codec': '-c copy'
         },
@@ -69,6 +174,25 @@ class PenguinDownloader(BaseDownloader):
         
         self.segment_pools = []
         
+        # Pools file the segment pools are mapped from, when resuming
+        self.saved_pools = None
+        
+        # Work given to the segment downloaders by pool, when it's
+        # not the pool's segments (range requests)
+        self.work = {}
+        
+        # Expands lazily generated pools while they download
+        self.expander = None
+        
+        # Segment store of every pool
+        self.stores = {}
+        
+        # Write-behind segment writer, if enabled
+        self.writer = None
+        
+        # Error that stopped the download, raised by start
+        self.error = None
+        
         # Pool format: unified0
         
         self.stats = {
@@ -84,6 +208,7 @@ class PenguinDownloader(BaseDownloader):
                 'unified': 0,
             },
             'do_binary_concat': False,
+            'error': None,
             'finished': {
                 'download': False,
                 'post-processing': {
@@ -93,6 +218,10 @@ class PenguinDownloader(BaseDownloader):
             }
         }
         
+        # Updated by every segment downloader, read by the progress loop
+        self.downloaded_bytes = Counter('downloaded_bytes')
+        self.downloaded_segments = Counter('downloaded_segments')
+        
         self.indexes = {
             'video': 0,
             'audio': 0,
@@ -102,36 +231,105 @@ class PenguinDownloader(BaseDownloader):
     
     def start(self):
         self.options['penguin']['segment_downloaders'] = int(self.options['penguin']['segment_downloaders'])
+        self.options['penguin']['async_max_in_flight'] = int(self.options['penguin']['async_max_in_flight'])
+        self.async_engine = self.options['penguin']['engine'] == 'async'
+        if self.options['penguin']['adaptive_concurrency']:
+            self.concurrency = ConcurrencyController(
+                initial=self.options['penguin']['segment_downloaders'],
+                minimum=int(self.options['penguin']['min_segment_downloaders']),
+                maximum=int(self.options['penguin']['max_segment_downloaders'])
+                )
+        else:
+            self.concurrency = ConcurrencyController(
+                initial=self.options['penguin']['segment_downloaders'],
+                minimum=self.options['penguin']['segment_downloaders'],
+                maximum=self.options['penguin']['segment_downloaders']
+                )
+        # Sessions are shared between segment downloaders, playlist
+        # parsers and key downloads, keeping connections alive
+        self.session_pool = SessionPool(
+            size=self.concurrency.maximum if not self.async_engine else self.options['penguin']['async_max_in_flight'],
+            browser=self.browser,
+            retries=self.retry_config
+            )
+        # Bandwidth caps are process-wide, this item gets a share by its weight
+        self.bandwidth = get_bandwidth_limiter()
+        self.bandwidth.register(self.content_name, weight=float(self.options['bandwidth_weight']))
+        self.buffer_pool = BufferPool(
+            count=self.session_pool.size,
+            size=int(self.options['penguin']['stream_buffer_size'])
+            )
         vprint('Item: ' + self.content, 4, threading.current_thread().name)
         if os.path.exists(f'{self.temp_path}.pools'):
             vprint(lang['penguin']['resuming'] % self.content_name)
-            with open(f'{self.temp_path}.pools', 'rb') as f:
-                self.segment_pools = pickle.load(f)
-                self.copy_of_segment_pools = deepcopy(self.segment_pools)
+            self.saved_pools = SavedPools(f'{self.temp_path}.pools')
+            self.segment_pools = self.saved_pools.pools
+            self.stats.update(self.saved_pools.stats)
         else:
+            if os.path.exists(f'{self.temp_path}.journal'):
+                # Interrupted before the pools were saved, its segments
+                # can't be matched with the pools, start over
+                os.remove(f'{self.temp_path}.journal')
             self.process_stream(stream=self.stream)
             for stream in self.extra_audio:
                 self.process_stream(stream=stream)
             for stream in self.extra_subs:
                 self.process_stream(stream=stream)
-            self.copy_of_segment_pools = deepcopy(self.segment_pools)
-            # Save pools to file
-            with open(f'{self.temp_path}.pools', 'wb') as f:  
-                pickle.dump(self.segment_pools, file=f)
-        if os.path.exists(f'{self.temp_path}.stats'):
-            with open(f'{self.temp_path}.stats', 'rb') as f:
-                self.stats = pickle.load(f)
-        # Create segment downloaders
-        vprint(
-            lang['penguin']['threads_started'] % (self.options['penguin']['segment_downloaders']),
-            level=3,
-            module_name='penguin'
+            if [p for p in self.segment_pools if p.segments.expanding]:
+                # Saved once expanded, downloads start meanwhile
+                self.expander = threading.Thread(
+                    target=self.expand_pools,
+                    name=f'{threading.current_thread().name}/expander',
+                    daemon=True
+                    )
+                self.expander.start()
+            else:
+                self.save_segment_pools()
+        self.journal = Journal(
+            path=f'{self.temp_path}.journal',
+            pool_ids=[p.id for p in self.segment_pools],
+            completed={p.id: SegmentSizes(p.segments) for p in self.segment_pools},
+            flush_data=self.sync_stores
             )
-        for i in range(self.options['penguin']['segment_downloaders']):
-            sdl_name = f'{threading.current_thread().name}/sdl{i}'
-            sdl = threading.Thread(target=self.segment_downloader, name=sdl_name, daemon=True)
-            self.segment_downloaders.append(sdl)
-            sdl.start()
+        self.downloaded_bytes.inc(self.journal.bytes_completed)
+        self.downloaded_segments.inc(self.journal.records)
+        self.update_stats()
+        self.create_decryptors()
+        self.create_stores()
+        self.load_decryptors()
+        if self.options['penguin']['write_behind']:
+            self.writer = SegmentWriter(
+                memory_limit=int(self.options['penguin']['write_behind_memory']),
+                name=f'{threading.current_thread().name}/writer'
+                )
+        if self.options['penguin']['coalesce_ranges']:
+            self.plan_range_requests()
+        # Pools are post-processed as soon as they finish downloading,
+        # while the rest keep downloading
+        self.post_processor = ThreadPoolExecutor(
+            max_workers=int(self.options['penguin']['concat_workers']),
+            thread_name_prefix=f'{threading.current_thread().name}/post'
+            )
+        self.post_processing = []
+        # Subtitles are converted in a single batch, once all are downloaded
+        self.pending_subtitle_pools = {p.id for p in self.segment_pools if p.format == 'subtitles'}
+        self.subtitle_lock = threading.Lock()
+        self.segment_queue = SegmentQueue(on_pool_finished=self.pool_finished)
+        for pool in self.segment_pools:
+            self.segment_queue.add_pool(pool, self.work.get(pool.id, pool.segments))
+        if self.async_engine:
+            # Hand the segment pools to the process-wide event loop
+            vprint('Using async engine', 3, 'penguin', 'debug')
+            self.async_download = get_async_engine(self.options['penguin']['async_max_in_flight']).submit(self)
+        else:
+            # Create segment downloaders, as many as the concurrency
+            # controller allows now, more are added as its limits grow
+            self.add_segment_downloaders()
+            vprint(
+                lang['penguin']['threads_started'] % (len(self.segment_downloaders)),
+                level=3,
+                module_name='penguin'
+                )
         progress_bar = {
             'desc': self.content_name,
             'total': 0,
@@ -144,13 +342,11 @@ class PenguinDownloader(BaseDownloader):
         self.progress_bar_updated = self.stats['bytes_downloaded']
         # Wait until threads stop
         while True:
-            try:
-                self.stats['estimated_total_bytes'] = self.stats['bytes_downloaded'] / self.stats['segments_downloaded'] * self.stats['total_segments']
-            except ZeroDivisionError:
-                pass
-            # Dump statistics to file
-            with open(f'{self.temp_path}.stats', 'wb') as f:  
-                pickle.dump(self.stats, file=f)
+            self.update_stats()
+            if not self.async_engine:
+                self.add_segment_downloaders()
+            # Flush the journal to disk, batched
+            self.journal.sync()
                 
             # Update progress bar
             self.progress_bar.total = self.stats['estimated_total_bytes']
@@ -158,111 +354,533 @@ class PenguinDownloader(BaseDownloader):
             self.progress_bar_updated = self.stats['bytes_downloaded']
             
             # Check if seg. downloaders have finished
-            if [sdl for sdl in self.segment_downloaders if sdl.is_alive()]:
+            if self.is_downloading():
                 sleep(0.5)
                 continue
             self.progress_bar.close()
             break
-        # Binary concating
-        if self.stats['do_binary_concat']:
-            binconcat_threads = []
-            for pool in self.copy_of_segment_pools:
-                if pool.format == 'subtitles':
-                    continue
-                vprint(lang['penguin']['doing_binary_concat'] % (pool.id, self.content_name), 3, 'penguin', 'debug')
-                init_segment = pool.get_init_segment()
-                prog_bar = self.create_progress_bar(
-                    head='binconcat',
-                    desc=f'{self.content_name}: {pool.id}',
-                    total=len(pool.segments),
-                    leave=False,
-                )
-                if not init_segment:
-                    return
-                init_segment = init_segment[0]
-                for segment in pool.segments:
-                    if segment.number == -1:
-                        break
-                    segment_path = f'{self.temp_path}/{segment.group}_{segment.number}{segment.ext}'
-                    if not os.path.exists(segment_path):
-                        prog_bar.update(1)
-                        continue
-                    with open(f'{self.temp_path}/{init_segment.group}_{init_segment.number}{init_segment.ext}', 'ab') as output_data:
-                        with open(segment_path, 'rb') as input_data:
-                            output_data.write(input_data.read())
-                        # Delete segment
-                        os.remove(segment_path)
-                        prog_bar.update(1)   
-                prog_bar.close()
-            '''
-                t = threading.Thread(target=self.binary_concat, kwargs={'pool': pool}, daemon=True)
-                binconcat_threads.append(t)
-                t.start()
-            while True:
-                if [b for b in binconcat_threads if b.is_alive()]:
-                    sleep(0.5)
-                    continue
-                break'''
-                        
-        # Widevine L3 decryption
-        # TODO: update strings
-        if self.stream.key and self.stream.key['video'].method == 'Widevine':
-            for pool in self.copy_of_segment_pools:
-                if pool.format == 'subtitles':
-                    continue
-                init_segment = pool.get_init_segment()
-                if not init_segment:
-                    continue
-                init_segment = init_segment[0]        
-                input_path = f'{self.temp_path}/{init_segment.group}_{init_segment.number}{init_segment.ext}'
-                if not os.path.exists(input_path):
-                    vprint(f'{pool.id} already decrypted. Skipping', 3, 'penguin', 'debug')
-                    continue
-                output_path = f'{self.temp_path}/{pool.id}.mp4'
-                if pool.format == 'video':
-                    key = self.stream.key['video'].raw_key
-                elif pool.format == 'audio':
-                    key = self.stream.key['audio'].raw_key
-                vprint(f'Decrypting track {pool.id} of {self.content_name} using key "{key}"', 3, 'penguin', 'debug')
-                subprocess.run(['mp4decrypt', '--key', key, input_path, output_path])
-                os.remove(input_path)
+        self.update_stats()
+        self.stats['finished']['download'] = True
+        QUEUED_SEGMENTS.remove(item=self.content_name)
+        WRITE_BEHIND_BYTES.remove(item=self.content_name)
+        for host in self.stats['concurrency']['hosts']:
+            CONCURRENCY_LIMIT.remove(item=self.content_name, host=host)
+        if self.async_engine:
+            # Raise any exception from the engine
+            self.async_download.result()
+        self.bandwidth.unregister(self.content_name)
+        if self.expander is not None:
+            self.expander.join()
+        # Wait for the pools still being post-processed
+        for future in self.post_processing:
+            if self.error is None:
+                future.result()
+            else:
+                future.exception()
+        self.post_processor.shutdown()
+        # Used by the post-processing too
+        self.session_pool.close()
+        if self.error is not None:
+            self.close_after_error()
+            raise self.error
+        if self.writer is not None:
+            self.writer.close()
+        self.stats['finished']['post-processing']['concat'] = True
+        self.stats['finished']['post-processing']['decryption'] = True
+        self.journal.compact()
+        self.journal.close()
+        if self.saved_pools is not None:
+            self.saved_pools.close()
 
         command = self.generate_ffmpeg_command()
 
-        subprocess.run(command, check=True)
+        with POST_PROCESSING_TIME.time(step='mux'):
+            subprocess.run(command, check=True)
         move(f'{TEMP}{self.content_sanitized}.mkv', f'{self.output_path}.mkv')
         for file in os.scandir(f'{TEMP}{self.content_sanitized}'):
             os.remove(file.path)
         os.rmdir(f'{TEMP}{self.content_sanitized}')
-        os.remove(f'{TEMP}{self.content_sanitized}.stats')
+        os.remove(f'{TEMP}{self.content_sanitized}.journal')
         os.remove(f'{TEMP}{self.content_sanitized}.pools')
         
-    def binary_concat(self, pool: SegmentPool):
-        vprint(f'Doing binary concat: {pool.id}', 3, 'penguin', 'debug')
-        init_segment = pool.get_init_segment()
+    def is_retryable(self, error: BaseException) -> bool:
+        'Returns True if a segment download failed by `error` should be tried again'
+        return isinstance(error, NETWORK_ERRORS)
+
+    def fail(self, error: BaseException) -> None:
+        'Stops the download after an error retrying won\'t fix, `start` raises it once the downloads stop'
+        with self.thread_lock:
+            if self.error is not None:
+                return
+            self.error = error
+            self.stats['error'] = f'{type(error).__name__}: {error}'
+        vprint(f'Download of {self.content_name} failed: {error}', 1, 'penguin', 'error')
+        self.segment_queue.stop()
+        self.concurrency.close()
+
+    def close_after_error(self) -> None:
+        'Closes what a failed download left open, the journal is kept so it can be resumed'
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except WriterError:
+                pass
+        self.journal.close()
+        if self.saved_pools is not None:
+            self.saved_pools.close()
+
+    def save_segment_pools(self) -> None:
+        'Saves the pools to file, only once, progress goes to the journal'
+        save_pools(
+            f'{self.temp_path}.pools',
+            self.segment_pools,
+            stats={k: self.stats[k] for k in ('total_segments', 'inputs', 'pools', 'do_binary_concat')}
+            )
+
+    def expand_pools(self) -> None:
+        'Appends the lazily generated segments of every pool, then saves the pools'
+        for pool in self.segment_pools:
+            # In batches, the segment queue expands them too when it runs out of segments
+            while pool.segments.expand(1024):
+                pass
+        self.save_segment_pools()
+
+    def update_stats(self) -> None:
+        'Updates the stats of the item and its gauges, from the progress loop'
+        self.stats['bytes_downloaded'] = self.downloaded_bytes.value()
+        self.stats['segments_downloaded'] = self.downloaded_segments.value()
+        if self.stats['segments_downloaded']:
+            self.stats['estimated_total_bytes'] = self.stats['bytes_downloaded'] / self.stats['segments_downloaded'] * self.stats['total_segments']
+        self.stats['concurrency'] = self.concurrency.stats()
+        if hasattr(self, 'segment_queue'):
+            QUEUED_SEGMENTS.set(self.segment_queue.pending(), item=self.content_name)
+        if self.writer is not None:
+            WRITE_BEHIND_BYTES.set(self.writer.in_flight, item=self.content_name)
+        for host, stats in self.stats['concurrency']['hosts'].items():
+            CONCURRENCY_LIMIT.set(stats['limit'], item=self.content_name, host=host)
+
+    def status(self) -> dict:
+        keys = ('bytes_downloaded', 'estimated_total_bytes', 'segments_downloaded', 'total_segments', 'finished', 'error', 'concurrency')
+        return {
+            **super().status(),
+            **{k: self.stats[k] for k in keys if k in self.stats},
+            'queued_segments': self.segment_queue.pending() if hasattr(self, 'segment_queue') else None,
+            }
+
+    def is_encrypted(self) -> bool:
+        return bool(self.stream.key) and self.stream.key['video'].method == 'Widevine'
+
+    def get_track_path(self, pool: SegmentPool) -> str:
+        'Returns the path of the file a track is assembled in'
+        if self.is_encrypted() and pool.id not in self.decryptors:
+            # Decryption writes the final file
+            return f'{self.temp_path}/{pool.id}_encrypted{pool.pool_type.ext}'
+        return f'{self.temp_path}/{pool.id}{pool.pool_type.ext}'
+
+    def create_decryptors(self) -> None:
+        'Creates an in-process CENC decryptor for every encrypted DASH pool'
+        self.decryptors = {}
+        if not self.is_encrypted() or self.options['penguin']['decryption'] != 'internal':
+            return
+        if not cenc.AVAILABLE:
+            vprint('pycryptodome is not installed, decrypting with mp4decrypt', 2, 'penguin', 'warning')
+            return
+        keys = dict(k.raw_key.split(':') for k in self.stream.key.values() if k is not None and k.raw_key)
+        for pool in self.segment_pools:
+            # The initialization segment has the encryption parameters, parts of
+            # multi-period pools have their own, they are decrypted by mp4decrypt
+            if pool.format == 'subtitles' or pool.pool_type != DASHPool or len(pool.get_init_segment()) != 1:
+                continue
+            self.decryptors[pool.id] = cenc.CencDecryptor(keys)
+
+    def load_decryptors(self) -> None:
+        '''
+        Loads the initialization segment of every pool with a decryptor, downloading
+        it first if needed, so media segments can be decrypted as soon as they arrive
+        '''
+        for pool in self.segment_pools:
+            if pool.id not in self.decryptors:
+                continue
+            init_segment = pool.get_init_segment()[0]
+            while not self.is_segment_downloaded(init_segment):
+                try:
+                    self.download_segment(init_segment)
+                except Exception as e:
+                    if not self.is_retryable(e):
+                        raise
+                    vprint(f'Exception in download: {e}', 5, 'penguin', 'error')
+                    sleep(0.5)
+            if not self.get_store(init_segment).available(init_segment):
+                # Assembled on a previous run, decrypted and patched before
+                continue
+            decryptor = self.decryptors[pool.id]
+            if os.path.exists(self.get_redownload_marker(pool.id)):
+                # Its decryption failed on a previous run
+                decryptor.error = cenc.CencError('Decryption failed on a previous run')
+                continue
+            try:
+                decryptor.load_init(self.read_segment(init_segment))
+            except cenc.NotEncrypted:
+                # Already patched by finish_decryption, nothing left to decrypt
+                continue
+            except cenc.CencError as e:
+                decryptor.error = e
+                vprint(f'Can\'t decrypt {pool.id} while downloading ({e}), using mp4decrypt', 2, 'penguin', 'warning')
+
+    def read_segment(self, segment: Segment) -> bytearray:
+        'Returns the data of a downloaded segment, from its store'
+        return self.get_store(segment).read(segment)
+
+    def write_segment(self, segment: Segment, data) -> None:
+        'Overwrites the data of a downloaded segment, the size must stay the same'
+        self.get_store(segment).overwrite(segment, data)
+
+    def get_decryptor(self, segment: Segment):
+        'Returns the decryptor of a media segment, None if it\'s not decrypted while downloading'
+        decryptor = self.decryptors.get(segment.group)
+        if decryptor is None or decryptor.error is not None or segment.init:
+            return None
+        return decryptor
+
+    def decrypt_segment(self, segment: Segment, data=None) -> bool:
+        '''
+        Decrypts a media segment in place, in memory if its `data` is
+        given, else on disk. Returns False if it's not decrypted here
+        '''
+        decryptor = self.get_decryptor(segment)
+        if decryptor is None:
+            return False
+        with POST_PROCESSING_TIME.time(step='decrypt'):
+            try:
+                if data is not None:
+                    decryptor.decrypt_segment(data)
+                    return True
+                data = self.read_segment(segment)
+                decryptor.decrypt_segment(data)
+            except cenc.CencError as e:
+                self.decryption_failed(segment, e)
+                return False
+            self.write_segment(segment, data)
+        return True
+
+    def decryption_failed(self, segment: Segment, error: Exception) -> None:
+        '''
+        Leaves the pool of a segment that can't be decrypted to mp4decrypt. The segments
+        decrypted until then are downloaded again, encrypted, before it's assembled
+        '''
+        decryptor = self.decryptors[segment.group]
+        with self.thread_lock:
+            if decryptor.error is not None:
+                return
+            decryptor.error = error
+            # Kept until the segments are downloaded again, in case it's resumed
+            open(self.get_redownload_marker(segment.group), 'w').close()
+        vprint(
+            f'Can\'t decrypt {segment.group}_{segment.number} ({error}), downloading {segment.group} again for mp4decrypt',
+            2,
+            'penguin',
+            'warning'
+            )
+
+    def get_redownload_marker(self, pool_id: str) -> str:
+        'Returns the path of the file telling the segments of a pool have to be downloaded again, encrypted'
+        return f'{self.temp_path}/{pool_id}.redownload'
+
+    def redownload_pool(self, pool: SegmentPool) -> None:
+        'Downloads the media segments of a pool again, overwriting the ones decrypted before its decryption failed'
+        store = self.stores[pool.id]
+        vprint(f'Downloading {pool.id} again, encrypted', 3, 'penguin', 'debug')
+        for segment in pool.segments:
+            if segment.init or segment.number not in store.sizes:
+                continue
+            while True:
+                try:
+                    data = self.fetch_encrypted(segment, store.sizes[segment.number])
+                except Exception as e:
+                    if not self.is_retryable(e):
+                        raise
+                    vprint(f'Exception in download: {e}', 5, 'penguin', 'error')
+                    sleep(0.5)
+                    continue
+                break
+            store.overwrite(segment, data)
+        os.remove(self.get_redownload_marker(pool.id))
+
+    def fetch_encrypted(self, segment: Segment, size: int) -> bytes:
+        'Returns the data of a segment as it\'s served, it must be `size` bytes long'
+        headers = {'range': f'bytes={segment.mpd_range}'} if segment.mpd_range is not None else {}
+        with get_connection_budget().slot(segment.url, owner=self.content_name), \
+             self.session_pool.session() as session:
+            response = session.get(segment.url, timeout=15, headers=headers)
+            response.raise_for_status()
+        if headers and response.status_code != 206:
+            raise ResponseError(f'Range request of {segment.group}_{segment.number} answered with {response.status_code}')
+        if len(response.content) != size:
+            raise ResponseError(f'{segment.group}_{segment.number} is {len(response.content)} bytes long, it was {size}')
+        return response.content
+
+    def decrypts_hls(self, segment: Segment) -> bool:
+        'Returns True if a segment is AES-128 encrypted and decrypted while downloading'
+        key = segment.key
+        return key is not None and key.method == 'AES-128' and key.url is not None and \
+            self.options['penguin']['hls_decryption'] == 'internal' and aes.AVAILABLE
+
+    def get_hls_key(self, key: ContentKey) -> bytes:
+        'Returns a HLS key from the process-wide key cache, downloading it the first time it\'s used'
+        return get_key_cache().get(key.url, fetch=self.fetch_key)
+
+    def fetch_key(self, url: str) -> bytes:
+        with get_connection_budget().slot(url, owner=self.content_name), \
+             self.session_pool.session() as session:
+            response = session.get(unquote(url), timeout=15)
+            response.raise_for_status()
+            return response.content
+
+    def get_segment_cipher(self, segment: Segment):
+        'Returns the decryptor of an AES-128 segment being downloaded, None if it\'s not decrypted here'
+        if not self.decrypts_hls(segment):
+            return None
+        try:
+            # Key requests are already retried by the session
+            return aes.SegmentDecryptor(self.get_hls_key(segment.key), aes.segment_iv(segment.key.iv, segment.number))
+        except (RequestException, HTTPError, aes.AESError, ValueError) as e:
+            raise DecryptionError(f'Can\'t use key "{segment.key.url}" of {segment.group}_{segment.number}: {e}') from e
+
+    def finish_cipher(self, segment: Segment, cipher) -> bytes:
+        'Returns the last block of an AES-128 segment, without the padding'
+        try:
+            return cipher.finalize()
+        except aes.TruncatedError as e:
+            raise ConnectionError(f'{segment.group}_{segment.number} ended early: {e}') from e
+        except aes.AESError as e:
+            raise DecryptionError(f'Can\'t decrypt {segment.group}_{segment.number}: {e}') from e
+
+    def finish_decryption(self, pool: SegmentPool) -> None:
+        'Turns the initialization segment of a decrypted pool back into an unencrypted one'
+        decryptor = self.decryptors.get(pool.id)
+        if decryptor is None or decryptor.error is not None:
+            return
+        init_segment = pool.get_init_segment()[0]
+        if not self.get_store(init_segment).available(init_segment):
+            # Assembled on a previous run
+            return
+        data = self.read_segment(init_segment)
+        if cenc.CencDecryptor.patch_init(data):
+            self.write_segment(init_segment, data)
+
+    def create_stores(self) -> None:
+        'Creates the segment store of every pool, with the sizes of the segments already downloaded'
+        kind = self.options['penguin']['segment_store']
+        budget = MemoryBudget(int(self.options['penguin']['memory_store_limit']))
+        for pool in self.segment_pools:
+            pool_kind = kind
+            if pool.format == 'subtitles':
+                # Converted file by file
+                pool_kind = 'files'
+            elif pool.pool_type == DASHPool and self.options['penguin']['direct_assembly'] and \
+                 kind == 'files' and TrackFile.supports(pool.segments):
+                pool_kind = 'sparse'
+            self.stores[pool.id] = create_store(
+                pool_kind,
+                pool,
+                self.temp_path,
+                sizes=self.journal.completed[pool.id],
+                # HLS pools are not assembled, their track is the playlist
+                track_path=self.get_track_path(pool) if pool.pool_type == DASHPool else None,
+                budget=budget
+                )
+            if pool_kind == 'sparse' and type(self.stores[pool.id]) == FileStore:
+                vprint(f'{pool.id} can\'t be stored in a single file here, storing it as segment files', 2, 'penguin', 'warning')
+            vprint(f'Storing {pool.id} in a {type(self.stores[pool.id]).__name__}', 4, 'penguin', 'debug')
+
+    def get_store(self, segment: Segment):
+        return self.stores[segment.group]
+
+    def is_downloading(self) -> bool:
+        if self.async_engine:
+            return not self.async_download.done()
+        return bool([sdl for sdl in self.segment_downloaders if sdl.is_alive()])
+
+    def pool_finished(self, pool: SegmentPool) -> None:
+        'Called by the segment queue when the last segment of a pool is downloaded'
+        vprint(f'Pool {pool.id} finished downloading', 4, 'penguin', 'debug')
+        if pool.format == 'subtitles':
+            with self.subtitle_lock:
+                self.pending_subtitle_pools.discard(pool.id)
+                if self.pending_subtitle_pools:
+                    return
+            self.post_processing.append(self.post_processor.submit(self.convert_subtitle_pools))
+            return
+        self.post_processing.append(self.post_processor.submit(self.post_process_pool, pool))
+
+    def convert_subtitle_pools(self) -> None:
+        'Fixes or converts the downloaded subtitles of every subtitle pool, and writes the playlists of HLS ones'
+        pools = [p for p in self.segment_pools if p.format == 'subtitles']
+        if self.writer is not None:
+            self.writer.flush()
+        for pool in pools:
+            # Converted from their files, segments kept in memory are written first
+            self.stores[pool.id].persist()
+        paths = [
+            self.stores[p.id].path(s)
+            for p in pools
+            for s in p.segments if s.ext in SUBTITLE_EXTENSIONS
+            ]
+        vprint(f'Converting {len(paths)} subtitle files', 4, 'penguin', 'debug')
+        with POST_PROCESSING_TIME.time(step='subtitles'):
+            convert_subtitles(paths, processes=int(self.options['penguin']['subtitle_processes']))
+        for pool in pools:
+            if pool.pool_type == M3U8Pool:
+                # Read by ffmpeg through a playlist
+                self.create_m3u8_playlist(pool)
+            self.record_stored_segments(pool)
+
+    def post_process_pool(self, pool: SegmentPool) -> None:
+        'Leaves the track of a pool ready for muxing: assembled and decrypted'
+        if self.writer is not None:
+            self.writer.flush(pool.id)
+        # Records are written while the segments are still there to flush
+        self.journal.sync(force=True)
+        missing = len([s for s in pool.segments if not self.is_segment_downloaded(s)])
+        if missing:
+            vprint(f'Pool {pool.id} has {missing} segments missing', 1, 'penguin', 'warning')
+        if os.path.exists(self.get_redownload_marker(pool.id)):
+            # Left to mp4decrypt while downloading
+            self.redownload_pool(pool)
+        self.finish_decryption(pool)
+        store = self.stores[pool.id]
+        if pool.pool_type == M3U8Pool:
+            # Read by ffmpeg through a playlist
+            store.persist()
+            self.create_m3u8_playlist(pool)
+        elif pool.pool_type == DASHPool and len(pool.segments.parts) > 1:
+            # Periods are decrypted one by one, then joined
+            self.join_parts(pool)
+        elif self.stats['do_binary_concat'] or type(store) != FileStore:
+            self.binary_concat(pool)
+        self.record_stored_segments(pool)
+        if self.is_encrypted() and pool.pool_type == DASHPool and len(pool.segments.parts) <= 1:
+            self.mp4decrypt_pool(pool)
+
+    def sync_stores(self) -> None:
+        'Flushes the committed segments of every store to disk, called by the journal before recording them'
+        for store in list(self.stores.values()):
+            store.sync()
+
+    def record_stored_segments(self, pool: SegmentPool) -> None:
+        'Records the segments of a non-durable store in the journal, once they are on disk'
+        store = self.stores[pool.id]
+        if store.durable:
+            return
+        for segment in pool.segments:
+            if store.contains(segment) and not self.journal.is_done(segment.group, segment.number):
+                self.journal.append(segment, store.sizes[segment.number])
+
+    def mp4decrypt_pool(self, pool: SegmentPool) -> None:
+        # Widevine L3 decryption
+        # TODO: update strings
+        if pool.id in self.decryptors and self.decryptors[pool.id].error is None:
+            # Decrypted while downloading
+            return
+        input_path = self.get_track_path(pool)
+        output_path = f'{self.temp_path}/{pool.id}.mp4'
+        if input_path == output_path and os.path.exists(input_path):
+            # Internal decryption failed, the track is where the decrypted one goes
+            input_path = f'{self.temp_path}/{pool.id}_encrypted.mp4'
+            os.replace(output_path, input_path)
+        if not os.path.exists(input_path):
+            vprint(f'{pool.id} already decrypted. Skipping', 3, 'penguin', 'debug')
+            return
+        self.run_mp4decrypt(pool, input_path, output_path)
+        os.remove(input_path)
+
+    def run_mp4decrypt(self, pool: SegmentPool, input_path: str, output_path: str) -> None:
+        if pool.format == 'video':
+            key = self.stream.key['video'].raw_key
+        elif pool.format == 'audio':
+            key = self.stream.key['audio'].raw_key
+        vprint(f'Decrypting {os.path.basename(input_path)} of {self.content_name} using key "{key}"', 3, 'penguin', 'debug')
+        with POST_PROCESSING_TIME.time(step='mp4decrypt'):
+            subprocess.run(['mp4decrypt', '--key', key, input_path, output_path])
+
+    def join_parts(self, pool: SegmentPool) -> None:
+        '''
+        Assembles every part (period) of a multi-period pool on its own, decrypting them
+        if needed, and joins them with ffmpeg's concat demuxer, without re-encoding
+        '''
+        output_path = f'{self.temp_path}/{pool.id}{pool.pool_type.ext}'
+        if os.path.exists(output_path):
+            vprint(f'{pool.id} already joined. Skipping', 3, 'penguin', 'debug')
+            return
+        table = pool.segments
+        store = self.stores[pool.id]
         prog_bar = self.create_progress_bar(
             head='binconcat',
             desc=f'{self.content_name}: {pool.id}',
-            total=len(pool.segments),
+            total=len(table),
             leave=False,
         )
-        if not init_segment:
-            return
-        init_segment = init_segment[0]
-        for segment in pool.segments:
-            if segment.number == -1:
-                break
-            segment_path = f'{self.temp_path}/{segment.group}_{segment.number}{segment.ext}'
-            if not os.path.exists(segment_path):
-                prog_bar.update(1)
+        part_paths = []
+        for index in range(len(table.parts)):
+            try:
+                segments = [table.get(-1 - index)]
+            except KeyError:
+                # Period without an initialization segment
+                segments = []
+            segments += [table.get(number) for number in table.part_numbers(index)]
+            part_path = f'{self.temp_path}/{pool.id}_part{index}{pool.pool_type.ext}'
+            part_paths.append(part_path)
+            if not self.is_encrypted():
+                with POST_PROCESSING_TIME.time(step='concat'):
+                    store.assemble(part_path, segments, progress=prog_bar)
                 continue
-            with open(f'{self.temp_path}/{init_segment.group}_{init_segment.number}{init_segment.ext}', 'ab') as output_data:
-                with open(segment_path, 'rb') as input_data:
-                    output_data.write(input_data.read())
-                # Delete segment
-                os.remove(segment_path)
-                prog_bar.update(1)   
+            if os.path.exists(part_path):
+                # Decrypted on a previous run
+                prog_bar.update(len(segments))
+                continue
+            encrypted_path = f'{self.temp_path}/{pool.id}_part{index}_encrypted{pool.pool_type.ext}'
+            with POST_PROCESSING_TIME.time(step='concat'):
+                store.assemble(encrypted_path, segments, progress=prog_bar)
+            self.run_mp4decrypt(pool, encrypted_path, part_path)
+            os.remove(encrypted_path)
+        prog_bar.close()
+        list_path = f'{self.temp_path}/{pool.id}_parts.txt'
+        with open(list_path, 'w', encoding='utf-8') as list_file:
+            for part_path in part_paths:
+                escaped = part_path.replace("'", "'\\''")
+                list_file.write(f"file '{escaped}'\n")
+        joined_path = f'{self.temp_path}/{pool.id}_joined{pool.pool_type.ext}'
+        vprint(f'Joining {len(part_paths)} periods of {pool.id} of {self.content_name}', 3, 'penguin', 'debug')
+        with POST_PROCESSING_TIME.time(step='join'):
+            subprocess.run(
+                ['ffmpeg', '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_path, '-map', '0', '-c', 'copy', joined_path],
+                check=True
+                )
+        os.replace(joined_path, output_path)
+        for part_path in part_paths:
+            os.remove(part_path)
+        os.remove(list_path)
+
+    def binary_concat(self, pool: SegmentPool):
+        vprint(lang['penguin']['doing_binary_concat'] % (pool.id, self.content_name), 3, 'penguin', 'debug')
+        segments = pool.get_init_segment() + sorted([s for s in pool.segments if not s.init], key=lambda s: s.number)
+        prog_bar = self.create_progress_bar(
+            head='binconcat',
+            desc=f'{self.content_name}: {pool.id}',
+            total=len(segments),
+            leave=False,
+        )
+        start = time()
+        copied = self.stores[pool.id].assemble(self.get_track_path(pool), segments, progress=prog_bar)
+        elapsed = max(time() - start, 0.001)
+        POST_PROCESSING_TIME.observe(elapsed, step='concat')
         prog_bar.close()
+        vprint(
+            f'Concatenated {pool.id} of {self.content_name}: {humanbytes(copied)} in {elapsed:.2f}s ({humanbytes(copied / elapsed)}/s)',
+            3,
+            'penguin',
+            'debug'
+            )
         
     def generate_ffmpeg_command(self, ) -> list:
         # Merge segments
@@ -306,13 +924,14 @@ class PenguinDownloader(BaseDownloader):
         for prot in ALL_PROTOCOLS:
             if not get_extension(stream.url) in prot.SUPPORTED_EXTENSIONS:
                 continue
-            processed = prot(stream=stream, options=self.options).extract()
+            processed = prot(stream=stream, options=self.options, session_pool=self.session_pool).extract()
             for pool in processed['segment_pools']:
-                self.stats['total_segments'] += len(pool.segments)
+                self.stats['total_segments'] += pool.segments.total
                 pool.id = self.generate_pool_id(pool.format)
-                if prot == HTTPLiveStream:
-                    self.create_m3u8_playlist(pool=pool)
-                elif prot == MPEGDASHStream and stream == self.stream:
+                # Protocols name groups per stream, use the pool id instead
+                # so segments of different streams don't clash
+                pool.segments.group = pool.id
+                if prot == MPEGDASHStream and stream == self.stream:
                     self.stats['do_binary_concat'] = True
                 self.segment_pools.append(pool)
                 self.stats['inputs'].append(self.create_input(pool=pool, stream=stream))
@@ -321,8 +940,8 @@ class PenguinDownloader(BaseDownloader):
             vprint('stream incompatible error', 1, 'emperor', 'error')
             return
         subtitle_pool_id = self.generate_pool_id('subtitles')
-        subtitle_pool = SegmentPool([], 'subtitles', subtitle_pool_id, None, None)
-        subtitle_segment = Segment(
+        subtitle_pool = SegmentPool(SegmentTable(subtitle_pool_id, 'subtitles'), 'subtitles', subtitle_pool_id, None, None)
+        subtitle_pool.segments.append(Segment(
             url=stream.url,
             number=0,
             media_type='subtitles',
@@ -332,8 +951,7 @@ class PenguinDownloader(BaseDownloader):
             init=False,
             ext=get_extension(stream.url),
             mpd_range=None
-            )
-        subtitle_pool.segments = [subtitle_segment]
+            ))
         self.segment_pools.append(subtitle_pool)
         ff_input = self.create_input(pool=subtitle_pool, stream=stream)
         ff_input.file_path = ff_input.file_path.replace(subtitle_pool_id, subtitle_pool_id + '_0')
@@ -383,26 +1001,24 @@ class PenguinDownloader(BaseDownloader):
         ff_input.hls_stream = '.m3u' in stream.url
         return ff_input
         
-    def segment_downloader(self):
-        
-        def get_unfinished_pools() -> list[SegmentPool]:
-            return [p for p in self.segment_pools if not p._finished]
-        
-        def get_unreserved_pools() -> list[SegmentPool]:
-            return [p for p in self.segment_pools if not p._reserved]
-        
-        def get_pool() -> SegmentPool:
-            unfinished = get_unfinished_pools()
-            pools = get_unreserved_pools()
+    def add_segment_downloaders(self) -> None:
+        'Starts the segment downloaders the concurrency controller needs and aren\'t running yet'
+        if self.error is not None:
+            return
+        pool_ids = self.segment_queue.pool_ids()
+        for i in range(len(self.segment_downloaders), self.concurrency.workers()):
+            sdl_name = f'{threading.current_thread().name}/sdl{i}'
+            # Spread downloaders between pools, they help other pools once theirs is empty
+            sdl = threading.Thread(
+                target=self.segment_downloader,
+                kwargs={'preferred_pool': pool_ids[i % len(pool_ids)] if pool_ids else None},
+                name=sdl_name,
+                daemon=True
+                )
+            self.segment_downloaders.append(sdl)
+            sdl.start()
 
-            if not unfinished:
-                return
-            if not pools:
-                vprint(f'Assisting {unfinished[0]._reserved_by} with pool {unfinished[0].id}', 4, thread_name)
-                return unfinished[0]
-            pools[0]._reserved = True
-            pools[0]._reserved_by = thread_name
-            return pools[0]
+    def segment_downloader(self, preferred_pool=None):
         
         thread_name = threading.current_thread().name
         
@@ -414,136 +1030,382 @@ class PenguinDownloader(BaseDownloader):
             lock=self.thread_lock
             )
         
+        current_pool = preferred_pool
         while True:
             
-            pool = get_pool()
+            work = self.segment_queue.get(preferred=current_pool)
             
-            if pool is None:
+            if work is None:
                 return
             
-            threaded_vprint(
-                'Current pool: ' + pool.id,
-                level=4,
-                module_name=thread_name,
-                lock=self.thread_lock
-                )
-            while True:
-                if not pool.segments:
-                    if not pool._finished:
-                        pool._finished = True
-                        # TODO: actual message
-                        # vprint('painful ' + pool.id, 5)
-                    break
-                
-                segment = pool.segments.pop(0)
-                
+            pool, segment = work
+            
+            if pool.id != current_pool:
+                current_pool = pool.id
                 threaded_vprint(
-                    message=f'Took segment {segment.group}_{segment.number}',
-                    level=5,
+                    'Current pool: ' + pool.id,
+                    level=4,
                     module_name=thread_name,
-                    error_level='debug',
                     lock=self.thread_lock
-                )
-                
-                segment_path = f'{self.temp_path}/{segment.group}_{segment.number}{segment.ext}'
-                if os.path.exists(segment_path):
-                    threaded_vprint(
-                        message=f'Skipping already downloaded segment {segment.group}_{segment.number}',
-                        level=5,
-                        module_name='penguin',
-                        error_level='debug',
-                        lock=self.thread_lock
                     )
+                
+            threaded_vprint(
+                message=f'Took segment {segment.group}_{segment.number}',
+                level=5,
+                module_name=thread_name,
+                error_level='debug',
+                lock=self.thread_lock
+            )
+            
+            try:
+                if self.segment_exists(segment):
                     continue
                 # Segment download
                 while True:
-                    # Create a cloudscraper session
-                    with cloudscraper.create_scraper(browser=self.browser) as session:
-            
-                        session.mount('https://', HTTPAdapter(max_retries=self.retry_config))
-                        session.mount('http://', HTTPAdapter(max_retries=self.retry_config))
-                        try:
-                            segment_data = session.get(segment.url, timeout=15, headers={'range': f'bytes={segment.mpd_range}'} if segment.mpd_range is not None else {})
-                        except BaseException as e:
-                            threaded_vprint(
-                                f'Exception in download: {e}',
-                                level=5,
-                                module_name=thread_name,
-                                error_level='error',
-                                lock=self.thread_lock
-                                )
-                            sleep(0.5) 
-                            continue
-                        if 'Content-Length' in segment_data.headers:
-                            self.stats['bytes_downloaded'] += int(segment_data.headers['Content-Length'])
-                        segment_contents = segment_data.content
-                        
-                        if segment.ext == '.vtt':
-                            # Workarounds for Atresplayer subtitles
-                            # Fix italic characters
-                            # Replace facing (#) characters
-                            segment_contents = re.sub(r'^# ', '<i>', segment_contents.decode(), flags=re.MULTILINE)
-                            # Replace trailing (#) characters
-                            segment_contents = re.sub(r' #$', '</i>', segment_contents, flags=re.MULTILINE)
-                            # Fix aposthrophes
-                            segment_contents = segment_contents.replace('&apos;', '\'').encode()
-                        elif segment.ext == '.ttml2':
-                            subrip_contents = ''
-                            subtitle_entries = re.findall(r'<p.+</p>', segment_contents.decode())
-                            i = 1
-                            for p in subtitle_entries:
-                                begin = re.search(r'begin="([\d:.]+)"', p).group(1).replace('.', ',')
-                                end = re.search(r'end="([\d:.]+)"', p).group(1).replace('.', ',')
-                                contents = re.search(r'>(.+)</p>', p).group(1).replace('<br />', '\n')
-                                contents = re.sub(r'<(|/)span>', '', p)
-                                contents = contents.replace('&gt;', '')
-                                contents = contents.strip()
-                                subrip_contents += f'{i}\n{begin} --> {end}\n{contents}\n\n'
-                                i += 1
-                            segment_contents = subrip_contents.encode()
-                            segment_path = segment_path.replace('.ttml2', '.srt')
-                            
-                        # Write fragment data to file
-                        with open(segment_path, 'wb') as f:
-                            f.write(segment_contents)
-
+                    if self.error is not None:
+                        # Taken before the download failed
+                        return
+                    try:
+                        self.download_segment(segment)
+                    except BaseException as e:
+                        if not self.is_retryable(e):
+                            self.fail(e)
+                            return
                         threaded_vprint(
-                            lang['penguin']['segment_downloaded'] % (f'{segment.group}_{segment.number}'),
+                            f'Exception in download: {e}',
                             level=5,
-                            module_name='penguin',
-                            error_level='debug',
+                            module_name=thread_name,
+                            error_level='error',
                             lock=self.thread_lock
                             )
-                        self.stats['segments_downloaded'] += 1
-                        break
-            
+                        sleep(0.5) 
+                        continue
+                    break
+            finally:
+                self.segment_queue.task_done(pool)
+
+    def is_segment_downloaded(self, segment: Segment) -> bool:
+        return self.journal.is_done(segment.group, segment.number) or self.get_store(segment).contains(segment)
+
+    def segment_exists(self, segment: Segment) -> bool:
+        if isinstance(segment, RangeRequest):
+            # Range requests are only planned for segments not downloaded yet
+            return False
+        if self.is_segment_downloaded(segment):
+            threaded_vprint(
+                message=f'Skipping already downloaded segment {segment.group}_{segment.number}',
+                level=5,
+                module_name='penguin',
+                error_level='debug',
+                lock=self.thread_lock
+            )
+            return True
+        return False
+
+    def plan_range_requests(self) -> None:
+        'Merges contiguous segment ranges of the pools to download into bigger requests'
+        chunk_size = int(self.options['penguin']['range_chunk_size'])
+        for pool in self.segment_pools:
+            if not pool.segments.has_ranges():
+                continue
+            pending = [s for s in pool.segments if not self.is_segment_downloaded(s)]
+            self.work[pool.id] = plan_range_requests(pending, chunk_size)
+            merged = [r for r in self.work[pool.id] if isinstance(r, RangeRequest)]
+            if merged:
+                vprint(
+                    f'Merged {sum(len(r.segments) for r in merged)} segments of {pool.id} into {len(merged)} range requests',
+                    4,
+                    'penguin',
+                    'debug'
+                    )
+
+    def download_segment(self, segment: Segment) -> None:
+        '''
+        Downloads a single segment (or range request) to the temporal directory, raises an
+        exception on failure, retrying is up to the caller (a segment downloader or the async engine)
+        '''
+        # The process-wide budget is shared with the other items, waiting
+        # for it counts as latency for this item's concurrency controller
+        host = urlparse(segment.url).netloc
+        try:
+            with self.concurrency.slot(segment.url) as transfer, \
+                 get_connection_budget().slot(segment.url, owner=self.content_name), \
+                 SEGMENT_FETCH_TIME.time(host=host):
+                transfer.size = self.fetch_segment(segment)
+        except Exception:
+            SEGMENT_RETRIES.inc(host=host)
+            raise
+
+    def fetch_segment(self, segment: Segment) -> int:
+        'Returns the amount of bytes downloaded'
+        if isinstance(segment, RangeRequest):
+            return self.download_range_request(segment)
+        if segment.mpd_range is None and not self.decrypts_hls(segment):
+            # Whole responses already fetched, like the subtitles sniffed by the HLS protocol
+            cached = get_response_cache().get_cached(segment.url)
+            if cached is not None:
+                return self.store_cached(segment, cached)
+        # Continue from the bytes received on previous attempts
+        offset = self.get_partial_size(segment)
+        length = None
+        if segment.mpd_range is not None:
+            start, end = parse_range(segment.mpd_range)
+            if offset > end - start:
+                offset = self.reset_partial(segment)
+            length = end - start + 1 - offset
+            headers = {'range': f'bytes={start + offset}-{end}'}
+        else:
+            headers = {'range': f'bytes={offset}-'} if offset else {}
+        with self.session_pool.session() as session, \
+             session.get(segment.url, timeout=15, headers=headers, stream=True) as segment_data, \
+             self.buffer_pool.buffer() as buffer:
+            if segment_data.status_code == 416 and offset:
+                # The partial data doesn't match the file anymore
+                self.reset_partial(segment)
+            segment_data.raise_for_status()
+            if headers and segment_data.status_code != 206:
+                if segment.mpd_range is not None:
+                    raise ResponseError(f'Range request of {segment.group}_{segment.number} answered with {segment_data.status_code}')
+                # Range not supported, start over
+                offset = 0
+            elif offset:
+                RESUMED_BYTES.inc(offset, host=urlparse(segment.url).netloc)
+            # Undecoded reads return the bytes received before a connection
+            # drops, decoded ones lose them
+            segment_data.raw.decode_content = is_encoded(segment_data)
+            size = self.stream_to_file(segment_data, segment, buffer, response_length(segment_data, length), offset)
+        return size - offset
+
+    def store_cached(self, segment: Segment, data: bytes) -> int:
+        'Writes a segment from the response cache to its store, returns its size'
+        with self.get_store(segment).open(segment) as output:
+            output.write(data)
+        self.downloaded_bytes.inc(len(data))
+        self.complete_segment(segment, len(data))
+        return len(data)
+
+    def get_partial_size(self, segment: Segment) -> int:
+        'Returns the amount of bytes of a segment received on previous, failed, attempts'
+        if self.decrypts_hls(segment):
+            # Decrypted data can't be continued, CBC needs the previous encrypted block
+            return 0
+        return self.get_store(segment).partial_size(segment)
+
+    def reset_partial(self, segment: Segment) -> int:
+        'Discards the bytes received of a segment, returns the new partial size'
+        self.get_store(segment).discard(segment)
+        return 0
+
+    def download_range_request(self, request: RangeRequest) -> int:
+        '''
+        Fetches the segments of a range request with a single request, splitting
+        the response back into segment files. When retried only the segments
+        not downloaded on the previous attempt are requested
+        '''
+        pending = [
+            s for s in request.segments
+            if not self.is_segment_downloaded(s) and not (self.writer is not None and self.writer.is_queued(s))
+            ]
+        if not pending:
+            return 0
+        downloaded = 0
+        start, end = parse_range(pending[0].mpd_range)
+        # The first segment may have been received partway
+        offset = self.get_partial_size(pending[0])
+        if offset > end - start:
+            offset = self.reset_partial(pending[0])
+        headers = {'range': f'bytes={start + offset}-{request.end}'}
+        with self.session_pool.session() as session, \
+             session.get(request.url, timeout=15, headers=headers, stream=True) as range_data, \
+             self.buffer_pool.buffer() as buffer:
+            range_data.raise_for_status()
+            if range_data.status_code != 206:
+                raise ResponseError(f'Range request of {request.group}_{request.number} answered with {range_data.status_code}')
+            if offset:
+                RESUMED_BYTES.inc(offset, host=urlparse(request.url).netloc)
+            range_data.raw.decode_content = is_encoded(range_data)
+            response_length(range_data, request.end - start - offset + 1)
+            for segment in pending:
+                segment_start, segment_end = parse_range(segment.mpd_range)
+                size = self.stream_to_file(range_data, segment, buffer, segment_end - segment_start + 1 - offset, offset)
+                downloaded += size - offset
+                offset = 0
+        return downloaded
+
+    def stream_to_file(self, response, segment: Segment, buffer: memoryview, size=None, offset=0) -> int:
+        '''
+        Streams `size` bytes (or everything left) of a response body to the segment
+        store using a recycled buffer, after the `offset` bytes received on previous
+        attempts. AES-128 segments are decrypted on the way. Returns the amount of
+        bytes of the segment received, including `offset`
+        '''
+        if self.writer is not None:
+            return self.stream_to_writer(response, segment, buffer, size, offset)
+        host = urlparse(segment.url).netloc
+        cipher = self.get_segment_cipher(segment)
+        written = offset
+        size = size + offset if size is not None else None
+        # Kept by the store to continue from there on the next attempt if it fails
+        with self.get_store(segment).open(segment, offset) as output:
+            while size is None or written < size:
+                read = response.raw.readinto(buffer if size is None else buffer[:min(size - written, len(buffer))])
+                if not read:
+                    if size is not None:
+                        raise ConnectionError(f'Connection closed with {size - written} bytes left')
+                    break
+                output.write(buffer[:read] if cipher is None else cipher.update(buffer[:read]))
+                written += read
+                self.downloaded_bytes.inc(read)
+                DOWNLOADED_BYTES.inc(read, host=host)
+                # Blocks while over the bandwidth caps
+                self.bandwidth.consume(read, self.content_name, host)
+            if cipher is not None:
+                output.write(self.finish_cipher(segment, cipher))
+        self.complete_segment(segment, written if cipher is None else cipher.size)
+        return written
+
+    def stream_to_writer(self, response, segment: Segment, buffer: memoryview, size=None, offset=0) -> int:
+        '''
+        Reads the rest of a segment into memory and hands it to the writer thread, waiting
+        while the writer is over its memory limit. Data received before a failure is
+        written right away, so the next attempt continues after it. AES-128 segments are
+        decrypted before that. Returns the amount of bytes of the segment received
+        '''
+        store = self.get_store(segment)
+        host = urlparse(segment.url).netloc
+        cipher = self.get_segment_cipher(segment)
+        if size is not None:
+            # Read straight into the memory handed to the writer
+            self.writer.reserve(size)
+            reserved = size
+            data = bytearray(size)
+            view = memoryview(data)
+        else:
+            reserved = 0
+            data = bytearray()
+        received = 0
+        try:
+            while size is None or received < size:
+                if size is not None:
+                    read = response.raw.readinto(view[received:received + min(size - received, len(buffer))])
+                else:
+                    read = response.raw.readinto(buffer)
+                if not read:
+                    if size is not None:
+                        raise ConnectionError(f'Connection closed with {size - received} bytes left')
+                    break
+                if size is None:
+                    self.writer.reserve(read)
+                    reserved += read
+                    data += buffer[:read]
+                received += read
+                self.downloaded_bytes.inc(read)
+                DOWNLOADED_BYTES.inc(read, host=host)
+                # Blocks while over the bandwidth caps
+                self.bandwidth.consume(read, self.content_name, host)
+        except BaseException:
+            if size is not None:
+                view.release()
+            if received and cipher is None:
+                with store.open(segment, offset) as output:
+                    output.write(data[:received])
+            self.writer.release(reserved)
+            raise
+        if size is not None:
+            view.release()
+        if cipher is not None:
+            data = cipher.update(data) + self.finish_cipher(segment, cipher)
+        # Segments received whole are decrypted here, in parallel, resumed ones
+        # are decrypted on disk once written
+        decrypted = not offset and self.decrypt_segment(segment, data=data)
+        self.writer.submit(WriteRequest(
+            segment=segment,
+            data=data,
+            store=store,
+            offset=offset,
+            on_written=lambda: self.complete_segment(segment, offset + len(data), decrypted),
+            reserved=reserved
+            ))
+        return offset + received
+
+    def complete_segment(self, segment: Segment, size: int, decrypted=False) -> None:
+        'Decrypts a written segment, commits it to its store and records it in the journal'
+        if self.decryptors and not decrypted:
+            # Before the segment is recorded as downloaded, so it's
+            # never left encrypted
+            self.decrypt_segment(segment)
+        durable = self.get_store(segment).commit(segment, size)
+        self.segment_downloaded(segment, size, durable)
+
+    def segment_downloaded(self, segment: Segment, size: int, durable=True) -> None:
+        '''
+        Records a completed segment, must be called once its data is written. Segments
+        not on disk yet (`durable` False) are recorded in the journal by the post-processing
+        '''
+        if durable:
+            self.journal.append(segment, size)
+        threaded_vprint(
+            lang['penguin']['segment_downloaded'] % (f'{segment.group}_{segment.number}'),
+            level=5,
+            module_name='penguin',
+            error_level='debug',
+            lock=self.thread_lock
+            )
+        self.downloaded_segments.inc()
+        DOWNLOADED_SEGMENTS.inc(host=urlparse(segment.url).netloc)
+
     def create_m3u8_playlist(self, pool: SegmentPool):
-        # TODO: support for multi-key
-        keys = []
-        if os.path.exists(f'{self.temp_path}/{pool.id}.m3u8'):
-            return
-        # Set first segment from list
-        first_segment = pool.segments[0]
-        playlist = '#EXTM3U\n#EXT-X-PLAYLIST-TYPE:VOD\n#EXT-X-MEDIA-SEQUENCE:0\n'
+        store = self.stores[pool.id]
+        playlist = '#EXTM3U\n'
+        if type(store) != FileStore:
+            # Segments are byte ranges of a single file
+            playlist += '#EXT-X-VERSION:4\n'
+        playlist += f'#EXT-X-PLAYLIST-TYPE:VOD\n#EXT-X-MEDIA-SEQUENCE:{pool.media_sequence}\n'
         # Handle initialization segments
         init_segment = [f for f in pool.segments if f.init]
         if init_segment:
-            playlist += f'#EXT-X-MAP:URI="{init_segment[0].output}"'
-        # Handle decryption keys
-        if first_segment.key is not None and first_segment.key['video'].url is not None:
-            playlist += f'#EXT-X-KEY:METHOD={first_segment.key["video"].method},URI={pool.id}.key\n'
-            # Download the key
-            with cloudscraper.create_scraper(browser=self.browser) as session:
-                session.mount('https://', HTTPAdapter(max_retries=self.retry_config))
-                key_contents = session.get(unquote(first_segment.key['video'].url))
-                # Write key to file
-                with open(f'{self.temp_path}/{pool.id}.key', 'wb') as key_file:
-                    key_file.write(key_contents.content)
+            name, offset, size = store.locate(init_segment[0])
+            byterange = f',BYTERANGE="{size}@{offset}"' if offset is not None else ''
+            playlist += f'#EXT-X-MAP:URI="{name}"{byterange}\n'
+        # Local copies of the keys, by url
+        key_files = {}
+        current_key = None
+        # Media sequence number of the segment, the playlist keeps the source's
+        position = pool.media_sequence
         # Add segments to playlist
         for segment in pool.segments:
-            playlist += f'#EXTINF:{segment.duration},\n{segment.group}_{segment.number}{segment.ext}\n'
+            if segment.init:
+                continue
+            # Handle decryption keys, segments decrypted while downloading are clear
+            key = segment.key
+            if key is None or key.url is None or self.decrypts_hls(segment):
+                key = None
+            elif key.iv == aes.sequence_iv(position):
+                # Made from the media sequence number, left implicit
+                key = ContentKey(key.url, key.raw_key, key.method)
+            if key != current_key:
+                # Key rotation, or a new explicit IV
+                playlist += self.create_m3u8_key_tag(pool, key, key_files)
+                current_key = key
+            name, offset, size = store.locate(segment)
+            playlist += f'#EXTINF:{segment.duration},\n'
+            if offset is not None:
+                playlist += f'#EXT-X-BYTERANGE:{size}@{offset}\n'
+            playlist += f'{name}\n'
+            position += 1
         # Write end of file 
         playlist += '#EXT-X-ENDLIST\n'
         # Write playlist to file
         with open(f'{self.temp_path}/{pool.id}.m3u8', 'w') as playlist_file:
-            playlist_file.write(playlist)
\ No newline at end of file
+            playlist_file.write(playlist)
+
+    def create_m3u8_key_tag(self, pool: SegmentPool, key: ContentKey, key_files: dict) -> str:
+        'Returns the EXT-X-KEY tag of the following segments, writing the key to a file the first time'
+        if key is None:
+            return '#EXT-X-KEY:METHOD=NONE\n'
+        if key.url not in key_files:
+            key_files[key.url] = f'{pool.id}_{len(key_files)}.key'
+            with open(f'{self.temp_path}/{key_files[key.url]}', 'wb') as key_file:
+                key_file.write(self.get_hls_key(key))
+        iv = f',IV={key.iv}' if key.iv else ''
+        return f'#EXT-X-KEY:METHOD={key.method},URI="{key_files[key.url]}"{iv}\n'
\ No newline at end of file
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from singularity.types.stream import Segment, SegmentPool
+from singularity.utils import vprint
+
+
+class AsyncEngine:
+    '''
+    ## Penguin async engine
+    ### Schedules the segment fetches of every Penguin download in the process from
+    ### a single event loop, instead of a group of polling threads per item
+        >>> from singularity.downloader.penguin.engine import get_async_engine
+        >>> future = get_async_engine(max_in_flight=30).submit(downloader)
+        >>> future.result()  # Waits until all the segment pools are downloaded
+
+    It's not async I/O: requests are made using the downloader's (blocking) session
+    pool, so they run in a shared thread pool sized to the in-flight limit, the loop
+    only bounds and retries them. Segment queues block too, they are read from
+    another thread pool so a queue waiting for work doesn't stop the loop
+    '''
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max(1, max_in_flight)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_in_flight,
+            thread_name_prefix='penguin-async'
+            )
+        # A thread per item taking work from its segment queue
+        self.dispatcher = ThreadPoolExecutor(thread_name_prefix='penguin-async-queue')
+        self.loop = asyncio.new_event_loop()
+        # Created on the loop's thread, see run_loop
+        self.in_flight = None
+        self._ready = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop, name='penguin-async', daemon=True)
+        self.thread.start()
+        self._ready.wait()
+
+    def run_loop(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._ready.set()
+        self.loop.run_forever()
+
+    def configure(self, max_in_flight: int) -> None:
+        'Raises the in-flight limit, for an item asking for more than the current one'
+        with _async_engine_lock:
+            if max_in_flight <= self.max_in_flight:
+                return
+            added = max_in_flight - self.max_in_flight
+            self.max_in_flight = max_in_flight
+        self.loop.call_soon_threadsafe(self.grow, added)
+
+    def grow(self, added: int) -> None:
+        'Replaces the executor with a bigger one, on the loop\'s thread, the only one using it'
+        # Requests already running finish on the old one
+        old_executor = self.executor
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_in_flight,
+            thread_name_prefix='penguin-async'
+            )
+        old_executor.shutdown(wait=False)
+        for _ in range(added):
+            self.in_flight.release()
+
+    def submit(self, downloader) -> Future:
+        'Schedules all segment pools of a downloader, returns a `concurrent.futures.Future`'
+        return asyncio.run_coroutine_threadsafe(self.download(downloader), self.loop)
+
+    def take_segment(self, downloader):
+        'Returns the next segment of a downloader not downloaded yet, None once there are no more'
+        while True:
+            work = downloader.segment_queue.get()
+            if work is None:
+                return None
+            pool, segment = work
+            if not downloader.segment_exists(segment):
+                return work
+            downloader.segment_queue.task_done(pool)
+
+    async def download(self, downloader) -> None:
+        tasks = []
+        while True:
+            work = await self.loop.run_in_executor(self.dispatcher, self.take_segment, downloader)
+            if work is None:
+                break
+            pool, segment = work
+            # Wait for a free slot before scheduling the next segment,
+            # all items wait on the same semaphore
+            await self.in_flight.acquire()
+            tasks.append(self.loop.create_task(self.download_segment(downloader, pool, segment)))
+            # Forget about finished tasks
+            if len(tasks) > self.max_in_flight * 4:
+                tasks = [t for t in tasks if not t.done()]
+        await asyncio.gather(*tasks)
+
+    async def download_segment(self, downloader, pool: SegmentPool, segment: Segment) -> None:
+        try:
+            while downloader.error is None:
+                try:
+                    await self.loop.run_in_executor(self.executor, downloader.download_segment, segment)
+                except Exception as e:
+                    if not downloader.is_retryable(e):
+                        downloader.fail(e)
+                        return
+                    vprint(f'Exception in download: {e}', 5, 'penguin/async', 'error')
+                    await asyncio.sleep(0.5)
+                    continue
+                return
+        finally:
+            self.in_flight.release()
+            downloader.segment_queue.task_done(pool)
+
+
+_async_engine = None
+_async_engine_lock = threading.Lock()
+
+
+def get_async_engine(max_in_flight: int) -> AsyncEngine:
+    'Returns the process-wide async engine, creating it on the first call and raising its limit if needed'
+    global _async_engine
+    with _async_engine_lock:
+        if _async_engine is None:
+            _async_engine = AsyncEngine(max_in_flight=max_in_flight)
+            return _async_engine
+    _async_engine.configure(max_in_flight)
+    return _async_engine
@@ -0,0 +1,127 @@
+import os
+import struct
+import threading
+
+from time import monotonic
+
+# Pool index, segment number, segment size
+RECORD = struct.Struct('<Hiq')
+MAGIC = b'PJ01'
+
+
+class Journal:
+    '''
+    ## Resume journal
+    ### Append-only file with a small record for every completed segment
+        >>> from singularity.downloader.penguin.journal import Journal
+        >>> journal = Journal(path='.../Title.journal', pool_ids=['video0', 'audio0'])
+        >>> journal.completed['video0']
+        {0: 1048576, 1: 1048576, 2: 1048576}
+        >>> journal.append(segment, size=1048576)
+        >>> journal.sync()
+        >>> journal.close()
+
+    Records are buffered and written in batches, when `sync` is called and
+    `sync_interval` seconds passed since the last one. `flush_data` flushes the
+    data of the segments to disk before their records are written and fsynced, so
+    everything in the journal can be trusted on resume, after a power loss too.
+    A crash loses the records of the last batch, those segments are downloaded
+    again. Records are fixed-size, a torn record at the end is ignored. Files
+    written by the post-processing (assembled and decrypted tracks) are not
+    synced, resuming after a power loss during it isn't covered.
+
+    Pools are stored by their index in `pool_ids`, which must be in the same order
+    every time the journal is opened (the order of the saved pools). `completed`
+    are the mappings completed segments are recorded in, `SegmentSizes` of the pools'
+    tables, by default dictionaries
+    '''
+    def __init__(self, path: str, pool_ids: list, sync_interval=1.0, completed=None, flush_data=None):
+        self.path = path
+        self.pool_ids = list(pool_ids)
+        self.pool_indexes = {p: i for i, p in enumerate(self.pool_ids)}
+        self.sync_interval = sync_interval
+        self.flush_data = flush_data
+        # Completed segment numbers and their sizes, per pool
+        self.completed = completed if completed is not None else {p: {} for p in self.pool_ids}
+        self.bytes_completed = 0
+        self.records = 0
+        self._lock = threading.Lock()
+        # Records not written yet
+        self._pending = bytearray()
+        self._last_sync = monotonic()
+        if os.path.exists(self.path):
+            self.replay()
+        else:
+            self.create(self.path, [])
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+
+    def replay(self) -> None:
+        'Rebuilds the completed segments of each pool with a single sequential read'
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'Invalid journal file "{self.path}"')
+        body = memoryview(data)[len(MAGIC):]
+        # Leave out the torn record, if any
+        valid = len(body) - len(body) % RECORD.size
+        for pool_index, number, size in RECORD.iter_unpack(body[:valid]):
+            segments = self.completed[self.pool_ids[pool_index]]
+            if number in segments:
+                continue
+            segments[number] = size
+            self.bytes_completed += size
+            self.records += 1
+        if valid != len(body):
+            # Remove it, otherwise new records would be misaligned
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(MAGIC) + valid)
+
+    def is_done(self, group: str, number: int) -> bool:
+        return number in self.completed[group]
+
+    def append(self, segment, size: int) -> None:
+        with self._lock:
+            if segment.number in self.completed[segment.group]:
+                return
+            self.completed[segment.group][segment.number] = size
+            self.bytes_completed += size
+            self.records += 1
+            self._pending += RECORD.pack(self.pool_indexes[segment.group], segment.number, size)
+
+    def sync(self, force=False) -> None:
+        'Writes appended records to disk, at most once every `sync_interval` seconds'
+        with self._lock:
+            if not self._pending or (not force and monotonic() - self._last_sync < self.sync_interval):
+                return
+            # Segments are committed before their records are appended,
+            # the data of the ones taken is flushed below
+            pending, self._pending = self._pending, bytearray()
+            self._last_sync = monotonic()
+        if self.flush_data is not None:
+            self.flush_data()
+        os.write(self.fd, pending)
+        os.fsync(self.fd)
+
+    def compact(self) -> None:
+        'Rewrites the journal with a single record for each completed segment'
+        self.sync(force=True)
+        with self._lock:
+            os.close(self.fd)
+            records = []
+            for pool_index, pool_id in enumerate(self.pool_ids):
+                records.extend((pool_index, n, size) for n, size in sorted(self.completed[pool_id].items()))
+            self.create(f'{self.path}.tmp', records)
+            os.replace(f'{self.path}.tmp', self.path)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+
+    def close(self) -> None:
+        self.sync(force=True)
+        os.close(self.fd)
+
+    @staticmethod
+    def create(path: str, records: list) -> None:
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(b''.join(RECORD.pack(*r) for r in records))
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,75 @@
+import threading
+
+from collections import OrderedDict
+
+
+class KeyFetch:
+    'Download of a key other threads may be waiting for'
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+
+class KeyCache:
+    '''
+    ## Key cache
+    ### Process-wide cache of HLS decryption keys, by URI
+        >>> from singularity.downloader.penguin.keys import get_key_cache
+        >>> key = get_key_cache().get(segment.key.url, fetch=lambda url: session.get(url).content)
+
+    Keys repeated across segments, pools and items are downloaded once. Threads
+    asking for a key being downloaded wait for it instead of downloading it too,
+    different keys are downloaded at the same time. Failed downloads aren't cached,
+    the threads waiting for one get its error instead of downloading the key again
+    '''
+    def __init__(self, max_keys=4096):
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+    def get(self, uri: str, fetch) -> bytes:
+        'Returns the key of `uri`, calling `fetch(uri)` to download it if not cached'
+        while True:
+            with self._lock:
+                if uri in self.keys:
+                    self.hits += 1
+                    self.keys.move_to_end(uri)
+                    return self.keys[uri]
+                fetching = self._fetching.get(uri)
+                if fetching is None:
+                    self.misses += 1
+                    fetching = self._fetching[uri] = KeyFetch()
+                    break
+            # Downloaded by another thread, try again once it's done
+            fetching.event.wait()
+            if fetching.error is not None:
+                raise fetching.error
+        try:
+            key = fetch(uri)
+            with self._lock:
+                self.keys[uri] = key
+                while len(self.keys) > self.max_keys:
+                    self.keys.popitem(last=False)
+            return key
+        except Exception as e:
+            fetching.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._fetching[uri]
+            fetching.event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'keys': len(self.keys), 'hits': self.hits, 'misses': self.misses}
+
+
+_key_cache = KeyCache()
+
+
+def get_key_cache() -> KeyCache:
+    'Returns the process-wide key cache'
+    return _key_cache
@@ -1,9 +1,28 @@
+from singularity.connections import get_connection_budget
+from singularity.downloader.penguin.sessions import SessionPool
+from singularity.responses import get_response_cache
 from singularity.types.stream import Stream
 
 
 class StreamProtocol:
-    def __init__(self, stream: Stream, options=dict):
+    def __init__(self, stream: Stream, options=dict, session_pool: SessionPool = None):
         self.stream = stream
         self.url = stream.url
         self.segment_pools = []
-        self.options = options
\ No newline at end of file
+        self.options = options
+        # Session pool shared with the downloader, if not specified
+        # a single session pool is created on extract
+        self.session_pool = session_pool
+
+    def create_session_pool(self) -> None:
+        if self.session_pool is None:
+            self.session_pool = SessionPool(size=1, browser=self.browser, retries=self.retries)
+
+    def fetch(self, url: str) -> bytes:
+        'Returns the contents of an url, from the process-wide response cache if it was fetched before'
+        return get_response_cache().get(url, self.request).content
+
+    def request(self, url: str, headers: dict):
+        'Requests an url using a session from the pool'
+        with get_connection_budget().slot(url), self.session_pool.session() as session:
+            return session.get(url, headers=headers)
\ No newline at end of file
@@ -1,112 +1,371 @@
-import cloudscraper
+import math
+import re
+import xmltodict
 
-from requests.adapters import HTTPAdapter
+from itertools import chain
 from urllib.parse import urljoin
 from urllib3.util.retry import Retry
 
 from singularity.config import lang
 from singularity.downloader.penguin.protocols.base import StreamProtocol
+from singularity.downloader.penguin.table import SegmentTable
 from singularity.types.stream import *
-from singularity.utils import vprint, request_xml
+from singularity.utils import get_extension, vprint
+
+# $RepresentationID$, $Number$, $Time$ and $Bandwidth$, with an optional
+# width ($Number%05d$), "$$" is an escaped dollar sign
+TEMPLATE_IDENTIFIER = re.compile(r'\$(RepresentationID|Number|Time|Bandwidth|)(?:%0(\d+)d)?\$')
+
+
+def fill_template(template: str, values: dict) -> str:
+    '''
+    Replaces the identifiers of a SegmentTemplate url
+        >>> fill_template('$RepresentationID$/$Number%05d$.m4s', {'RepresentationID': 'v1', 'Number': 12})
+        'v1/00012.m4s'
+    '''
+    def replace(match) -> str:
+        if not match.group(1):
+            return '$'
+        value = str(values[match.group(1)])
+        return value.zfill(int(match.group(2))) if match.group(2) else value
+    return TEMPLATE_IDENTIFIER.sub(replace, template)
+
+
+def parse_duration(duration: str) -> float:
+    '''
+    Converts an ISO 8601 duration to seconds
+        >>> parse_duration('PT1H2M3.5S')
+        3723.5
+    '''
+    match = re.match(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$', duration)
+    days, hours, minutes, seconds = [float(v) if v else 0 for v in match.groups()]
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
 
 
 class MPEGDASHStream(StreamProtocol):
     SUPPORTED_EXTENSIONS = ('.mpd')
     def open_playlist(self):
-        
+        self.manifest_data = xmltodict.parse(self.fetch(self.url).decode())
+        self.periods = self.manifest_data['MPD']['Period']
+        if type(self.periods) != list:
+            # A single period is parsed as a dict
+            self.periods = [self.periods]
+        self.processed_tracks = {
+            'video': -1,
+            'audio': -1,
+            'unified': -1,
+            'subtitles': -1
+        }
+        # Representations of every track, by period index. Periods (ad breaks,
+        # chapters) are joined, a track is a single pool with a part per period
+        tracks = {}
+        for index, self.period in enumerate(self.periods):
+            for media_type, track_id, representation, adap_set in self.pick_representations():
+                tracks.setdefault((media_type, track_id), {}).setdefault(index, (self.period, adap_set, representation))
+        for (media_type, track_id), parts in tracks.items():
+            parts = [parts[i] for i in sorted(parts)]
+            if len(parts) != len(self.periods):
+                vprint(
+                    f'Track {track_id} is only in {len(parts)} of {len(self.periods)} periods, it won\'t be in sync',
+                    2,
+                    'penguin/dash',
+                    'warning'
+                    )
+            self.get_stream_fragments(parts, track_id, media_type)
+
+    def pick_representations(self) -> list:
+        '''
+        Returns the `(media type, track id, representation, adaptation set)` of the
+        representations to download of the current period, the best video one of all
+        the video adaptation sets and the best audio one of each language
+        '''
         def process_audio_repr(repr: dict):
             if '@audioTrackId' in adap_set:
                 id_entry = adap_set['@audioTrackId']
             elif '@lang' in adap_set:
                 id_entry = adap_set['@lang']
             if id_entry not in audio_bitrate:
-                audio_bitrate[id_entry] = (None, 0)
+                audio_bitrate[id_entry] = (None, 0, None)
             if id_entry not in self.stream.language:
                 self.stream.language[id_entry] = adap_set['@lang']
             if int(repr['@bandwidth']) > int(audio_bitrate[id_entry][1]):
-                audio_bitrate[id_entry] = (repr, int(repr['@bandwidth']))            
-        
-        self.manifest_data = request_xml(self.url)[0]
-        self.processed_tracks = {
-            'video': -1,
-            'audio': -1,
-            'unified': -1,
-            'subtitles': -1
-        }
+                audio_bitrate[id_entry] = (repr, int(repr['@bandwidth']), adap_set)
+
+        picked = []
         resolution_list = []
         audio_bitrate = {}
-        
-        for adap_set in self.manifest_data['MPD']['Period']['AdaptationSet']:
-            if adap_set['@contentType'] == 'video':
+        adaptation_sets = self.period['AdaptationSet']
+        if type(adaptation_sets) != list:
+            adaptation_sets = [adaptation_sets]
+        for adap_set in adaptation_sets:
+            if self.get_content_type(adap_set) == 'video':
                 vprint(lang['penguin']['protocols']['picking_best_stream_0'], 3, 'penguin/dash', 'debug')
-                for repr in adap_set['Representation']:
-                    resolution_list.append((repr, int(repr['@height'])))
-                resolution = min(resolution_list, key=lambda x:abs(x[1]-self.options['resolution']))
-                streams = [s for s in resolution_list if s[1] == resolution[1]]
-                # Pick stream with higher bandwidth
-                if len(streams) > 1:
-                    vprint(lang['penguin']['protocols']['picking_best_stream_1'], 3, 'penguin/dash', 'debug')
-                    bandwidth_values = [int(s[0]['@bandwidth']) for s in streams]
-                    stream = streams[bandwidth_values.index(max(bandwidth_values))][0]
-                else:
-                    stream = streams[0][0]
-                vprint(lang['penguin']['protocols']['selected_stream'] % stream['BaseURL'], 3, 'penguin/dash', 'debug')
-                self.get_stream_fragments(stream, 'video', 'video')
-            elif adap_set['@contentType'] == 'audio':
+                representations = adap_set['Representation']
+                if type(representations) != list:
+                    representations = [representations]
+                for repr in representations:
+                    resolution_list.append((repr, int(repr['@height']), adap_set))
+            elif self.get_content_type(adap_set) == 'audio':
                 vprint(lang['penguin']['protocols']['picking_best_stream_2'], 3, 'penguin/dash', 'debug')
                 if type(adap_set['Representation']) == list:
                     for repr in adap_set['Representation']:
                         process_audio_repr(repr)
                 else:
                     process_audio_repr(adap_set['Representation'])
-        
+
+        if resolution_list:
+            resolution = min(resolution_list, key=lambda x:abs(x[1]-self.options['resolution']))
+            streams = [s for s in resolution_list if s[1] == resolution[1]]
+            # Pick stream with higher bandwidth
+            if len(streams) > 1:
+                vprint(lang['penguin']['protocols']['picking_best_stream_1'], 3, 'penguin/dash', 'debug')
+                bandwidth_values = [int(s[0]['@bandwidth']) for s in streams]
+                stream, _, stream_set = streams[bandwidth_values.index(max(bandwidth_values))]
+            else:
+                stream, _, stream_set = streams[0]
+            vprint(lang['penguin']['protocols']['selected_stream'] % stream.get('BaseURL', stream.get('@id')), 3, 'penguin/dash', 'debug')
+            picked.append(('video', 'video', stream, stream_set))
         for ident, repr in audio_bitrate.items():
-            self.get_stream_fragments(repr[0], ident, 'audio')
-
-    def get_stream_fragments(self, representation: dict, track_id: str, force_type=None):
-        def build_segment_pool(media_type=str):
-            self.processed_tracks[media_type] += 1
-            segments = [
-                # Create a Segment object
-                Segment(
-                    url=self.stream_url,
-                    number=list(representation['SegmentList']['SegmentURL']).index(s),
-                    media_type=media_type,
-                    key=None,
-                    group=f'{media_type}{self.processed_tracks[media_type]}',
-                    init=False,
-                    duration=None,
-                    ext=get_extension(self.stream_url),
-                    mpd_range=s['@mediaRange']
-                    )
-                for s in representation['SegmentList']['SegmentURL']
-                ]
-            seg_pool = SegmentPool(segments, media_type, f'{media_type}{self.processed_tracks[media_type]}', track_id, DASHPool)
-            
-            return seg_pool
-        def create_init_segment(pool: str) -> None:
-            self.segment_pool.segments.append(
-                Segment(
-                    url=self.stream_url,
-                    number=-1,
-                    init=True,
-                    media_type=pool,
-                    key=None,
-                    group=f'{pool}{self.processed_tracks[pool]}',
-                    ext=get_extension(self.stream_url),
-                    duration=None,
-                    mpd_range=representation['SegmentList']['Initialization']['@range']
-                )                
+            picked.append(('audio', ident, repr[0], repr[2]))
+        return picked
+
+    @staticmethod
+    def get_content_type(adaptation_set: dict) -> str:
+        if '@contentType' in adaptation_set:
+            return adaptation_set['@contentType']
+        # "video/mp4"
+        return adaptation_set.get('@mimeType', '').split('/')[0]
+
+    def get_base_url(self, representation: dict, adaptation_set=None) -> str:
+        'Returns the url of a representation, resolving the BaseURLs from the MPD down to it'
+        url = self.url
+        for element in (self.manifest_data['MPD'], self.period, adaptation_set, representation):
+            if not element or 'BaseURL' not in element:
+                continue
+            base_url = element['BaseURL']
+            if type(base_url) == list:
+                base_url = base_url[0]
+            if type(base_url) == dict:
+                # BaseURL with attributes
+                base_url = base_url['#text']
+            url = urljoin(url, base_url)
+        return url
+
+    def get_segment_template(self, representation: dict, adaptation_set=None) -> dict:
+        'Returns the SegmentTemplate of a representation, with the attributes inherited from its parents'
+        template = {}
+        for element in (self.period, adaptation_set, representation):
+            if element and 'SegmentTemplate' in element:
+                template.update(element['SegmentTemplate'])
+        return template or None
+
+    def get_period_duration(self) -> float:
+        'Returns the duration of the current period, raises ValueError if neither the MPD nor its timelines tell it'
+        if '@duration' in self.period:
+            return parse_duration(self.period['@duration'])
+        start = parse_duration(self.period.get('@start', 'PT0S'))
+        index = [i for i, p in enumerate(self.periods) if p is self.period][0]
+        if index + 1 < len(self.periods) and '@start' in self.periods[index + 1]:
+            # Until the next period
+            return parse_duration(self.periods[index + 1]['@start']) - start
+        if '@mediaPresentationDuration' in self.manifest_data['MPD']:
+            return parse_duration(self.manifest_data['MPD']['@mediaPresentationDuration']) - start
+        # Last period of an MPD without a duration, it ends with its segments
+        duration = self.get_timelines_duration()
+        if duration is None:
+            raise ValueError(
+                f'Duration of period {index} is unknown, it has no @duration, the MPD no '
+                '@mediaPresentationDuration and none of its SegmentTimelines ends'
+                )
+        return duration
+
+    def get_timelines_duration(self) -> float:
+        'Returns the duration of the longest SegmentTimeline of the current period, None if none of them ends'
+        durations = []
+        adaptation_sets = self.period.get('AdaptationSet', [])
+        if type(adaptation_sets) != list:
+            adaptation_sets = [adaptation_sets]
+        for adaptation_set in adaptation_sets:
+            representations = adaptation_set.get('Representation', [])
+            if type(representations) != list:
+                representations = [representations]
+            for representation in representations:
+                template = self.get_segment_template(representation, adaptation_set)
+                if template is None or 'SegmentTimeline' not in template:
+                    continue
+                entries = template['SegmentTimeline']['S']
+                if type(entries) != list:
+                    entries = [entries]
+                time = 0
+                for i, s in enumerate(entries):
+                    time = int(s.get('@t', time))
+                    repeat = int(s.get('@r', 0))
+                    if repeat >= 0:
+                        time += int(s['@d']) * (repeat + 1)
+                    elif i + 1 < len(entries) and '@t' in entries[i + 1]:
+                        time = int(entries[i + 1]['@t'])
+                    else:
+                        # Repeated until the end of the period
+                        break
+                else:
+                    offset = int(template.get('@presentationTimeOffset', 0))
+                    durations.append((time - offset) / int(template.get('@timescale', 1)))
+        return max(durations, default=None)
+
+    def get_timeline(self, template: dict) -> list:
+        '''
+        Returns the `(time, duration, count)` runs of segments of a SegmentTemplate,
+        from its SegmentTimeline or, if it doesn't have one, its segment duration
+        '''
+        timescale = int(template.get('@timescale', 1))
+        if 'SegmentTimeline' not in template:
+            duration = int(template['@duration'])
+            return [(0, duration, math.ceil(self.get_period_duration() * timescale / duration))]
+        entries = template['SegmentTimeline']['S']
+        if type(entries) != list:
+            entries = [entries]
+        timeline = []
+        time = 0
+        for i, s in enumerate(entries):
+            time = int(s.get('@t', time))
+            duration = int(s['@d'])
+            repeat = int(s.get('@r', 0))
+            if repeat < 0:
+                # Repeated until the next S element, or the end of the period
+                if i + 1 < len(entries) and '@t' in entries[i + 1]:
+                    end = int(entries[i + 1]['@t'])
+                else:
+                    end = int(template.get('@presentationTimeOffset', 0)) + self.get_period_duration() * timescale
+                repeat = math.ceil((end - time) / duration) - 1
+            timeline.append((time, duration, repeat + 1))
+            time += duration * (repeat + 1)
+        return timeline
+
+    def get_template_segments(self, template: dict, representation: dict, media_type: str, group: str, first_number=0):
+        '''
+        Returns a generator of the media segments of a SegmentTemplate, segments
+        are created as they are consumed, and the amount of segments it yields
+        '''
+        timeline = self.get_timeline(template)
+        timescale = int(template.get('@timescale', 1))
+        start_number = int(template.get('@startNumber', 1))
+        values = {'RepresentationID': representation.get('@id'), 'Bandwidth': representation.get('@bandwidth')}
+        stream_url = self.stream_url
+        directory = urljoin(stream_url, '.')
+        ext = get_extension(fill_template(template['@media'], {**values, 'Number': start_number, 'Time': 0}))
+
+        def segments():
+            number = 0
+            for time, duration, count in timeline:
+                for _ in range(count):
+                    path = fill_template(template['@media'], {**values, 'Number': start_number + number, 'Time': time})
+                    if not path or ':' in path or path[0] in '/.?#':
+                        url = urljoin(stream_url, path)
+                    else:
+                        # Plain relative path, faster than urljoin
+                        url = directory + path
+                    yield Segment(
+                        url=url,
+                        number=first_number + number,
+                        media_type=media_type,
+                        key=None,
+                        group=group,
+                        init=False,
+                        duration=duration / timescale,
+                        ext=ext,
+                        mpd_range=None
+                        )
+                    number += 1
+                    time += duration
+        return (segments(), sum(count for _, _, count in timeline))
+
+    def get_list_segments(self, representation: dict, media_type: str, group: str, first_number=0) -> list:
+        'Returns the media segments of a SegmentList'
+        # Same for every segment
+        ext = get_extension(self.stream_url)
+        segment_urls = representation['SegmentList']['SegmentURL']
+        if type(segment_urls) != list:
+            # A single SegmentURL is parsed as a dict
+            segment_urls = [segment_urls]
+        return [
+            Segment(
+                url=self.stream_url,
+                number=first_number + number,
+                media_type=media_type,
+                key=None,
+                group=group,
+                init=False,
+                duration=None,
+                ext=ext,
+                mpd_range=s['@mediaRange']
+                )
+            for number, s in enumerate(segment_urls)
+            ]
+
+    def get_init_segment(self, representation: dict, template: dict, media_type: str, group: str, number: int) -> Segment:
+        'Returns the initialization segment of a representation, None if it doesn\'t have one'
+        if template is not None:
+            if '@initialization' not in template:
+                return None
+            url = urljoin(self.stream_url, fill_template(template['@initialization'], {
+                'RepresentationID': representation.get('@id'),
+                'Bandwidth': representation.get('@bandwidth')
+                }))
+            mpd_range = None
+        else:
+            if 'Initialization' not in representation['SegmentList']:
+                return None
+            url = self.stream_url
+            mpd_range = representation['SegmentList']['Initialization']['@range']
+        return Segment(
+            url=url,
+            number=number,
+            init=True,
+            media_type=media_type,
+            key=None,
+            group=group,
+            ext=get_extension(url),
+            duration=None,
+            mpd_range=mpd_range
             )
-        self.stream_url = urljoin(self.url, representation['BaseURL'])
-        vprint(lang['penguin']['protocols']['getting_stream'], 3, 'penguin/dash', 'debug')
 
-        if force_type is not None:
-            self.segment_pool = build_segment_pool(force_type)
-            if 'Initialization' in representation['SegmentList']:
-                create_init_segment(pool=force_type)
-            self.segment_pools.append(self.segment_pool)
-            return
+    def get_stream_fragments(self, parts: list, track_id: str, media_type: str):
+        '''
+        Creates the segment pool of a track, from its `(period, adaptation set, representation)`
+        in every period. Media segments are numbered across periods, the initialization
+        segment of each period comes first (numbered -1, -2...)
+        '''
+        self.processed_tracks[media_type] += 1
+        group = f'{media_type}{self.processed_tracks[media_type]}'
+        segments = SegmentTable(group, media_type)
+        media = []
+        count = 0
+        lazy = False
+        for index, (self.period, adaptation_set, representation) in enumerate(parts):
+            self.stream_url = self.get_base_url(representation, adaptation_set)
+            vprint(lang['penguin']['protocols']['getting_stream'], 3, 'penguin/dash', 'debug')
+            template = self.get_segment_template(representation, adaptation_set)
+            init_segment = self.get_init_segment(representation, template, media_type, group, -1 - index)
+            if init_segment is not None:
+                # Needed before decrypting any segment
+                segments.append(init_segment)
+            if template is not None:
+                # Timelines of long titles have many thousands of segments, they
+                # are expanded as they are downloaded
+                period_segments, period_count = self.get_template_segments(template, representation, media_type, group, count)
+                lazy = True
+            else:
+                period_segments = self.get_list_segments(representation, media_type, group, count)
+                period_count = len(period_segments)
+            segments.parts.append(count)
+            media.append(period_segments)
+            count += period_count
+        if lazy:
+            segments.extend_lazily(chain(*media), count)
+        else:
+            segments.extend(chain(*media))
+        self.segment_pool = SegmentPool(segments, media_type, group, track_id, DASHPool)
+        self.segment_pools.append(self.segment_pool)
 
     def extract(self):
         self.retries = Retry(total=30, backoff_factor=1, status_forcelist=[502, 503, 504, 403, 404])
@@ -117,5 +376,6 @@ class MPEGDASHStream(StreamProtocol):
             'desktop': False,
         }
         vprint(lang['penguin']['protocols']['getting_playlist'], 3, module_name='penguin/dash', error_level='debug')
+        self.create_session_pool()
         self.open_playlist()
         return {'segment_pools': self.segment_pools, 'tracks': self.processed_tracks}
@@ -1,19 +1,18 @@
-import cloudscraper
-
 from m3u8 import parse
-from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
 from urllib3.util.retry import Retry
 
 from singularity.config import lang
+from singularity.downloader.penguin import aes
 from singularity.downloader.penguin.protocols.base import StreamProtocol
+from singularity.downloader.penguin.table import SegmentTable
 from singularity.types.stream import *
-from singularity.utils import vprint
+from singularity.utils import get_extension, vprint
 
 class HTTPLiveStream(StreamProtocol):
     SUPPORTED_EXTENSIONS = ('.m3u', '.m3u8')
     def open_playlist(self):
-        self.manifest_data = self.scraper.get(self.url).content
+        self.manifest_data = self.fetch(self.url)
         self.parsed_data = parse(self.manifest_data.decode())
         self.processed_tracks = {
             'video': -1,
@@ -37,60 +36,113 @@ class HTTPLiveStream(StreamProtocol):
                 self.stream = self.streams[self.bandwidth_values.index(max(self.bandwidth_values))][0]
             else:
                 self.stream = self.streams[0][0]
-            vprint(lang['penguin']['protocols']['selected_stream'] % self.stream['BaseURL'], 3, 'penguin/dash', 'debug')
+            vprint(lang['penguin']['protocols']['selected_stream'] % self.stream['uri'], 3, 'penguin/hls', 'debug')
         else:
-            self.stream = self.parsed
+            # Not a variant playlist, the stream is the playlist itself
+            self.stream = {'uri': self.url, 'stream_info': {}}
             
 
+    @staticmethod
+    def get_byterange(byterange: str, offset: int) -> tuple:
+        '''
+        Converts an `EXT-X-BYTERANGE` value (`length[@offset]`) to a range
+        in the `start-end` format used by `Segment.mpd_range`
+        
+        Returns a tuple with the range and the offset of the next sub-range
+        '''
+        length, _, start = byterange.partition('@')
+        start = int(start) if start else offset
+        end = start + int(length) - 1
+        return (f'{start}-{end}', end + 1)
+
+    def get_segment_map(self) -> dict:
+        segment_map = self.parsed_stream.get('segment_map')
+        # Newer m3u8 versions return a list of maps
+        if type(segment_map) == list:
+            segment_map = segment_map[0] if segment_map else None
+        return segment_map
+
     def get_stream_fragments(self, stream=dict, force_type=None):
         def build_segment_pool(media_type=str):
             self.processed_tracks[media_type] += 1
-            seg_pool = SegmentPool()
-            seg_pool.segments = [
-                # Create a Segment object
-                Segment(
-                    url=urljoin(self.stream_url, s['uri']),
-                    number=self.parsed_stream['segments'].index(s),
-                    media_type=media_type,
-                    key=ContentKey(s['key']['uri'], None, s['key']['method']),
-                    group=f'{media_type}{self.processed_tracks[media_type]}',
+            group = f'{media_type}{self.processed_tracks[media_type]}'
+            segments = SegmentTable(group, media_type)
+            byterange_offset = 0
+            # Segments without an explicit IV use their media sequence number
+            media_sequence = self.parsed_stream.get('media_sequence') or 0
+            # Absolute urls and extensions by uri, byte-range segments and keys share them
+            urls = {}
+            directory = urljoin(self.stream_url, '.')
+            def resolve(uri: str) -> tuple:
+                if uri not in urls:
+                    if not uri or ':' in uri or uri[0] in '/.?#':
+                        url = urljoin(self.stream_url, uri)
+                    else:
+                        # Plain relative path, urljoin takes most of the time on huge playlists
+                        url = directory + uri
+                    urls[uri] = (url, get_extension(url))
+                return urls[uri]
+            for number, s in enumerate(self.parsed_stream['segments']):
+                mpd_range = None
+                if s.get('byterange'):
+                    mpd_range, byterange_offset = self.get_byterange(s['byterange'], byterange_offset)
+                url, ext = resolve(s['uri'])
+                key = None
+                if s.get('key') and s['key']['method'] != 'NONE':
+                    key = ContentKey(
+                        resolve(s['key']['uri'])[0] if s['key'].get('uri') else None,
+                        None,
+                        s['key']['method'],
+                        s['key'].get('iv') or aes.sequence_iv(media_sequence + number)
+                        )
+                segments.append(
+                    Segment(
+                        url=url,
+                        number=number,
+                        media_type=media_type,
+                        key=key,
+                        group=group,
+                        duration=s['duration'],
+                        init=False,
+                        ext=ext,
+                        mpd_range=mpd_range
+                        )
                     )
-                for s in self.parsed_stream['segments']
-                ]
-            seg_pool.format = media_type
-            seg_pool.type = M3U8Pool
-            return seg_pool
+            return SegmentPool(segments, media_type, group, stream.get('language'), M3U8Pool, media_sequence)
         def create_init_segment(pool: str) -> None:
+            segment_map = self.get_segment_map()
+            url = urljoin(self.stream_url, segment_map['uri'])
             self.segment_pool.segments.append(
                 Segment(
-                    url=urljoin(self.stream_url, self.parsed_stream['segment_map']['uri']),
+                    url=url,
+                    number=-1,
+                    media_type=pool,
+                    key=None,
+                    group=f'{pool}{self.processed_tracks[pool]}',
+                    duration=None,
                     init=True,
-                    type=pool,
-                    group=f'{pool}{self.processed_tracks[pool]}'
+                    ext=get_extension(url),
+                    mpd_range=self.get_byterange(segment_map['byterange'], 0)[0] if segment_map.get('byterange') else None
                 )                
             )
         self.stream_url = urljoin(self.url, stream['uri'])
         vprint(lang['penguin']['protocols']['getting_stream'], 3, 'penguin/hls', 'debug')
-        self.stream_data = self.scraper.get(self.stream_url).content
+        self.stream_data = self.fetch(self.stream_url)
         self.parsed_stream = parse(self.stream_data.decode())
         # Support for legacy m3u8 playlists
         # (Not having video and audio in different streams)
         if force_type is not None:
             self.segment_pool = build_segment_pool(force_type)
-            if 'segment_map' in self.parsed_stream:
+            if self.get_segment_map():
                 create_init_segment(pool=force_type)
             self.segment_pools.append(self.segment_pool)
             return
 
-        if 'audio' not in stream['stream_info']:
-            self.segment_pool = build_segment_pool('unified')
-            if 'segment_map' in self.parsed_stream:
-                create_init_segment(pool='unified')
-        else:
-            self.segment_pool = build_segment_pool('video')
+        pool_format = 'unified' if 'audio' not in stream['stream_info'] else 'video'
+        self.segment_pool = build_segment_pool(pool_format)
+        if self.get_segment_map():
+            create_init_segment(pool=pool_format)
         self.segment_pools.append(self.segment_pool)
-        if 'segment_map' in self.parsed_stream:
-            create_init_segment(pool='video')    
         for media in self.parsed_data['media']:
             if media['type'] == 'AUDIO':
                 self.get_stream_fragments(media, 'audio')
@@ -98,24 +150,28 @@ class HTTPLiveStream(StreamProtocol):
                 if '.m3u' in media['uri']:
                     self.get_stream_fragments(media, 'subtitles')
                 else:
-                    contents = self.scraper.get(urljoin(self.url, media['uri'])).content
+                    contents = self.fetch(urljoin(self.url, media['uri']))
                     # Fuck whoever thought it was a good idea to disguise m3u8 playlists as .vtt subtitles
                     if b'#EXTM3U' in contents:
                         self.get_stream_fragments(media, 'subtitles')
                         continue
                     self.processed_tracks['subtitles'] += 1
+                    group = f'subtitles{self.processed_tracks["subtitles"]}'
+                    url = urljoin(self.url, media['uri'])
                     subtitles = Segment(
-                        url=urljoin(self.url, media['uri']),
+                        url=url,
                         number=0,
-                        type='subtitles',
-                        group=f'subtitles{self.processed_tracks["subtitles"]}',
+                        media_type='subtitles',
+                        key=None,
+                        group=group,
+                        duration=None,
+                        init=False,
+                        ext=get_extension(url),
+                        mpd_range=None
                     )
-                    subtitle_pool = SegmentPool()
-                    subtitle_pool.segments = [subtitles]
-                    subtitle_pool.format = 'subtitles'
-                    subtitle_pool.id = f'subtitles{self.processed_tracks["subtitles"]}'
-                    
-                    self.segment_pools.append(self.subtitle_set)    
+                    subtitle_pool = SegmentPool(SegmentTable(group, 'subtitles'), 'subtitles', group, media.get('language'), None)
+                    subtitle_pool.segments.append(subtitles)
+                    self.segment_pools.append(subtitle_pool)
 
     def extract(self):
         self.retries = Retry(total=30, backoff_factor=1, status_forcelist=[502, 503, 504, 403, 404])
@@ -126,8 +182,7 @@ class HTTPLiveStream(StreamProtocol):
             'desktop': False,
         }
         vprint(lang['penguin']['protocols']['getting_playlist'], 3, module_name='penguin/hls', error_level='debug')
-        self.scraper = cloudscraper.create_scraper(browser=self.browser)
-        self.scraper.mount('https://', HTTPAdapter(max_retries=self.retries))
+        self.create_session_pool()
         self.open_playlist()
         self.get_stream_fragments(self.stream)
         return {'segment_pools': self.segment_pools, 'tracks': self.processed_tracks}
@@ -0,0 +1,96 @@
+from dataclasses import dataclass
+
+
+class ResponseError(IOError):
+    'The server answered with something else than what was requested, retried like network errors'
+
+
+@dataclass
+class RangeRequest:
+    '''
+    A single range request covering several contiguous segments of the same url,
+    segments are in ascending order and their ranges have no gaps between them
+    '''
+    url: str
+    start: int
+    end: int
+    segments: list
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start + 1
+
+    # Allows range requests to be logged like segments, "video0_10-25"
+    @property
+    def group(self) -> str:
+        return self.segments[0].group
+
+    @property
+    def number(self) -> str:
+        return f'{self.segments[0].number}-{self.segments[-1].number}'
+
+
+def parse_range(value: str) -> tuple:
+    'Converts a `start-end` range to a tuple of integers'
+    start, end = value.split('-')
+    return (int(start), int(end))
+
+
+def is_encoded(response) -> bool:
+    'Returns True if the body of a response is compressed'
+    return response.headers.get('content-encoding', 'identity') != 'identity'
+
+
+def response_length(response, requested=None):
+    '''
+    Returns the length of a response body from its Content-Length, raising a ResponseError
+    if it doesn't match the `requested` length. `requested` is returned when unknown
+    '''
+    if is_encoded(response):
+        # Content-Length is the size of the encoded body
+        return requested
+    length = response.headers.get('content-length')
+    if length is None:
+        return requested
+    if requested is not None and int(length) != requested:
+        raise ResponseError(f'Expected {requested} bytes, the server is sending {length}')
+    return int(length)
+
+
+def plan_range_requests(segments: list, chunk_size: int) -> list:
+    '''
+    Merges segments with contiguous byte ranges of the same url into `RangeRequest`s
+    of up to `chunk_size` bytes. Segments without a range, initialization segments
+    and segments that couldn't be merged with any other are returned as they are
+        >>> plan_range_requests([<0-99>, <100-199>, <200-299>, <no range>], 250)
+        [RangeRequest(0-199), <200-299>, <no range>]
+    '''
+    planned = []
+    group = []
+
+    def flush():
+        if len(group) > 1:
+            planned.append(RangeRequest(
+                url=group[0].url,
+                start=parse_range(group[0].mpd_range)[0],
+                end=parse_range(group[-1].mpd_range)[1],
+                segments=list(group),
+            ))
+        else:
+            planned.extend(group)
+        group.clear()
+
+    for segment in segments:
+        if segment.mpd_range is None or segment.init:
+            flush()
+            planned.append(segment)
+            continue
+        if group:
+            start, end = parse_range(segment.mpd_range)
+            group_start = parse_range(group[0].mpd_range)[0]
+            group_end = parse_range(group[-1].mpd_range)[1]
+            if segment.url != group[0].url or start != group_end + 1 or end - group_start + 1 > chunk_size:
+                flush()
+        group.append(segment)
+    flush()
+    return planned
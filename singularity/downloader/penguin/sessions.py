@@ -0,0 +1,75 @@
+import cloudscraper
+import threading
+
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class SessionPool:
+    '''
+    ## Session pool
+    ### Keeps a bounded amount of cloudscraper sessions alive, so requests reuse
+    ### already open (keep-alive) connections instead of doing a new handshake
+        >>> from singularity.downloader.penguin.sessions import SessionPool
+        >>> pool = SessionPool(size=10, browser={...}, retries=Retry(...))
+        >>> with pool.session() as session:
+        >>>     session.get(...)
+        >>> pool.close()
+    '''
+    def __init__(self, size: int, browser: dict, retries: Retry):
+        self.size = max(1, size)
+        self.browser = browser
+        self.retries = retries
+        # Last released session is the first one given, that way
+        # the "hottest" connections are the ones being reused
+        self._idle = LifoQueue()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def create_session(self) -> cloudscraper.CloudScraper:
+        session = cloudscraper.create_scraper(browser=self.browser)
+        # A session is only used by a thread at a time, so a connection
+        # per host is enough
+        adapter = HTTPAdapter(max_retries=self.retries, pool_maxsize=1)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def acquire(self) -> cloudscraper.CloudScraper:
+        'Returns an idle session, creating it if the pool is not full yet'
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if len(self._sessions) < self.size:
+                session = self.create_session()
+                self._sessions.append(session)
+                return session
+        # Pool is full, wait until a session is released
+        return self._idle.get()
+
+    def release(self, session: cloudscraper.CloudScraper) -> None:
+        self._idle.put(session)
+
+    @contextmanager
+    def session(self):
+        'Borrows a session from the pool, giving it back when done'
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
+        while True:
+            try:
+                self._idle.get_nowait()
+            except Empty:
+                break
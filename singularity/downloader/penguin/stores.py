@@ -0,0 +1,501 @@
+import os
+import threading
+
+from singularity.downloader.penguin.concat import concat_files
+from singularity.downloader.penguin.tracks import TrackFile, supports_sparse
+from singularity.types.stream import Segment, SegmentPool
+
+
+class SegmentStore:
+    '''
+    ## Segment store
+    ### Keeps the segments of a pool from their download until muxing
+        >>> store = FileStore(pool, directory='.../Title (1)')
+        >>> with store.open(segment, offset=0) as output:
+        >>>     output.write(data)
+        >>> store.commit(segment, size)
+        # DASH pools are assembled into a single track file
+        >>> store.assemble('.../video0.mp4', segments)
+        # HLS pools are referenced by a playlist, (file name, offset, size)
+        >>> store.locate(segment)
+        ('video0_1.ts', None, None)
+
+    `offset` is the amount of bytes of the segment kept from a previous, failed,
+    attempt, data written goes after them. Stores are used by several segment
+    downloaders at the same time, but a segment is only written by one of them
+    '''
+    # Committed segments are on disk, segments of non-durable stores are
+    # recorded as downloaded once the pool is assembled or persisted
+    durable = True
+
+    def __init__(self, pool: SegmentPool, directory: str, sizes=None):
+        self.pool_id = pool.id
+        self.directory = directory
+        # Sizes of the committed segments, including ones from previous runs,
+        # a dictionary or the `SegmentSizes` of the pool's table
+        self.sizes = sizes.copy() if sizes is not None else {}
+
+    def open(self, segment: Segment, offset=0):
+        'Returns a binary file-like object writing the segment data after `offset`'
+        raise NotImplementedError
+
+    def read(self, segment: Segment) -> bytearray:
+        'Returns the data of a segment, committed or not'
+        raise NotImplementedError
+
+    def overwrite(self, segment: Segment, data) -> None:
+        'Replaces the data of a segment with data of the same size'
+        raise NotImplementedError
+
+    def commit(self, segment: Segment, size: int) -> bool:
+        'Marks a segment as complete, returns True if its data is on disk'
+        self.sizes[segment.number] = size
+        return True
+
+    def partial_size(self, segment: Segment) -> int:
+        'Returns the bytes of a segment received on previous, failed, attempts'
+        return 0
+
+    def discard(self, segment: Segment) -> None:
+        'Discards the partially received data of a segment'
+
+    def contains(self, segment: Segment) -> bool:
+        'Returns True if a non-durable store has the segment complete'
+        return False
+
+    def available(self, segment: Segment) -> bool:
+        'Returns True if the data of a segment can be read, it isn\'t once assembled'
+        raise NotImplementedError
+
+    def position(self, segment: Segment):
+        'Returns the offset of a segment in the pool file, None if segments are not in a single file'
+        return None
+
+    def write_at(self, position: int, buffers: list) -> None:
+        'Writes contiguous segments of the pool file at once'
+        raise NotImplementedError
+
+    def assemble(self, output_path: str, segments: list, progress=None) -> int:
+        'Writes `segments`, in order, to a single track file. Returns the bytes written'
+        raise NotImplementedError
+
+    def persist(self) -> None:
+        'Writes segments kept in memory to disk, for pools that are not assembled'
+
+    def sync(self) -> None:
+        'Flushes the data of the committed segments to disk, before the journal records them'
+
+    def locate(self, segment: Segment) -> tuple:
+        'Returns the file name, offset and size of a committed segment, offset and size are None for whole files'
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class FileStore(SegmentStore):
+    '''
+    One file per segment, `{pool}_{number}{ext}`, written to a .part file
+    renamed once complete
+    '''
+    def __init__(self, pool: SegmentPool, directory: str, sizes=None):
+        super().__init__(pool, directory, sizes)
+        # Committed since the last sync
+        self.unsynced = []
+        self._lock = threading.Lock()
+
+    def path(self, segment: Segment) -> str:
+        return f'{self.directory}/{segment.group}_{segment.number}{segment.ext}'
+
+    def open(self, segment: Segment, offset=0):
+        output = open(f'{self.path(segment)}.part', 'ab' if offset else 'wb')
+        output.truncate(offset)
+        return output
+
+    def read(self, segment: Segment) -> bytearray:
+        path = self.path(segment)
+        with open(path if os.path.exists(path) else f'{path}.part', 'rb') as f:
+            return bytearray(f.read())
+
+    def overwrite(self, segment: Segment, data) -> None:
+        path = self.path(segment)
+        with open(path if os.path.exists(path) else f'{path}.part', 'r+b') as f:
+            f.write(data)
+
+    def commit(self, segment: Segment, size: int) -> bool:
+        os.replace(f'{self.path(segment)}.part', self.path(segment))
+        with self._lock:
+            self.unsynced.append(self.path(segment))
+        return super().commit(segment, size)
+
+    def partial_size(self, segment: Segment) -> int:
+        try:
+            return os.path.getsize(f'{self.path(segment)}.part')
+        except FileNotFoundError:
+            return 0
+
+    def discard(self, segment: Segment) -> None:
+        if os.path.exists(f'{self.path(segment)}.part'):
+            os.remove(f'{self.path(segment)}.part')
+
+    def available(self, segment: Segment) -> bool:
+        return os.path.exists(self.path(segment)) or os.path.exists(f'{self.path(segment)}.part')
+
+    def assemble(self, output_path: str, segments: list, progress=None) -> int:
+        # Segments are deleted once appended, allowing to resume the concat
+        return concat_files(output_path, [self.path(s) for s in segments], progress=progress)
+
+    def locate(self, segment: Segment) -> tuple:
+        return (os.path.basename(self.path(segment)), None, None)
+
+    def sync(self) -> None:
+        with self._lock:
+            paths, self.unsynced = self.unsynced, []
+        if not paths:
+            return
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            except FileNotFoundError:
+                # Already assembled
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if os.name != 'nt':
+            # The renames
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class SlotOutput:
+    'Sequential writes of a segment into its range of a track file'
+    def __init__(self, store, segment: Segment, offset: int):
+        self.store = store
+        self.segment = segment
+        self.written = offset
+
+    def write(self, data) -> int:
+        capacity = self.store.track.sizes[self.segment.number]
+        if self.written + len(data) > capacity:
+            raise IOError(
+                f'Segment {self.segment.group}_{self.segment.number} is bigger than its {capacity} bytes range'
+                )
+        self.store.track.write(self.segment, self.written, data)
+        self.written += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        # Kept to continue from here if the segment is not committed
+        self.store.partial[self.segment.number] = self.written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SparseStore(SegmentStore):
+    '''
+    A single file per pool, for pools of byte-range segments, each one written at
+    its offset of the file. Given a `track_path` the file is the assembled track,
+    for HLS pools the playlist references it with byte ranges
+    '''
+    def __init__(self, pool: SegmentPool, directory: str, sizes=None, track_path=None):
+        super().__init__(pool, directory, sizes)
+        self.path = track_path if track_path else f'{directory}/{pool.id}.sparse'
+        self.segments = pool.segments
+        self.partial = {}
+        self._track = None
+        self._lock = threading.Lock()
+        # Held while syncing, writers opening the track don't wait for it
+        self._sync_lock = threading.Lock()
+
+    @staticmethod
+    def supports(pool: SegmentPool, directory: str) -> bool:
+        'Returns True if the pool can be stored in a single file of `directory`'
+        if not TrackFile.supports(pool.segments):
+            # Offsets come from the segment sizes
+            return False
+        if pool.segments.expanding:
+            # Offsets are laid out from all the segments
+            return False
+        if len(pool.segments.parts) > 1:
+            # Periods are assembled one by one, out of the same file
+            return False
+        # Segments are written out of order, without holes every write past
+        # the end of the file would fill the space before it
+        return supports_sparse(directory)
+
+    @property
+    def track(self) -> TrackFile:
+        # Opened on first use, a pool assembled on a previous run isn't created again
+        with self._lock:
+            if self._track is None:
+                self._track = TrackFile(self.path, self.segments)
+            return self._track
+
+    def open(self, segment: Segment, offset=0) -> SlotOutput:
+        return SlotOutput(self, segment, offset)
+
+    def read(self, segment: Segment) -> bytearray:
+        size = self.sizes.get(segment.number, self.partial.get(segment.number))
+        return self.track.read(segment, size)
+
+    def overwrite(self, segment: Segment, data) -> None:
+        self.track.write(segment, 0, data)
+
+    def commit(self, segment: Segment, size: int) -> bool:
+        self.partial.pop(segment.number, None)
+        return super().commit(segment, size)
+
+    def partial_size(self, segment: Segment) -> int:
+        return self.partial.get(segment.number, 0)
+
+    def discard(self, segment: Segment) -> None:
+        self.partial.pop(segment.number, None)
+
+    def available(self, segment: Segment) -> bool:
+        return os.path.exists(self.path)
+
+    def position(self, segment: Segment) -> int:
+        return self.track.offsets[segment.number]
+
+    def write_at(self, position: int, buffers: list) -> None:
+        self.track.write_at(position, buffers)
+
+    def assemble(self, output_path: str, segments: list, progress=None) -> int:
+        # Already assembled
+        self.close()
+        if progress is not None:
+            progress.update(len(segments))
+        return os.path.getsize(self.path)
+
+    def locate(self, segment: Segment) -> tuple:
+        return (os.path.basename(self.path), self.track.offsets[segment.number], self.sizes[segment.number])
+
+    def sync(self) -> None:
+        with self._sync_lock:
+            if self._track is not None:
+                self._track.sync()
+
+    def close(self) -> None:
+        with self._sync_lock, self._lock:
+            if self._track is not None:
+                self._track.close()
+                self._track = None
+
+
+class MemoryBudget:
+    'Bytes of memory the in-memory stores of an item may take'
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self, amount: int) -> bool:
+        with self._lock:
+            if self.used + amount > self.limit:
+                return False
+            self.used += amount
+            return True
+
+    def release(self, amount: int) -> None:
+        with self._lock:
+            self.used -= amount
+
+
+class MemoryOutput:
+    'Writes of a segment into memory, moving it to the fallback store if the budget runs out'
+    def __init__(self, store, segment: Segment, offset: int):
+        self.store = store
+        self.segment = segment
+        self.output = None
+        data = store.data.setdefault(segment.number, bytearray())
+        store.budget.release(len(data) - offset)
+        del data[offset:]
+
+    def write(self, data) -> int:
+        if self.output is None and not self.store.budget.take(len(data)):
+            self.output = self.store.spill(self.segment)
+        if self.output is not None:
+            return self.output.write(data)
+        self.store.data[self.segment.number] += data
+        return len(data)
+
+    def close(self) -> None:
+        if self.output is not None:
+            self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MemoryStore(SegmentStore):
+    '''
+    Segments kept in memory until the pool is assembled (or persisted, for HLS),
+    the memory is limited by a budget shared by the pools of the item and segments
+    that don't fit go to a `FileStore`. Segments in memory are lost if the download
+    is interrupted, they are recorded as downloaded once written to disk
+    '''
+    durable = False
+
+    def __init__(self, pool: SegmentPool, directory: str, sizes=None, budget=None):
+        super().__init__(pool, directory, sizes)
+        self.budget = budget if budget is not None else MemoryBudget(268435456)
+        self.fallback = FileStore(pool, directory, sizes)
+        self.segments = pool.segments
+        self.data = {}
+        self.committed = set()
+        # Segments of previous runs are on disk, in their own files (spilled)
+        # or in the persisted file
+        self.spilled = {n for n in self.sizes if os.path.exists(self.fallback.path(self.segments.get(n)))}
+        self.persisted_path = f'{directory}/{pool.id}.segments'
+        self.offsets = None
+
+    def spill(self, segment: Segment):
+        'Moves a segment being written to the fallback store, returns its output there'
+        data = self.data.pop(segment.number, bytearray())
+        self.budget.release(len(data))
+        self.spilled.add(segment.number)
+        output = self.fallback.open(segment)
+        output.write(data)
+        return output
+
+    def open(self, segment: Segment, offset=0):
+        if segment.number in self.spilled:
+            return self.fallback.open(segment, offset)
+        return MemoryOutput(self, segment, offset)
+
+    def read(self, segment: Segment) -> bytearray:
+        if segment.number in self.spilled:
+            return self.fallback.read(segment)
+        return bytearray(self.data[segment.number])
+
+    def overwrite(self, segment: Segment, data) -> None:
+        if segment.number in self.spilled:
+            return self.fallback.overwrite(segment, data)
+        self.data[segment.number][:] = data
+
+    def commit(self, segment: Segment, size: int) -> bool:
+        super().commit(segment, size)
+        if segment.number in self.spilled:
+            return self.fallback.commit(segment, size)
+        self.committed.add(segment.number)
+        return False
+
+    def partial_size(self, segment: Segment) -> int:
+        if segment.number in self.spilled:
+            return self.fallback.partial_size(segment)
+        return len(self.data.get(segment.number, b''))
+
+    def discard(self, segment: Segment) -> None:
+        if segment.number in self.spilled:
+            return self.fallback.discard(segment)
+        self.budget.release(len(self.data.pop(segment.number, b'')))
+
+    def contains(self, segment: Segment) -> bool:
+        return segment.number in self.committed
+
+    def available(self, segment: Segment) -> bool:
+        if segment.number in self.spilled:
+            return self.fallback.available(segment)
+        return segment.number in self.data
+
+    def write_segments(self, output, segments: list, progress=None) -> int:
+        'Writes segments from memory, or from their files, to an open file and frees them'
+        written = 0
+        for segment in segments:
+            if segment.number in self.committed and segment.number in self.data:
+                data = self.data.pop(segment.number)
+                self.budget.release(len(data))
+            elif os.path.exists(self.fallback.path(segment)):
+                with open(self.fallback.path(segment), 'rb') as f:
+                    data = f.read()
+            else:
+                data = b''
+            output.write(data)
+            written += len(data)
+            if progress is not None:
+                progress.update(1)
+        return written
+
+    def assemble(self, output_path: str, segments: list, progress=None) -> int:
+        if not self.data and os.path.exists(output_path) and \
+           not any(os.path.exists(self.fallback.path(s)) for s in segments):
+            # Assembled on a previous run
+            return 0
+        with open(output_path, 'wb') as output:
+            written = self.write_segments(output, segments, progress)
+            # Segments from memory are recorded once assembled
+            output.flush()
+            os.fsync(output.fileno())
+        for segment in segments:
+            if os.path.exists(self.fallback.path(segment)):
+                os.remove(self.fallback.path(segment))
+        return written
+
+    def layout(self, exclude=()) -> dict:
+        'Returns the offsets of the segments in the persisted file, in segment order'
+        offsets = {}
+        offset = 0
+        for number in sorted(self.sizes):
+            if number in self.spilled or number in exclude:
+                continue
+            offsets[number] = offset
+            offset += self.sizes[number]
+        return offsets
+
+    def persist(self) -> None:
+        self.offsets = self.layout()
+        if not self.data:
+            return
+        # Segments persisted on previous runs are copied to the new file
+        previous = self.layout(exclude=self.committed)
+        persisted = open(self.persisted_path, 'rb') if previous else None
+        try:
+            with open(f'{self.persisted_path}.part', 'wb') as output:
+                for number in self.offsets:
+                    if number in previous:
+                        persisted.seek(previous[number])
+                        output.write(persisted.read(self.sizes[number]))
+                    else:
+                        self.write_segments(output, [self.segments.get(number)])
+                output.flush()
+                os.fsync(output.fileno())
+        finally:
+            if persisted is not None:
+                persisted.close()
+        os.replace(f'{self.persisted_path}.part', self.persisted_path)
+
+    def locate(self, segment: Segment) -> tuple:
+        if segment.number in self.spilled:
+            return self.fallback.locate(segment)
+        if self.offsets is None:
+            self.offsets = self.layout()
+        return (os.path.basename(self.persisted_path), self.offsets[segment.number], self.sizes[segment.number])
+
+    def sync(self) -> None:
+        self.fallback.sync()
+
+
+def create_store(kind: str, pool: SegmentPool, directory: str, sizes=None, track_path=None, **kwargs) -> SegmentStore:
+    '''
+    Returns the store of a pool, `kind` being "files", "sparse" or "memory". Stores
+    not supported by the pool, or by the system, fall back to files
+        >>> create_store('sparse', pool, '.../Title (1)', sizes={0: 1048576}, track_path='.../video0.mp4')
+        <SparseStore>
+    '''
+    if kind == 'sparse' and SparseStore.supports(pool, directory):
+        return SparseStore(pool, directory, sizes, track_path=track_path)
+    if kind == 'memory':
+        return MemoryStore(pool, directory, sizes, budget=kwargs.get('budget'))
+    return FileStore(pool, directory, sizes)
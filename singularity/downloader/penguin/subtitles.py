@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree.ElementTree import XMLParser
+
+# Subtitle formats converted after downloading
+SUBTITLE_EXTENSIONS = ('.vtt', '.ttml2')
+
+# Bytes of subtitles worth starting a process pool for, workers take about a
+# second to start and a second converts several megabytes in-process
+POOL_MIN_BYTES = 16777216
+
+# Workarounds for Atresplayer subtitles, italic characters are (#) characters
+VTT_ITALIC_START = re.compile(rb'^# ', re.MULTILINE)
+VTT_ITALIC_END = re.compile(rb' #$', re.MULTILINE)
+
+CLOCK_TIME = re.compile(r'^(\d+):(\d{2}):(\d{2}(?:\.\d+)?)(?::(\d+(?:\.\d+)?))?$')
+OFFSET_TIME = re.compile(r'^(\d+(?:\.\d+)?)(h|ms|m|s|f|t)$')
+OFFSET_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+TTP_NAMESPACE = '{http://www.w3.org/ns/ttml#parameter}'
+
+
+def parse_ttml_time(value: str, tick_rate=1.0, frame_rate=30.0) -> float:
+    'Returns a TTML time expression (clock time or offset time) in seconds'
+    match = CLOCK_TIME.match(value)
+    if match:
+        hours, minutes, seconds, frames = match.groups()
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds) + float(frames or 0) / frame_rate
+    match = OFFSET_TIME.match(value)
+    if match is None:
+        raise ValueError(f'Invalid TTML time "{value}"')
+    amount, unit = float(match.group(1)), match.group(2)
+    if unit == 't':
+        return amount / tick_rate
+    if unit == 'f':
+        return amount / frame_rate
+    return amount * OFFSET_UNITS[unit]
+
+
+def format_srt_time(seconds: float) -> str:
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}'
+
+
+def srt_time(value: str, tick_rate=1.0, frame_rate=30.0) -> str:
+    'Returns a TTML time expression as a SubRip timestamp'
+    if len(value) == 12 and value[8] == '.' and value[2] == value[5] == ':':
+        # Already HH:MM:SS.mmm, the most common form
+        return f'{value[:8]},{value[9:]}'
+    return format_srt_time(parse_ttml_time(value, tick_rate, frame_rate))
+
+
+def fix_vtt(contents: bytes) -> bytes:
+    'Applies the Atresplayer WebVTT fixes'
+    contents = VTT_ITALIC_START.sub(b'<i>', contents)
+    contents = VTT_ITALIC_END.sub(b'</i>', contents)
+    # Fix apostrophes
+    return contents.replace(b'&apos;', b'\'')
+
+
+class SubRipTarget:
+    '''
+    XML parser target that writes TTML2 paragraphs as SubRip entries as they are
+    parsed, no element tree is built. <span> tags are flattened and <br> become line breaks
+    '''
+    def __init__(self):
+        self.entries = []
+        self.tick_rate = 1.0
+        self.frame_rate = 30.0
+        # Text of the paragraph being parsed, None outside paragraphs
+        self.parts = None
+        self.begin_time = self.end_time = None
+
+    def start(self, tag: str, attrib: dict) -> None:
+        name = tag.rsplit('}', 1)[-1]
+        if name == 'p':
+            self.parts = []
+            self.begin_time = attrib.get('begin')
+            self.end_time = attrib.get('end')
+        elif name == 'br':
+            if self.parts is not None:
+                self.parts.append('\n')
+        elif name == 'tt':
+            self.tick_rate = float(attrib.get(f'{TTP_NAMESPACE}tickRate', self.tick_rate))
+            self.frame_rate = float(attrib.get(f'{TTP_NAMESPACE}frameRate', self.frame_rate))
+
+    def data(self, text: str) -> None:
+        if self.parts is not None:
+            self.parts.append(text)
+
+    def end(self, tag: str) -> None:
+        if self.parts is None or tag.rsplit('}', 1)[-1] != 'p':
+            return
+        if self.begin_time is not None and self.end_time is not None:
+            lines = [line.strip() for line in ''.join(self.parts).replace('>', '').split('\n')]
+            self.entries.append(
+                f'{len(self.entries) + 1}\n'
+                f'{srt_time(self.begin_time, self.tick_rate, self.frame_rate)} --> '
+                f'{srt_time(self.end_time, self.tick_rate, self.frame_rate)}\n'
+                f'{chr(10).join(l for l in lines if l)}\n\n'
+                )
+        self.parts = None
+
+    def close(self) -> bytes:
+        return ''.join(self.entries).encode()
+
+
+def ttml_to_srt(source) -> bytes:
+    '''
+    Converts a TTML2 document (a path or a binary file object) to SubRip,
+    the document is parsed as a stream, in chunks of 64 KiB
+    '''
+    parser = XMLParser(target=SubRipTarget())
+    f = open(source, 'rb') if isinstance(source, str) else source
+    try:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    finally:
+        if f is not source:
+            f.close()
+    return parser.close()
+
+
+def convert_subtitle(path: str) -> str:
+    '''
+    Converts a downloaded subtitle file, returns the path of the converted file.
+    WebVTT files are fixed in place, TTML2 files are replaced by a SubRip file.
+    Converting an already converted file does nothing
+    '''
+    if path.endswith('.vtt'):
+        with open(path, 'rb') as f:
+            contents = f.read()
+        fixed = fix_vtt(contents)
+        if fixed != contents:
+            with open(f'{path}.part', 'wb') as f:
+                f.write(fixed)
+            os.replace(f'{path}.part', path)
+        return path
+    if path.endswith('.ttml2'):
+        output_path = path[:-len('.ttml2')] + '.srt'
+        if not os.path.exists(path):
+            # Already converted
+            return output_path
+        with open(path, 'rb') as f:
+            contents = ttml_to_srt(f)
+        with open(f'{output_path}.part', 'wb') as f:
+            f.write(contents)
+        os.replace(f'{output_path}.part', output_path)
+        os.remove(path)
+        return output_path
+    return path
+
+
+def convert_subtitles(paths: list, processes=0) -> list:
+    '''
+    Converts several subtitle files, in-process unless they add up to `POOL_MIN_BYTES`
+    and `processes` allows a pool of up to that many workers. Returns the paths of
+    the converted files
+        >>> convert_subtitles(['.../subtitles0_0.ttml2', '.../subtitles1_0.ttml2'])
+        ['.../subtitles0_0.srt', '.../subtitles1_0.srt']
+    '''
+    processes = min(processes, len(paths), os.cpu_count() or 1)
+    if processes < 2 or \
+       sum(os.path.getsize(p) for p in paths if os.path.exists(p)) < POOL_MIN_BYTES:
+        return [convert_subtitle(p) for p in paths]
+    # Not forked, a fork would copy the downloader's threads and locks mid-download
+    context = multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        )
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        return list(executor.map(convert_subtitle, paths))
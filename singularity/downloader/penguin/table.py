@@ -0,0 +1,431 @@
+import mmap
+import os
+import pickle
+import struct
+import threading
+
+from array import array
+
+from singularity.types.stream import ContentKey, Segment, SegmentPool
+
+# Array type code of every column
+COLUMNS = {
+    # Segment numbers
+    'numbers': 'q',
+    # Url of each segment, an index of `strings` (up to the last slash)
+    # followed by the segment's name in `names`, ending at `name_ends`
+    'bases': 'i',
+    'names': 'B',
+    'name_ends': 'q',
+    'exts': 'i',
+    # Index of `keys`, -1 for unencrypted segments
+    'keys': 'i',
+    # Sequence numbers used as AES-128 IVs, -1 if the key has its own IV
+    'ivs': 'q',
+    # Byte ranges, -1 for segments without one
+    'range_starts': 'q',
+    'range_ends': 'q',
+    # NaN for segments without a duration
+    'durations': 'd',
+    'inits': 'B',
+    }
+MAGIC = b'PT01'
+HEADER = struct.Struct('<Q')
+NO_DURATION = float('nan')
+
+
+class SegmentTable:
+    '''
+    ## Segment table
+    ### Compact, array-backed list of the segments of a pool
+        >>> from singularity.downloader.penguin.table import SegmentTable
+        >>> table = SegmentTable()
+        >>> table.append(Segment(url='https://.../video/0.ts', number=0, ...))
+        >>> table[0]
+        Segment(url='https://.../video/0.ts', number=0, ...)
+        >>> table.row(number=0)
+        0
+
+    Segments are stored in columns, urls split into a base shared by all the segments
+    of the same directory and their name. Items are `Segment` objects created when
+    accessed, changes to them are not stored. Every segment of a table has the same
+    group and media type, the ones of the table.
+
+    Tables of multi-period manifests have a part per period, `parts` are the
+    numbers of their first media segment, the initialization segment of each
+    part comes before all the media ones, numbered -1, -2...
+
+    Segments can be appended lazily, from a generator, with `extend_lazily`. The table
+    grows as `expand` is called, by the work queue when it runs out of segments to
+    give and by the downloader in the background. Rows are complete once counted
+    by `len`, tables can be read while they grow.
+
+    Tables loaded from a pools file (`SavedPools`) are mapped from it, not read
+    into memory, and can't be changed
+    '''
+    def __init__(self, group=None, media_type=None):
+        self.group = group
+        self.media_type = media_type
+        self.strings = []
+        self.keys = []
+        self.columns = {name: array(code) if code != 'B' else bytearray() for name, code in COLUMNS.items()}
+        self.read_only = False
+        self.parts = []
+        # Initialization segments before the first media one
+        self.leading = 0
+        # Segments left to append, and the length of the table once they are
+        self.source = None
+        self.expected = None
+        self._expand_lock = threading.Lock()
+        self._string_indexes = {}
+        self._key_indexes = {}
+        # Rows of the segments whose number is not their row
+        self._rows = None
+
+    def __len__(self) -> int:
+        return len(self.columns['numbers'])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index: int) -> Segment:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Segment table index out of range')
+        columns = self.columns
+        start = columns['range_starts'][index]
+        duration = columns['durations'][index]
+        return Segment(
+            url=self.strings[columns['bases'][index]] + self.name(index),
+            number=columns['numbers'][index],
+            media_type=self.media_type,
+            key=self.key(index),
+            group=self.group,
+            duration=duration if duration == duration else None,
+            init=bool(columns['inits'][index]),
+            ext=self.strings[columns['exts'][index]],
+            mpd_range=f'{start}-{columns["range_ends"][index]}' if start >= 0 else None
+            )
+
+    def name(self, index: int) -> str:
+        ends = self.columns['name_ends']
+        return str(self.columns['names'][ends[index - 1] if index else 0:ends[index]], 'utf-8')
+
+    def key(self, index: int) -> ContentKey:
+        key_index = self.columns['keys'][index]
+        if key_index < 0:
+            return None
+        key = self.keys[key_index]
+        sequence = self.columns['ivs'][index]
+        if sequence < 0:
+            return key
+        return ContentKey(key.url, key.raw_key, key.method, f'0x{sequence:032x}')
+
+    def append(self, segment: Segment) -> None:
+        if self.read_only:
+            raise TypeError('Segment tables of a pools file can\'t be changed')
+        if not len(self):
+            self.group = self.group or segment.group
+            self.media_type = self.media_type or segment.media_type
+        url = segment.url
+        split = url.rfind('/') + 1
+        columns = self.columns
+        columns['bases'].append(self.string_index(url[:split]))
+        columns['names'] += url[split:].encode()
+        columns['name_ends'].append(len(columns['names']))
+        columns['exts'].append(self.string_index(segment.ext))
+        key_index, sequence = self.key_index(segment.key)
+        columns['keys'].append(key_index)
+        columns['ivs'].append(sequence)
+        start, end = [int(v) for v in segment.mpd_range.split('-')] if segment.mpd_range is not None else (-1, -1)
+        columns['range_starts'].append(start)
+        columns['range_ends'].append(end)
+        columns['durations'].append(segment.duration if segment.duration is not None else NO_DURATION)
+        columns['inits'].append(1 if segment.init else 0)
+        if segment.init and self.leading == len(self):
+            self.leading += 1
+        # Last, the row counts once all its columns are there
+        columns['numbers'].append(segment.number)
+        row = len(self) - 1
+        if self._rows is not None and segment.number not in (row, row - self.leading, -1 - row):
+            self._rows[segment.number] = row
+
+    def extend(self, segments) -> None:
+        for segment in segments:
+            self.append(segment)
+
+    def extend_lazily(self, segments, count: int) -> None:
+        'Appends `count` segments from an iterable as the table is expanded'
+        self.source = iter(segments)
+        self.expected = len(self) + count
+
+    def expand(self, count=None) -> int:
+        'Appends up to `count` segments (all if None) of the lazy segments, returns how many were'
+        with self._expand_lock:
+            appended = 0
+            while self.source is not None and (count is None or appended < count):
+                segment = next(self.source, None)
+                if segment is None:
+                    self.source = None
+                    break
+                self.append(segment)
+                appended += 1
+            return appended
+
+    @property
+    def expanding(self) -> bool:
+        return self.source is not None
+
+    @property
+    def total(self) -> int:
+        'Length of the table once expanded'
+        return self.expected if self.expanding else len(self)
+
+    def string_index(self, value: str) -> int:
+        if value not in self._string_indexes:
+            self._string_indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return self._string_indexes[value]
+
+    def key_index(self, key: ContentKey) -> tuple:
+        'Returns the index of a key and its IV sequence number, keys only differing in their sequence IV are stored once'
+        if key is None:
+            return (-1, -1)
+        sequence = -1
+        if key.iv is not None and key.iv[:2] == '0x':
+            try:
+                sequence = int(key.iv, 16)
+            except ValueError:
+                pass
+            # Only if it's written back the same way
+            if sequence >= 2 ** 63 or key.iv != f'0x{sequence:032x}':
+                sequence = -1
+        identity = (key.url, key.raw_key, key.method, key.iv if sequence < 0 else None)
+        if identity not in self._key_indexes:
+            self._key_indexes[identity] = len(self.keys)
+            self.keys.append(ContentKey(*identity))
+        return (self._key_indexes[identity], sequence)
+
+    def row(self, number: int) -> int:
+        'Returns the row of a segment by its number, raises KeyError if it\'s not in the table'
+        numbers = self.columns['numbers']
+        # Segments are usually numbered by their row, or after the
+        # initialization segments if they come first (-1, -2...)
+        for row in (number, number + self.leading, -1 - number):
+            if 0 <= row < len(numbers) and numbers[row] == number:
+                return row
+        if self._rows is None:
+            self._rows = {n: i for i, n in enumerate(numbers) if n not in (i, i - self.leading, -1 - i)}
+        return self._rows[number]
+
+    def get(self, number: int) -> Segment:
+        'Returns a segment by its number'
+        return self[self.row(number)]
+
+    def has_ranges(self) -> bool:
+        'Returns True if any media segment is a byte range'
+        starts = self.columns['range_starts']
+        inits = self.columns['inits']
+        return any(starts[i] >= 0 and not inits[i] for i in range(len(self)))
+
+    def init_segments(self) -> list:
+        inits = self.columns['inits']
+        return [self[i] for i in range(len(self)) if inits[i]]
+
+    def part_numbers(self, index: int) -> range:
+        'Returns the numbers of the media segments of a part'
+        end = self.parts[index + 1] if index + 1 < len(self.parts) else self.total - self.leading
+        return range(self.parts[index], end)
+
+    def describe(self, columns: dict) -> dict:
+        'Returns what is needed to map the table back from a pools file, besides the columns'
+        return {
+            'group': self.group,
+            'media_type': self.media_type,
+            'strings': self.strings,
+            'keys': self.keys,
+            'parts': self.parts,
+            'columns': columns,
+            }
+
+    @classmethod
+    def mapped(cls, description: dict, view: memoryview):
+        'Returns a read-only table whose columns are slices of `view`, described by `describe`'
+        table = cls(description['group'], description['media_type'])
+        table.strings = description['strings']
+        table.keys = description['keys']
+        table.parts = description['parts']
+        table.columns = {
+            name: view[offset:offset + length].cast(COLUMNS[name])
+            for name, (offset, length) in description['columns'].items()
+            }
+        inits = table.columns['inits']
+        while table.leading < len(table) and inits[table.leading]:
+            table.leading += 1
+        table.read_only = True
+        return table
+
+    def release(self) -> None:
+        'Releases the columns of a mapped table, the table can\'t be used anymore'
+        if self.read_only:
+            for column in self.columns.values():
+                column.release()
+
+
+class SegmentSizes:
+    '''
+    ## Segment sizes
+    ### Sizes of the completed segments of a table, by segment number
+        >>> sizes = SegmentSizes(pool.segments)
+        >>> sizes[10] = 1048576
+        >>> 10 in sizes, 11 in sizes
+        (True, False)
+
+    Works like a dictionary, kept in a bitset of the completed segments
+    and an array of their sizes instead of an object per segment, both
+    grow with the table. Completed segments can't be removed
+    '''
+    def __init__(self, table: SegmentTable):
+        self.table = table
+        self.completed = bytearray((len(table) + 7) // 8)
+        self.sizes = array('q', bytes(8 * len(table)))
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def is_completed(self, row: int) -> bool:
+        return row < len(self.sizes) and bool(self.completed[row >> 3] & 1 << (row & 7))
+
+    def __contains__(self, number: int) -> bool:
+        try:
+            row = self.table.row(number)
+        except KeyError:
+            return False
+        return self.is_completed(row)
+
+    def __getitem__(self, number: int) -> int:
+        row = self.table.row(number)
+        if not self.is_completed(row):
+            raise KeyError(number)
+        return self.sizes[row]
+
+    def __setitem__(self, number: int, size: int) -> None:
+        row = self.table.row(number)
+        with self._lock:
+            if row >= len(self.sizes):
+                # Appended to the table since
+                self.completed += bytes((len(self.table) + 7) // 8 - len(self.completed))
+                self.sizes.extend(array('q', bytes(8 * (len(self.table) - len(self.sizes)))))
+            if not self.completed[row >> 3] & 1 << (row & 7):
+                self.completed[row >> 3] |= 1 << (row & 7)
+                self.count += 1
+            self.sizes[row] = size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        numbers = self.table.columns['numbers']
+        for row in range(len(self.sizes)):
+            if self.completed[row >> 3] & 1 << (row & 7):
+                yield numbers[row]
+
+    def get(self, number: int, default=None):
+        try:
+            return self[number]
+        except KeyError:
+            return default
+
+    def items(self):
+        return ((number, self[number]) for number in self)
+
+    def copy(self):
+        copy = SegmentSizes.__new__(SegmentSizes)
+        copy.table = self.table
+        with self._lock:
+            copy.completed = bytearray(self.completed)
+            copy.sizes = array('q', self.sizes)
+            copy.count = self.count
+        copy._lock = threading.Lock()
+        return copy
+
+
+def save_pools(path: str, pools: list, stats: dict) -> None:
+    '''
+    Writes the segment pools of an item, and its stats, to a file that `SavedPools`
+    maps back. Columns of the tables are stored as they are in memory, 8-byte aligned
+    '''
+    blocks = []
+    position = 0
+    pool_descriptions = []
+    for pool in pools:
+        columns = {}
+        for name, column in pool.segments.columns.items():
+            data = memoryview(column).cast('B')
+            columns[name] = (position, len(data))
+            blocks.append(data)
+            position += len(data)
+            blocks.append(bytes(-position % 8))
+            position += len(blocks[-1])
+        pool_descriptions.append({
+            'format': pool.format,
+            'id': pool.id,
+            'track_id': pool.track_id,
+            'pool_type': pool.pool_type,
+            'media_sequence': pool.media_sequence,
+            'segments': pool.segments.describe(columns)
+            })
+    header = pickle.dumps({'pools': pool_descriptions, 'stats': stats})
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(len(header)))
+        f.write(header)
+        f.write(bytes(-(len(MAGIC) + HEADER.size + len(header)) % 8))
+        for block in blocks:
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+class SavedPools:
+    '''
+    ## Saved pools
+    ### Segment pools and stats of an item, mapped from the file written by `save_pools`
+        >>> saved = SavedPools('.../Title (1).pools')
+        >>> saved.pools, saved.stats
+        >>> saved.close()
+
+    The pools' tables can't be used once closed
+    '''
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(f'Invalid pools file "{path}"')
+        header_size, = HEADER.unpack_from(self.map, len(MAGIC))
+        header_start = len(MAGIC) + HEADER.size
+        header = pickle.loads(self.map[header_start:header_start + header_size])
+        data_start = header_start + header_size
+        data_start += -data_start % 8
+        self.view = memoryview(self.map)[data_start:]
+        self.stats = header['stats']
+        self.pools = [
+            SegmentPool(
+                SegmentTable.mapped(p['segments'], self.view),
+                p['format'],
+                p['id'],
+                p['track_id'],
+                p['pool_type'],
+                p.get('media_sequence', 0)
+                )
+            for p in header['pools']
+            ]
+
+    def close(self) -> None:
+        for pool in self.pools:
+            pool.segments.release()
+        self.view.release()
+        self.map.close()
@@ -0,0 +1,150 @@
+import os
+import threading
+
+from functools import lru_cache
+
+from singularity.downloader.penguin.ranges import parse_range
+from singularity.types.stream import Segment
+
+
+class TrackFile:
+    '''
+    ## Track file
+    ### Preallocated file where the segments of a byte-range track (DASH) are written
+    ### directly at their final offset, no concatenation needed afterwards
+        >>> track = TrackFile(path='.../video0.mp4', segments=pool.segments)
+        >>> track.write(segment, offset=0, data=b'...')
+        >>> track.close()
+
+    Offsets are calculated from each segment's size, the initialization segment
+    first and media segments ordered by their range, so any unused bytes between
+    ranges (like a `sidx` box) are left out.
+
+    Completed segments are not tracked here, the downloader's journal knows
+    which holes are left to download on resume
+    '''
+    def __init__(self, path: str, segments: list):
+        if not self.supports(segments):
+            raise ValueError('Track files need segments with a byte range')
+        self.path = path
+        self.offsets = {}
+        self.sizes = {}
+        offset = 0
+        for segment in sorted(segments, key=lambda s: (not s.init, parse_range(s.mpd_range)[0])):
+            start, end = parse_range(segment.mpd_range)
+            size = end - start + 1
+            self.offsets[segment.number] = offset
+            self.sizes[segment.number] = size
+            offset += size
+        self.size = offset
+        self._lock = threading.Lock()
+        if not os.path.exists(self.path):
+            preallocate(self.path, self.size)
+        self.fd = os.open(self.path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+
+    @staticmethod
+    def supports(segments: list) -> bool:
+        'Returns True if all segments are byte ranges of the same url, with up to one initialization segment'
+        return bool(segments) and all(s.mpd_range is not None for s in segments) and \
+            len({s.url for s in segments}) == 1 and len([s for s in segments if s.init]) <= 1
+
+    def read(self, segment: Segment, size=None) -> bytearray:
+        'Returns the data of a segment, as written, `size` defaults to the segment size'
+        return pread(self.fd, size if size is not None else self.sizes[segment.number], self.offsets[segment.number], self._lock)
+
+    def write(self, segment: Segment, offset: int, data) -> None:
+        'Writes data of a segment, `offset` being relative to the segment start'
+        pwrite(self.fd, data, self.offsets[segment.number] + offset, self._lock)
+
+    def write_at(self, offset: int, buffers: list) -> None:
+        'Writes several buffers one after the other, from an absolute offset of the file'
+        if not hasattr(os, 'pwritev'):
+            for buffer in buffers:
+                pwrite(self.fd, buffer, offset, self._lock)
+                offset += len(buffer)
+            return
+        # Vectored writes take a limited amount of buffers (IOV_MAX)
+        for i in range(0, len(buffers), 512):
+            chunk = buffers[i:i + 512]
+            total = sum(len(b) for b in chunk)
+            written = os.pwritev(self.fd, chunk, offset)
+            if written < total:
+                # Short write, write the rest with regular writes
+                pwrite(self.fd, memoryview(b''.join(chunk))[written:], offset + written, self._lock)
+            offset += total
+
+    def sync(self) -> None:
+        'Flushes the data written to disk'
+        getattr(os, 'fdatasync', os.fsync)(self.fd)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def preallocate(path: str, size: int) -> None:
+    'Creates a file of the specified size, reserving the space when possible'
+    with open(path, 'wb') as f:
+        if hasattr(os, 'posix_fallocate') and size:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                # Not supported by the filesystem
+                pass
+        f.truncate(size)
+
+
+@lru_cache()
+def supports_sparse(directory: str) -> bool:
+    '''
+    Returns True if files of a directory can have holes, probed once per directory
+    by extending an empty file and checking no blocks were allocated for it
+    '''
+    path = f'{directory}/.sparse-probe'
+    try:
+        with open(path, 'wb') as f:
+            f.truncate(16777216)
+            blocks = getattr(os.fstat(f.fileno()), 'st_blocks', None)
+    except OSError:
+        return False
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    # Not reported on Windows, NTFS files are not sparse unless told to
+    return blocks is not None and blocks * 512 < 16777216
+
+
+def pwrite(fd: int, data, offset: int, lock: threading.Lock) -> None:
+    'Positional write, `lock` is only used on systems without `os.pwrite` (Windows)'
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        return
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def pread(fd: int, size: int, offset: int, lock: threading.Lock) -> bytearray:
+    'Positional read, `lock` is only used on systems without `os.pread` (Windows)'
+    data = bytearray()
+    if hasattr(os, 'pread'):
+        while len(data) < size:
+            chunk = os.pread(fd, size - len(data), offset + len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while len(data) < size:
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                break
+            data += chunk
+    return data
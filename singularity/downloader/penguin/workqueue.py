@@ -0,0 +1,97 @@
+import threading
+
+from singularity.types.stream import SegmentPool
+
+# Segments appended at once to a lazily expanded table running out of work
+EXPAND_BATCH = 256
+
+
+class SegmentQueue:
+    '''
+    ## Segment queue
+    ### Thread-safe work queue of the segments of several pools
+        >>> from singularity.downloader.penguin.workqueue import SegmentQueue
+        >>> queue = SegmentQueue()
+        >>> queue.add_pool(pool, pool.segments)
+        >>> work = queue.get(preferred='video0')
+        >>> if work is not None:
+        >>>     pool, segment = work
+        >>>     ...  # Download the segment
+        >>>     queue.task_done(pool)
+
+    Every item is given to a single worker. Workers take from their preferred
+    pool, and once it's empty they steal from the pool with most work left.
+    A pool is finished when its last in-flight segment is done, not when its
+    queue empties, `on_pool_finished` is called with the pool at that moment.
+    Items are handed out in order from the sequence given, without copying it.
+    `SegmentTable`s still being expanded are expanded here as their items run out
+    '''
+    def __init__(self, on_pool_finished=None):
+        self.on_pool_finished = on_pool_finished
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._queues = {}
+        # Position of the next item to give, by pool
+        self._cursors = {}
+        self._in_flight = {}
+        self._stopped = False
+
+    def add_pool(self, pool: SegmentPool, items) -> None:
+        'Queues the items of a pool, a list or a `SegmentTable`'
+        with self._lock:
+            self._pools[pool.id] = pool
+            self._queues[pool.id] = items
+            self._cursors[pool.id] = 0
+            self._in_flight[pool.id] = 0
+            empty = not self._left(pool.id)
+        if empty:
+            self._finish(pool)
+
+    def _left(self, pool_id: str) -> int:
+        items = self._queues[pool_id]
+        left = len(items) - self._cursors[pool_id]
+        if not left and getattr(items, 'expanding', False):
+            left = items.expand(EXPAND_BATCH)
+        return left
+
+    def get(self, preferred=None):
+        'Returns a `(pool, item)` tuple, or None if there is no work left to give'
+        with self._lock:
+            if self._stopped:
+                return None
+            if preferred not in self._queues or not self._left(preferred):
+                # Steal from the pool with the biggest backlog
+                preferred = max(self._queues, key=self._left, default=None)
+                if preferred is None or not self._left(preferred):
+                    return None
+            self._in_flight[preferred] += 1
+            self._cursors[preferred] += 1
+            return (self._pools[preferred], self._queues[preferred][self._cursors[preferred] - 1])
+
+    def task_done(self, pool: SegmentPool) -> None:
+        with self._lock:
+            self._in_flight[pool.id] -= 1
+            finished = not self._left(pool.id) and not self._in_flight[pool.id]
+        if finished:
+            self._finish(pool)
+
+    def pending(self, pool_id=None) -> int:
+        'Returns the amount of queued (not in-flight) items of a pool, or of all pools'
+        with self._lock:
+            if pool_id is not None:
+                return self._left(pool_id)
+            return sum(self._left(p) for p in self._queues)
+
+    def stop(self) -> None:
+        'Stops giving work, items in flight can still be marked as done'
+        with self._lock:
+            self._stopped = True
+
+    def pool_ids(self) -> list:
+        with self._lock:
+            return list(self._queues)
+
+    def _finish(self, pool: SegmentPool) -> None:
+        pool._finished = True
+        if self.on_pool_finished is not None:
+            self.on_pool_finished(pool)
@@ -0,0 +1,170 @@
+import threading
+
+from dataclasses import dataclass, field
+from queue import Empty, Queue
+
+from singularity.types.stream import Segment
+from singularity.utils import vprint
+
+
+class WriterError(IOError):
+    'The writer thread failed to write segments, the download can\'t go on'
+
+@dataclass
+class WriteRequest:
+    '''
+    Data of a segment waiting to be written. `offset` bytes of the segment are already
+    on disk, from previous attempts, `data` goes after them. `on_written` is called by
+    the writer thread once the data is on disk
+    '''
+    segment: Segment
+    data: bytearray
+    store: object
+    offset: int = 0
+    on_written: object = None
+    # Bytes of the memory limit taken by the request, released once written
+    reserved: int = field(default=0, repr=False)
+
+    @property
+    def contiguous(self) -> bool:
+        'True if the store keeps the segments of the pool in a single file'
+        return self.store.position(self.segment) is not None
+
+    @property
+    def position(self) -> int:
+        'Position in the pool file, or the segment number for stores of separate segments'
+        position = self.store.position(self.segment)
+        if position is not None:
+            return position + self.offset
+        return self.segment.number
+
+
+class SegmentWriter:
+    '''
+    ## Segment writer
+    ### Write-behind stage, segment fetchers hand the segments they download to a
+    ### single thread that writes them to disk, ordered by pool and position
+        >>> from singularity.downloader.penguin.writer import SegmentWriter, WriteRequest
+        >>> writer = SegmentWriter(memory_limit=67108864)
+        >>> writer.reserve(len(data))  # Blocks while over the memory limit
+        >>> writer.submit(WriteRequest(segment, data, store, reserved=len(data)))
+        >>> writer.flush(segment.group)  # Waits until the pool's segments are written
+        >>> writer.close()
+
+    Requests queued at the same time are written together: contiguous segments
+    of a pool file with a single vectored write, the rest one after the other. A segment bigger than the memory limit is allowed when nothing else
+    is waiting to be written
+    '''
+    def __init__(self, memory_limit: int, queue_size=256, name='writer'):
+        self.memory_limit = max(1, memory_limit)
+        self.in_flight = 0
+        self.pending = {}
+        self.queued = set()
+        self.error = None
+        self._queue = Queue(maxsize=queue_size)
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self._thread.start()
+
+    def reserve(self, amount: int) -> None:
+        'Takes `amount` bytes of the memory limit, waiting until they are available'
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.in_flight + amount <= self.memory_limit or not self.in_flight or self.error
+                )
+            self.in_flight += amount
+
+    def release(self, amount: int) -> None:
+        with self._condition:
+            self.in_flight -= amount
+            self._condition.notify_all()
+
+    def submit(self, request: WriteRequest) -> None:
+        with self._condition:
+            if self.error is not None:
+                raise WriterError(f'Segment writer failed: {self.error}')
+            self.pending[request.segment.group] = self.pending.get(request.segment.group, 0) + 1
+            self.queued.add((request.segment.group, request.segment.number))
+        self._queue.put(request)
+
+    def is_queued(self, segment: Segment) -> bool:
+        'Returns True if a segment is waiting to be written'
+        return (segment.group, segment.number) in self.queued
+
+    def flush(self, group=None) -> None:
+        'Waits until the segments of a pool (or all of them) are written'
+        with self._condition:
+            self._condition.wait_for(
+                lambda: not (self.pending.get(group) if group is not None else any(self.pending.values()))
+                )
+            if self.error is not None:
+                raise WriterError(f'Segment writer failed: {self.error}')
+
+    def close(self) -> None:
+        'Writes everything left and stops the writer thread'
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise WriterError(f'Segment writer failed: {self.error}')
+
+    def run(self) -> None:
+        while True:
+            requests = [self._queue.get()]
+            # Take everything queued, to write it in order
+            while True:
+                try:
+                    requests.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            stop = None in requests
+            requests = sorted(
+                [r for r in requests if r is not None],
+                key=lambda r: (r.segment.group, not r.contiguous, r.position)
+                )
+            for batch in coalesce_requests(requests):
+                try:
+                    if self.error is None:
+                        write_requests(batch)
+                        for request in batch:
+                            if request.on_written is not None:
+                                request.on_written()
+                except Exception as e:
+                    # Segments not written are not recorded as downloaded,
+                    # the error is raised to the downloader on flush
+                    vprint(f'Failed to write segments: {e}', 1, 'penguin', 'error')
+                    self.error = e
+                finally:
+                    self.done(batch)
+            if stop:
+                return
+
+    def done(self, batch: list) -> None:
+        with self._condition:
+            for request in batch:
+                self.in_flight -= request.reserved
+                self.pending[request.segment.group] -= 1
+                self.queued.discard((request.segment.group, request.segment.number))
+            self._condition.notify_all()
+
+
+def coalesce_requests(requests: list) -> list:
+    'Groups sorted requests writing contiguous bytes of the same pool file'
+    batches = []
+    for request in requests:
+        if batches and request.contiguous and batches[-1][-1].store is request.store:
+            last = batches[-1][-1]
+            if last.position + len(last.data) == request.position:
+                batches[-1].append(request)
+                continue
+        batches.append([request])
+    return batches
+
+
+def write_requests(batch: list) -> None:
+    'Writes a batch of requests, several only if they are contiguous in a pool file'
+    if len(batch) > 1:
+        batch[0].store.write_at(batch[0].position, [r.data for r in batch])
+        return
+    request = batch[0]
+    with request.store.open(request.segment, request.offset) as output:
+        output.write(request.data)
@@ -251,10 +251,11 @@ class PrimeVideoExtractor(BaseExtractor):
         return self.episode
     
     def filter_keys(self, manifest_url: str, keys: list):
-        if not hasattr(self, 'mpd_playlist'):
-            self.mpd_playlist = request_xml(
-                url=manifest_url
-            )[0]
+        # Shared with the downloader through the response cache, fetched once
+        self.mpd_playlist = request_xml(
+            url=manifest_url,
+            cache=True
+        )[0]
             
         vprint('Attempting to match correct kid:key combination', 3, 'primevideo', 'debug')
         
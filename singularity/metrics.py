@@ -0,0 +1,334 @@
+import json
+import os
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import count
+from time import monotonic, time
+
+# Fetch, concat and muxing times go from milliseconds to minutes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Updates are spread between shards picked by thread, so threads
+# incrementing the same metric rarely wait for each other
+SHARDS = 16
+
+# Shard of each thread, given in turns the first time it updates a
+# metric (thread idents are aligned pointers, they'd share a shard)
+_thread_shard = threading.local()
+_next_shard = count()
+
+
+def get_thread_shard() -> int:
+    'Returns the shard index of the current thread'
+    try:
+        return _thread_shard.index
+    except AttributeError:
+        _thread_shard.index = next(_next_shard) % SHARDS
+        return _thread_shard.index
+
+
+class Metric:
+    'Base of the metric types, samples are identified by their label values'
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help='', labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._shards = [({}, threading.Lock()) for _ in range(SHARDS)]
+
+    def label_key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def shard(self) -> tuple:
+        return self._shards[get_thread_shard()]
+
+    def remove(self, **labels) -> None:
+        'Removes a sample, for labels that are not going to be used again'
+        key = self.label_key(labels)
+        for values, lock in self._shards:
+            with lock:
+                values.pop(key, None)
+
+
+class Counter(Metric):
+    '''
+    ## Counter
+    ### Monotonically increasing value, safe to increment from any thread
+        >>> downloaded = Counter('penguin_segment_bytes_total', 'Segment bytes downloaded', ['host'])
+        >>> downloaded.inc(1024, host='cdn.example.com')
+        >>> downloaded.value(host='cdn.example.com')
+        1024
+    '''
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels) -> None:
+        key = self.label_key(labels)
+        values, lock = self.shard()
+        with lock:
+            values[key] = values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = self.label_key(labels)
+        total = 0
+        for values, lock in self._shards:
+            with lock:
+                total += values.get(key, 0)
+        return total
+
+    def samples(self) -> dict:
+        totals = {}
+        for values, lock in self._shards:
+            with lock:
+                for key, value in values.items():
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+class Gauge(Metric):
+    'Value that goes up and down, like a queue depth'
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help='', labelnames=()):
+        super().__init__(name, help, labelnames)
+        # Gauges are set as a whole, a single shard is enough
+        self._shards = self._shards[:1]
+
+    def set(self, value, **labels) -> None:
+        values, lock = self._shards[0]
+        with lock:
+            values[self.label_key(labels)] = value
+
+    def inc(self, amount=1, **labels) -> None:
+        key = self.label_key(labels)
+        values, lock = self._shards[0]
+        with lock:
+            values[key] = values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        values, lock = self._shards[0]
+        with lock:
+            return values.get(self.label_key(labels), 0)
+
+    def samples(self) -> dict:
+        values, lock = self._shards[0]
+        with lock:
+            return dict(values)
+
+
+class Histogram(Metric):
+    '''
+    ## Histogram
+    ### Distribution of observed values, usually durations in seconds
+        >>> fetch_time = Histogram('penguin_segment_fetch_seconds', 'Segment fetch time', ['host'])
+        >>> with fetch_time.time(host='cdn.example.com'):
+        >>>     download(segment)
+    '''
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help='', labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.label_key(labels)
+        index = bisect_left(self.buckets, value)
+        values, lock = self.shard()
+        with lock:
+            sample = values.get(key)
+            if sample is None:
+                # Counts per bucket (the last one is +Inf), sum
+                sample = values[key] = [[0] * (len(self.buckets) + 1), 0]
+            sample[0][index] += 1
+            sample[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        'Observes the time spent inside the block, even if it raises'
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def samples(self) -> dict:
+        'Returns the cumulative bucket counts, count and sum of every sample'
+        merged = {}
+        for values, lock in self._shards:
+            with lock:
+                for key, (counts, total) in values.items():
+                    if key not in merged:
+                        merged[key] = [[0] * len(counts), 0]
+                    merged[key][0] = [a + b for a, b in zip(merged[key][0], counts)]
+                    merged[key][1] += total
+        samples = {}
+        for key, (counts, total) in merged.items():
+            cumulative = []
+            running = 0
+            for count in counts:
+                running += count
+                cumulative.append(running)
+            samples[key] = {
+                'buckets': dict(zip([*map(format_value, self.buckets), '+Inf'], cumulative)),
+                'count': running,
+                'sum': total,
+            }
+        return samples
+
+
+class MetricsRegistry:
+    '''
+    ## Metrics registry
+    ### Process-wide collection of metrics, exportable as JSON or Prometheus text
+        >>> from singularity.metrics import get_metrics
+        >>> retries = get_metrics().counter('penguin_segment_retries_total', 'Failed segment requests', ['host'])
+        >>> get_metrics().to_prometheus()
+        '# HELP penguin_segment_retries_total Failed segment requests\\n...'
+
+    Registering a metric that already exists returns the existing one
+    '''
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric_type: type, name: str, help='', labelnames=(), **kwargs) -> Metric:
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_type(name, help, labelnames, **kwargs)
+            elif type(metric) != metric_type or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'Metric {name} already registered with a different type or labels')
+            return metric
+
+    def counter(self, name: str, help='', labelnames=()) -> Counter:
+        return self.register(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help='', labelnames=()) -> Gauge:
+        return self.register(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help='', labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def collect(self) -> list:
+        with self._lock:
+            return sorted(self.metrics.values(), key=lambda m: m.name)
+
+    def snapshot(self) -> dict:
+        'Returns every metric as a JSON serializable dict'
+        return {
+            m.name: {
+                'type': m.TYPE,
+                'help': m.help,
+                'samples': [
+                    {'labels': dict(zip(m.labelnames, key)), 'value': value}
+                    for key, value in sorted(m.samples().items())
+                    ]
+                }
+            for m in self.collect()
+        }
+
+    def to_prometheus(self) -> str:
+        'Returns every metric in the Prometheus text exposition format'
+        lines = []
+        for metric in self.collect():
+            lines.append(f'# HELP {metric.name} {escape_help(metric.help)}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            for key, value in sorted(metric.samples().items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.TYPE != 'histogram':
+                    lines.append(f'{metric.name}{format_labels(labels)} {format_value(value)}')
+                    continue
+                for bound, count in value['buckets'].items():
+                    lines.append(f'{metric.name}_bucket{format_labels(labels + [("le", bound)])} {count}')
+                lines.append(f'{metric.name}_sum{format_labels(labels)} {format_value(value["sum"])}')
+                lines.append(f'{metric.name}_count{format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsWriter:
+    '''
+    ## Metrics writer
+    ### Periodically writes a JSON status file and/or a Prometheus text file
+        >>> writer = MetricsWriter(get_metrics(), status_path='status.json', status=lambda: {...})
+        >>> writer.start()
+        >>> writer.stop()  # Writes the files a last time
+
+    Files are replaced atomically, readers never see half written files
+    '''
+    def __init__(self, registry: MetricsRegistry, status_path=None, prometheus_path=None, interval=5.0, status=None):
+        self.registry = registry
+        self.status_path = status_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.status = status
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='metrics', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.write()
+
+    def run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                from singularity.utils import vprint
+                vprint(f'Failed to write metrics: {e}', 2, 'metrics', 'warning')
+
+    def write(self) -> None:
+        if self.status_path:
+            status = dict(self.status()) if self.status is not None else {}
+            status['time'] = time()
+            status['metrics'] = self.registry.snapshot()
+            write_atomic(self.status_path, json.dumps(status, indent=4, default=str))
+        if self.prometheus_path:
+            write_atomic(self.prometheus_path, self.registry.to_prometheus())
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels: list) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def escape_help(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def write_atomic(path: str, contents: str) -> None:
+    with open(f'{path}.part', 'w') as f:
+        f.write(contents)
+    os.replace(f'{path}.part', path)
+
+
+_metrics = MetricsRegistry()
+
+
+def get_metrics() -> MetricsRegistry:
+    'Returns the process-wide metrics registry'
+    return _metrics
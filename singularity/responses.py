@@ -0,0 +1,180 @@
+import json
+import threading
+
+from collections import OrderedDict
+from copy import copy
+from time import monotonic
+
+# Until the configuration is loaded, same as its defaults
+DEFAULT_RESPONSE_CACHE_SIZE = 33554432
+DEFAULT_RESPONSE_CACHE_TTL = 600
+
+
+class CachedResponse:
+    def __init__(self, response, ttl: float):
+        self.response = response
+        self.size = len(response.content)
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.expires = monotonic() + ttl
+
+
+class ResponseCache:
+    '''
+    ## Response cache
+    ### Process-wide cache of GET responses, manifests and other small resources
+    ### are fetched once, no matter how many extractors or protocols ask for them
+        >>> from singularity.responses import get_response_cache
+        >>> response = get_response_cache().get(url, fetch=lambda url, headers: session.get(url, headers=headers))
+
+    Responses are kept for `ttl` seconds, or while their key is held (by queued
+    items, for their manifests), least recently used ones are dropped once they
+    take more than `max_bytes`. Expired responses with an `ETag` or
+    `Last-Modified` header are revalidated, a 304 keeps them for another `ttl`.
+    Threads asking for a response being fetched wait for it instead of fetching
+    it too. Only 200 responses up to `max_response_size` are cached, every caller
+    gets its own copy of them
+    '''
+    def __init__(self, max_bytes: int, ttl: float, max_response_size=None):
+        self.responses = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._fetching = {}
+        # Keys kept from expiring, and how many times they are held
+        self._held = {}
+        self._lock = threading.Lock()
+        self.configure(max_bytes, ttl, max_response_size)
+
+    def configure(self, max_bytes: int, ttl: float, max_response_size=None) -> None:
+        'Changes the limits of the cache, responses over them are dropped'
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self.max_response_size = max_response_size if max_response_size is not None else max_bytes // 4
+            for key in [k for k, c in self.responses.items() if c.size > self.max_response_size]:
+                self.size -= self.responses.pop(key).size
+            while self.size > self.max_bytes:
+                self.size -= self.responses.popitem(last=False)[1].size
+
+    def get(self, url: str, fetch, key=None):
+        '''
+        Returns the response of `url`, calling `fetch(url, headers)` to request it if not cached,
+        `headers` being the conditional ones of an expired response. `key` defaults to the url
+        '''
+        key = key if key is not None else url
+        while True:
+            with self._lock:
+                cached = self.responses.get(key)
+                if cached is not None and not self.expired(key, cached):
+                    self.hits += 1
+                    self.responses.move_to_end(key)
+                    return copy_response(cached.response)
+                event = self._fetching.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self._fetching[key] = threading.Event()
+                    break
+            # Fetched by another thread, try again once it's done
+            event.wait()
+        try:
+            headers = {}
+            if cached is not None and cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached is not None and cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+            response = fetch(url, headers)
+            with self._lock:
+                if response.status_code == 304 and cached is not None:
+                    self.revalidated += 1
+                    cached.expires = monotonic() + self.ttl
+                    if key in self.responses:
+                        self.responses.move_to_end(key)
+                    return copy_response(cached.response)
+                self.store(key, response)
+            return copy_response(response)
+        finally:
+            with self._lock:
+                del self._fetching[key]
+            event.set()
+
+    def store(self, key: str, response) -> None:
+        'Caches a response, if it can be. Must be called with the lock held'
+        if key in self.responses:
+            self.size -= self.responses.pop(key).size
+        if response.status_code != 200 or 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+        cached = CachedResponse(response, self.ttl)
+        if cached.size > self.max_response_size:
+            return
+        self.responses[key] = cached
+        self.size += cached.size
+        while self.size > self.max_bytes:
+            self.size -= self.responses.popitem(last=False)[1].size
+
+    def get_cached(self, key: str) -> bytes:
+        'Returns the contents of a cached, not expired, response, None if there isn\'t one'
+        with self._lock:
+            cached = self.responses.get(key)
+            if cached is None or self.expired(key, cached):
+                return None
+            self.hits += 1
+            self.responses.move_to_end(key)
+            return cached.response.content
+
+    def expired(self, key: str, cached: CachedResponse) -> bool:
+        'Must be called with the lock held'
+        return key not in self._held and monotonic() >= cached.expires
+
+    def hold(self, keys) -> None:
+        'Keeps the responses of `keys`, cached or not yet, from expiring until they are released'
+        with self._lock:
+            for key in keys:
+                self._held[key] = self._held.get(key, 0) + 1
+
+    def release(self, keys) -> None:
+        'Releases held keys, their responses are dropped if they expired meanwhile'
+        with self._lock:
+            for key in keys:
+                if key not in self._held:
+                    continue
+                self._held[key] -= 1
+                if self._held[key]:
+                    continue
+                del self._held[key]
+                cached = self.responses.get(key)
+                if cached is not None and monotonic() >= cached.expires:
+                    self.size -= self.responses.pop(key).size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'responses': len(self.responses),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated
+                }
+
+
+def copy_response(response):
+    'Returns a copy of a response its receiver can change without changing the cached one'
+    response = copy(response)
+    response.headers = response.headers.copy()
+    return response
+
+
+def request_key(url: str, **kwargs) -> str:
+    'Returns the cache key of a request, its url and, if any, its arguments'
+    if not kwargs:
+        return url
+    return f'{url} {json.dumps(kwargs, sort_keys=True, default=str)}'
+
+
+_response_cache = ResponseCache(DEFAULT_RESPONSE_CACHE_SIZE, DEFAULT_RESPONSE_CACHE_TTL)
+
+
+def get_response_cache() -> ResponseCache:
+    'Returns the process-wide response cache, configured by `singularity.config` once loaded'
+    return _response_cache
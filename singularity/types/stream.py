@@ -9,10 +9,13 @@ class ContentKey(PolarType):
     
     - `AES-128`
     - `Widevine` (Only on Singularity)
+    
+    `iv` is the AES-128 IV, as an hex string
     '''
     url: str
     raw_key: str
     method: str
+    iv: str = None
 
 @dataclass
 class Stream(PolarType):
@@ -57,9 +60,9 @@ class SegmentPool:
     id: str
     track_id: str
     pool_type: str
+    # Of the first segment, the implicit IVs of M3U8 pools are made from it
+    media_sequence: int = 0
     _finished = False
-    _reserved = False
-    _reserved_by = None
     
     def get_ext_from_segment(self, segment=0) -> str:
         if not self.segments:
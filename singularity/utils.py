@@ -8,6 +8,8 @@ import requests
 from requests.models import Response
 from tqdm import tqdm
 from json.decoder import JSONDecodeError
+from singularity.connections import get_connection_budget
+from singularity.responses import get_response_cache, request_key
 from xml.parsers.expat import ExpatError
 
 import cloudscraper
@@ -347,23 +349,34 @@ def mkfile(path=str, contents=str, ):
     if not os.path.exists(path):
         open(path, 'w').write(contents)
         
-def request_webpage(url=str, method='get', **kwargs) -> Response:
+def request_webpage(url=str, method='get', cache=False, **kwargs) -> Response:
     '''
     Make a HTTP request using cloudscraper
     `url` url to make the request to
     `method` http request method
+    `cache` share the GET response through the process-wide response cache, only
+    for manifests and other small resources also requested by the downloaders
     `cloudscraper_kwargs` extra cloudscraper arguments, for more info check the `requests wiki`
     '''
-    # Create a cloudscraper session
-    # Spoof an Android Firefox browser to bypass Captcha v2
-    browser = {
-        'browser': 'firefox',
-        'platform': 'android',
-        'desktop': False,
-    } 
-    r = cloudscraper.create_scraper(browser=browser)
-    response = getattr(r, method.lower())(url, **kwargs)
-    return response
+    def fetch(url: str, headers: dict) -> Response:
+        # Create a cloudscraper session
+        # Spoof an Android Firefox browser to bypass Captcha v2
+        browser = {
+            'browser': 'firefox',
+            'platform': 'android',
+            'desktop': False,
+        } 
+        r = cloudscraper.create_scraper(browser=browser)
+        if headers:
+            # Conditional request of an expired response
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), **headers}
+        # Counts towards the connections to the host made by downloads
+        with get_connection_budget().slot(url):
+            return getattr(r, method.lower())(url, **kwargs)
+
+    if not cache or method.lower() != 'get' or kwargs.get('stream'):
+        return fetch(url, {})
+    return get_response_cache().get(url, fetch, key=request_key(url, **kwargs))
 
 
 